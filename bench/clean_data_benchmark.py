@@ -0,0 +1,130 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import ingest_sources
+
+OPTION_GROUPS = ['Size', 'Milk', 'Extras', 'Sauce', 'Side']
+OPTION_NAMES = ['Small', 'Large', 'Oat milk', 'Extra shot', 'No onions', ' ', '', 'Spicy\x01', 'Cheese\t']
+APP_NAMES = ['franchise-app', 'web', 'kiosk', 'pos']
+CURRENCIES = ['USD', 'CAD']
+ITEM_CATEGORIES = ['Burgers', 'Drinks', 'Sides', 'Desserts', '  ', 'Salads\x0b']
+ITEM_NAMES = ['Classic Burger', 'Cola', 'Fries', 'Brownie', 'Garden Salad', 'Milkshake\x7f', '']
+
+def random_strings(rng, values, rows):
+    return pd.Series(np.asarray(values, dtype=object)[rng.integers(0, len(values), rows)])
+
+def random_timestamps(rng, rows):
+    start = np.datetime64('2025-01-01T00:00:00')
+    return pd.Series(start + rng.integers(0, 180 * 24 * 3600, rows).astype('timedelta64[s]')).astype('datetime64[ns]')
+
+def make_order_items(rows, seed=0):
+    rng = np.random.default_rng(seed)
+
+    return pd.DataFrame({
+        'order_id': rng.integers(1, rows // 4 + 2, rows),
+        'lineitem_id': rng.integers(1, 10, rows),
+        'option_group_name': random_strings(rng, OPTION_GROUPS, rows),
+        'option_name': random_strings(rng, OPTION_NAMES, rows),
+        'option_price': rng.choice([0.0, 0.5, 1.0, 1.25, np.nan], rows),
+        'option_quantity': rng.integers(1, 4, rows),
+        'created_at': random_timestamps(rng, rows),
+    })
+
+def make_order_item_options(rows, seed=0):
+    rng = np.random.default_rng(seed)
+
+    return pd.DataFrame({
+        'app_name': random_strings(rng, APP_NAMES, rows),
+        'restaurant_id': rng.integers(1, 60, rows),
+        'creation_time_utc': random_timestamps(rng, rows),
+        'order_id': rng.integers(1, rows // 3 + 2, rows),
+        'user_id': rng.integers(1, rows // 10 + 2, rows),
+        'is_loyalty': rng.integers(0, 2, rows).astype(bool),
+        'currency': random_strings(rng, CURRENCIES, rows),
+        'lineitem_id': rng.integers(1, 10, rows),
+        'item_category': random_strings(rng, ITEM_CATEGORIES, rows),
+        'item_name': random_strings(rng, ITEM_NAMES, rows),
+        'item_price': rng.choice([2.5, 4.99, 7.25, 11.0, np.nan], rows),
+        'item_quantity': rng.integers(1, 5, rows),
+        'created_at': random_timestamps(rng, rows),
+    })
+
+def time_engine_call(clean, df, repeat):
+    timings = []
+    result = None
+
+    for _ in range(repeat):
+        frame = df.copy()
+        start_time = time.perf_counter()
+        result = clean(frame)
+        timings.append(time.perf_counter() - start_time)
+
+    return min(timings), result
+
+def time_engine(engine, df, repeat):
+    return time_engine_call(ingest_sources.CLEAN_DATA_ENGINES[engine], df, repeat)
+
+def time_workers(workers, df, repeat):
+    os.environ['CLEAN_DATA_WORKERS'] = str(workers)
+
+    # The first call starts the pool, warm containers reuse it so it is not timed
+    ingest_sources.clean_data(df.copy())
+
+    return time_engine_call(lambda frame: ingest_sources.clean_data(frame), df, repeat)
+
+def run_scaling(rows, workers, repeat):
+    df = make_order_item_options(rows)
+
+    # Repeat a slice so duplicates straddle shard boundaries
+    df = pd.concat([df, df.iloc[:rows // 10]], ignore_index=True)
+
+    serial_seconds, serial = time_workers(1, df, repeat)
+    print(f"order_item_options: {len(df)} rows, 1 worker {serial_seconds:.2f}s")
+
+    for count in workers:
+        if count == 1:
+            continue
+
+        seconds, result = time_workers(count, df, repeat)
+
+        if not result.equals(serial):
+            raise AssertionError(f"Sharded cleaning with {count} workers differs from one worker")
+
+        print(f"order_item_options: {len(df)} rows, {count} workers {seconds:.2f}s, speedup {serial_seconds / seconds:.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the legacy and vectorized clean_data engines.')
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, nargs='+', help='time sharded cleaning of order_item_options with these CLEAN_DATA_WORKERS counts instead')
+    args = parser.parse_args()
+
+    if args.workers:
+        run_scaling(args.rows, args.workers, args.repeat)
+        return
+
+    frames = {
+        'order_items': make_order_items(args.rows),
+        'order_item_options': make_order_item_options(args.rows),
+    }
+
+    for table_name, df in frames.items():
+        legacy_seconds, legacy = time_engine('legacy', df, args.repeat)
+        vectorized_seconds, vectorized = time_engine('vectorized', df, args.repeat)
+
+        if not legacy.equals(vectorized):
+            raise AssertionError(f"Engines produced different output for {table_name}")
+
+        print(f"{table_name}: {args.rows} rows, "
+              f"legacy {legacy_seconds:.2f}s, vectorized {vectorized_seconds:.2f}s, "
+              f"speedup {legacy_seconds / vectorized_seconds:.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCH_DIR, '..', 'src')
+
+# Cumulative import milliseconds each handler may spend before its first invocation runs.
+# transform_raw and curate_transformed need pandas and pyarrow on every code path, so theirs are loaded up front.
+IMPORT_BUDGETS_MS = {
+    'ingest_sources': 150,
+    'load_raw': 150,
+    'transform_raw': 1000,
+    'curate_transformed': 1000,
+}
+
+def parse_import_times(stderr):
+    # -X importtime lines look like "import time:  self [us] | cumulative | imported package", nesting is indentation
+    imports = []
+
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports.append({'name': name.strip(), 'depth': (len(name) - len(name.lstrip())) // 2, 'self_us': int(self_us), 'cumulative_us': int(cumulative_us)})
+
+    return imports
+
+def measure_import(module):
+    # A fresh interpreter per sample, nothing is cached in sys.modules the way a cold Lambda container starts
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+        cwd=SRC_DIR,
+        env={**os.environ, 'PYTHONPATH': SRC_DIR},
+        capture_output=True,
+        text=True,
+    )
+
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    imports = parse_import_times(result.stderr)
+    total = next(entry for entry in reversed(imports) if entry['name'] == module and entry['depth'] == 0)
+
+    return total['cumulative_us'] / 1000, imports
+
+def get_heaviest_imports(imports, count):
+    # Packages imported directly by the handler or its helpers, their cumulative time is what laziness can remove
+    top_level = [entry for entry in imports if 1 <= entry['depth'] <= 2]
+
+    return sorted(top_level, key=lambda entry: entry['cumulative_us'], reverse=True)[:count]
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cold-start import cost of every Lambda handler with python -X importtime and fail when one goes over its budget.')
+    parser.add_argument('--modules', nargs='+', default=list(IMPORT_BUDGETS_MS), choices=list(IMPORT_BUDGETS_MS))
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per handler, the median is compared to the budget')
+    parser.add_argument('--budget-scale', type=float, default=1.0, help='multiply every budget, for slower build machines')
+    parser.add_argument('--top', type=int, default=8, help='heaviest imports listed for a handler over budget')
+    parser.add_argument('--output', help='write the report as JSON')
+    args = parser.parse_args()
+
+    # Warm the bytecode cache first, a deployed image ships compiled modules
+    for module in args.modules:
+        measure_import(module)
+
+    report = {}
+    over_budget = []
+
+    for module in args.modules:
+        samples = [measure_import(module) for _ in range(args.repeat)]
+        median_ms = statistics.median(milliseconds for milliseconds, _ in samples)
+        budget_ms = IMPORT_BUDGETS_MS[module] * args.budget_scale
+        heaviest = get_heaviest_imports(samples[-1][1], args.top)
+
+        report[module] = {
+            'median_ms': round(median_ms, 1),
+            'budget_ms': budget_ms,
+            'heaviest': [{'name': entry['name'], 'cumulative_ms': round(entry['cumulative_us'] / 1000, 1)} for entry in heaviest],
+        }
+
+        print(f"{module}: {median_ms:.1f} ms median import over {args.repeat} runs, budget {budget_ms:.0f} ms")
+
+        if median_ms > budget_ms:
+            over_budget.append(module)
+
+            for entry in heaviest:
+                print(f"  {entry['name']}: {entry['cumulative_us'] / 1000:.1f} ms")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if over_budget:
+        print(f"Over the import budget: {', '.join(over_budget)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
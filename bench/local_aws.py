@@ -0,0 +1,273 @@
+import datetime
+import gzip
+import io
+import json
+import os
+import re
+import sqlite3
+import threading
+import uuid
+
+import pyarrow.parquet as pq
+import sqlalchemy as sa
+from botocore.exceptions import ClientError
+
+import resource_cache
+
+# Local stand-ins for the AWS services the pipeline talks to, just enough API surface for the handlers
+
+class LocalS3:
+    def __init__(self, root):
+        self.root = root
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def get_path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def write(self, bucket, key, body):
+        path = self.get_path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'wb') as file:
+            file.write(body)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.write(Bucket, Key, Body if isinstance(Body, bytes) else Body.read())
+
+        return {}
+
+    def upload_file(self, file_path, bucket, key):
+        with open(file_path, 'rb') as file:
+            self.write(bucket, key, file.read())
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        path = self.get_path(Bucket, Key)
+
+        if not os.path.exists(path):
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': Key}}, 'GetObject')
+
+        with open(path, 'rb') as file:
+            body = file.read()
+
+        # Only the 'bytes=start-end' form the pipeline sends
+        if Range:
+            start, end = Range.removeprefix('bytes=').split('-')
+            body = body[int(start):int(end) + 1]
+
+        return {'Body': io.BytesIO(body), 'ContentLength': len(body)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        path = self.get_path(Bucket, Key)
+
+        if not os.path.exists(path):
+            raise ClientError({'Error': {'Code': '404', 'Message': Key}}, 'HeadObject')
+
+        return {'ContentLength': os.path.getsize(path)}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        # S3 deletes of a missing key succeed
+        if os.path.exists(self.get_path(Bucket, Key)):
+            os.remove(self.get_path(Bucket, Key))
+
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', StartAfter='', **kwargs):
+        bucket_root = os.path.join(self.root, Bucket)
+        keys = []
+
+        # Only the folder holding the prefix is walked, like S3 a narrow prefix stays cheap in a large bucket
+        for directory, _, file_names in os.walk(os.path.join(bucket_root, os.path.dirname(Prefix))):
+            for file_name in file_names:
+                key = os.path.relpath(os.path.join(directory, file_name), bucket_root)
+
+                if key.startswith(Prefix) and key > StartAfter:
+                    keys.append(key)
+
+        contents = [{'Key': key, 'Size': os.path.getsize(self.get_path(Bucket, key))} for key in sorted(keys)]
+
+        return {'Contents': contents, 'KeyCount': len(contents), 'IsTruncated': False}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = uuid.uuid4().hex
+
+        with self.lock:
+            self.uploads[upload_id] = {}
+
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = bytes(Body)
+
+        return {'ETag': f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        with self.lock:
+            parts = self.uploads.pop(UploadId)
+
+        self.write(Bucket, Key, b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts']))
+
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+
+        return {}
+
+class LocalDynamoDB:
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get_item(self, TableName, Key, **kwargs):
+        item = self.items.get(Key['table_name']['S'])
+
+        return {'Item': item} if item else {}
+
+    def batch_get_item(self, RequestItems):
+        responses = {}
+
+        for table, request in RequestItems.items():
+            responses[table] = [self.items[key['table_name']['S']] for key in request['Keys'] if key['table_name']['S'] in self.items]
+
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def put_item(self, TableName, Item, **kwargs):
+        with self.lock:
+            self.items[Item['table_name']['S']] = Item
+
+        return {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues, ConditionExpression=None, **kwargs):
+        # Conditions are trusted here, the benchmark only ever moves watermarks forward
+        with self.lock:
+            item = self.items.setdefault(Key['table_name']['S'], dict(Key))
+            set_clause, _, remove_clause = UpdateExpression.partition(' REMOVE ')
+
+            for assignment in set_clause.replace('SET ', '', 1).split(','):
+                name, value = [part.strip() for part in assignment.split('=')]
+                item[name] = ExpressionAttributeValues[value]
+
+            for name in filter(None, (part.strip() for part in remove_clause.split(','))):
+                item.pop(name, None)
+
+        return {}
+
+class LocalRedshiftData:
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+        self.statements = {}
+
+    def count_rows(self, s3uri):
+        bucket, _, key = s3uri.replace('s3://', '', 1).partition('/')
+        body = self.s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+        if key.endswith('.manifest'):
+            return sum(self.count_rows(entry['url']) for entry in json.loads(body)['entries'])
+
+        if key.endswith('.parquet'):
+            return pq.ParquetFile(io.BytesIO(body)).metadata.num_rows
+
+        if key.endswith('.gz'):
+            body = gzip.decompress(body)
+        elif key.endswith('.zst'):
+            import zstandard
+            body = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)).read()
+
+        # Header line is skipped by ignoreheader 1
+        return max(body.count(b'\n') - 1, 0)
+
+    def run(self, sql):
+        match = re.search(r"from '([^']+)'", sql)
+
+        # Staging and merge statements around a snapshot COPY read no object
+        if match is None:
+            return {'Status': 'FINISHED', 'Duration': 0, 'ResultRows': 0}
+
+        s3uri = match.group(1)
+
+        # A COPY from a missing object fails like Redshift's, load_raw's failure paths run against it
+        try:
+            return {'Status': 'FINISHED', 'Duration': 0, 'ResultRows': self.count_rows(s3uri)}
+        except ClientError as e:
+            return {'Status': 'FAILED', 'Duration': 0, 'ResultRows': 0, 'Error': f"{s3uri}: {e}"}
+
+    def execute_statement(self, Sql, **kwargs):
+        statement_id = uuid.uuid4().hex
+        self.statements[statement_id] = dict(self.run(Sql), Id=statement_id, QueryString=Sql)
+
+        return {'Id': statement_id}
+
+    def batch_execute_statement(self, Sqls, **kwargs):
+        statement_id = uuid.uuid4().hex
+        sub_statements = [dict(self.run(sql), QueryString=sql) for sql in Sqls]
+        errors = [sub_statement['Error'] for sub_statement in sub_statements if sub_statement['Status'] == 'FAILED']
+
+        # The batch is one transaction, a failing sub-statement rolls back the others
+        self.statements[statement_id] = {
+            'Id': statement_id,
+            'Status': 'FAILED' if errors else 'FINISHED',
+            'Error': errors[0] if errors else None,
+            'SubStatements': sub_statements,
+            'ResultRows': 0 if errors else sum(sub_statement['ResultRows'] for sub_statement in sub_statements),
+        }
+
+        return {'Id': statement_id}
+
+    def describe_statement(self, Id):
+        return self.statements[Id]
+
+    def list_statements(self, Status, **kwargs):
+        return {'Statements': []}
+
+def install(root):
+    s3_client = LocalS3(root)
+    clients = {
+        's3': s3_client,
+        'dynamodb': LocalDynamoDB(),
+        'redshift-data': LocalRedshiftData(s3_client),
+    }
+
+    # Both handlers reach AWS only through resource_cache
+    resource_cache.get_client = lambda service_name, scope=None: clients[service_name]
+
+    return clients
+
+# Postgres syntax used by the ingestion queries that SQLite does not understand
+POSTGRES_REWRITES = [
+    (re.compile(r'::timestamp'), ''),
+    (re.compile(r'CAST\(([^()]+?) AS timestamp\)'), r'\1'),
+    # SQLite keeps timestamps as text, backfill ranges do arithmetic on the bounds, the alias has them parsed like psycopg2 would
+    (re.compile(r'\b(min|max)\(created_at\)'), r'\1(created_at) AS "\1 [source_timestamp]"'),
+]
+
+sqlite3.register_converter('source_timestamp', lambda value: datetime.datetime.fromisoformat(value.decode('utf-8')))
+
+def regexp_replace(text, pattern, replacement, flags=''):
+    if text is None:
+        return None
+
+    return re.sub(pattern, replacement, text, count=0 if 'g' in flags else 1)
+
+def btrim(text):
+    return text.strip(' ') if text is not None else None
+
+def create_source_engine(path):
+    engine = sa.create_engine(f'sqlite:///{path}', connect_args={'detect_types': sqlite3.PARSE_COLNAMES})
+
+    # Postgres string functions used by the pushdown queries
+    @sa.event.listens_for(engine, 'connect')
+    def register_functions(dbapi_connection, connection_record):
+        dbapi_connection.create_function('regexp_replace', 4, regexp_replace, deterministic=True)
+        dbapi_connection.create_function('btrim', 1, btrim, deterministic=True)
+
+    @sa.event.listens_for(engine, 'before_cursor_execute', retval=True)
+    def rewrite_postgres(conn, cursor, statement, parameters, context, executemany):
+        for pattern, replacement in POSTGRES_REWRITES:
+            statement = pattern.sub(replacement, statement)
+
+        return statement, parameters
+
+    return engine
@@ -0,0 +1,299 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import traceback
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(BENCH_DIR, '..')
+
+sys.path.insert(0, os.path.join(REPO_DIR, 'src'))
+
+import local_aws
+from synthetic_data import FranchiseGenerator, make_date_dim
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baselines', 'pipeline_benchmark.json')
+
+# Local names for the services and buckets, anything already set in the environment wins
+BENCH_ENVIRONMENT = {
+    'AWS_S3': 's3',
+    'AWS_DYNAMODB': 'dynamodb',
+    'AWS_REDSHIFT_DATA_API': 'redshift-data',
+    'AWS_S3_BUCKET_NAME': 'bench-raw',
+    'AWS_S3_FOLDER_PATH': 'raw_data',
+    'AWS_S3_ERROR_BUCKET_NAME': 'bench-errors',
+    'AWS_DYNAMODB_TABLE_NAME': 'bench-watermarks',
+    'AWS_REDSHIFT_ROLE_ARN': 'arn:aws:iam::000000000000:role/bench',
+    'INGEST_CHUNK_SIZE': '50000',
+    # Synthetic orders start on 2025-01-01, recency is measured from the day after the default 180 days
+    'CURATE_AS_OF_DATE': '2025-06-30',
+}
+
+def read_env_template():
+    values = {}
+
+    with open(os.path.join(REPO_DIR, '.env.template')) as file:
+        for line in file:
+            name, separator, value = line.strip().partition('=')
+
+            if separator and not name.startswith('#'):
+                values[name] = value.strip("'")
+
+    return values
+
+def configure_environment():
+    os.environ.setdefault('FILE_STRUCTURES', read_env_template()['FILE_STRUCTURES'])
+
+    for name, value in BENCH_ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+
+def get_directory_bytes(path):
+    return sum(os.path.getsize(os.path.join(directory, file_name)) for directory, _, file_names in os.walk(path) for file_name in file_names)
+
+def generate_source(db_path, rows, chunk_size, days, seed):
+    import pandas as pd
+
+    file_structures = json.loads(os.getenv('FILE_STRUCTURES'))
+    generator = FranchiseGenerator(file_structures, days=days, seed=seed)
+    row_count = 0
+
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    # pandas writes through the DBAPI connection, SQLAlchemy 1.4 connections are not supported by to_sql
+    with contextlib.closing(sqlite3.connect(db_path)) as conn, conn:
+        date_dim = make_date_dim(pd.Timestamp(generator.start), days, file_structures)
+        date_dim.to_sql('date_dim', conn, if_exists='replace', index=False)
+        row_count += len(date_dim)
+
+        for line_items, options in generator.iter_chunks(rows, chunk_size):
+            line_items.to_sql('order_item_options', conn, if_exists='append', index=False)
+            options.to_sql('order_items', conn, if_exists='append', index=False)
+            row_count += len(line_items) + len(options)
+
+    return {'rows': row_count, 'bytes_written': os.path.getsize(db_path)}
+
+def run_ingest(db_path, s3_root):
+    import sqlalchemy as sa
+
+    # Imported after the environment is configured, FILE_STRUCTURES is compiled at import
+    import ingest_sources
+    import metrics
+    import resource_cache
+
+    local_aws.install(s3_root)
+    engine = local_aws.create_source_engine(db_path)
+    bytes_before = get_directory_bytes(s3_root)
+
+    with engine.connect() as conn:
+        row_count = sum(conn.execute(sa.text(f"SELECT count(*) FROM {table_name}")).scalar() for table_name in json.loads(os.getenv('FILE_STRUCTURES')))
+
+    # The handler itself only adds the secret lookup, its metrics and profiling hooks are applied here instead
+    try:
+        metrics.profiled('ingest_sources')(ingest_sources.upload_to_s3)(engine)
+    finally:
+        metrics.flush()
+
+        # Stage processes exit by joining their children, idle clean data workers would never leave
+        for pool in resource_cache.process_pools.values():
+            pool.shutdown()
+
+    return {'rows': row_count, 'bytes_written': get_directory_bytes(s3_root) - bytes_before}
+
+def run_load(s3_root):
+    import load_raw
+
+    clients = local_aws.install(s3_root)
+    bucket = os.getenv('AWS_S3_BUCKET_NAME')
+    objects = clients['s3'].list_objects_v2(Bucket=bucket, Prefix=os.getenv('AWS_S3_FOLDER_PATH') + '/')['Contents']
+    bytes_before = get_directory_bytes(s3_root)
+
+    event = {
+        'Records': [
+            {'eventSource': 'aws:s3', 's3': {'bucket': {'name': bucket}, 'object': {'key': s3_object['Key'], 'size': s3_object['Size']}}}
+            for s3_object in objects
+        ]
+    }
+
+    response = load_raw.lambda_handler(event, None)
+
+    if response.get('statusCode') != 200:
+        raise RuntimeError(f"load_raw failed: {response}")
+
+    statements = clients['redshift-data'].statements.values()
+
+    return {
+        'rows': sum(statement['ResultRows'] for statement in statements),
+        'bytes_read': sum(s3_object['Size'] for s3_object in objects),
+        'bytes_written': get_directory_bytes(s3_root) - bytes_before,
+    }
+
+def count_parquet_rows(path):
+    import pyarrow.parquet as pq
+
+    return sum(pq.ParquetFile(os.path.join(directory, file_name)).metadata.num_rows for directory, _, file_names in os.walk(path) for file_name in file_names if file_name.endswith('.parquet'))
+
+def run_transform(s3_root):
+    import transform_raw
+
+    local_aws.install(s3_root)
+    bytes_before = get_directory_bytes(s3_root)
+
+    transform_raw.run()
+
+    order_lines_path = os.path.join(s3_root, os.getenv('AWS_S3_BUCKET_NAME'), os.getenv('AWS_S3_TRANSFORMED_FOLDER_PATH') or 'transformed', 'order_lines')
+
+    return {'rows': count_parquet_rows(order_lines_path), 'bytes_written': get_directory_bytes(s3_root) - bytes_before}
+
+def run_curate(s3_root):
+    import curate_transformed
+
+    local_aws.install(s3_root)
+    bytes_before = get_directory_bytes(s3_root)
+
+    curate_transformed.run()
+
+    bucket, folder = curate_transformed.get_curated_location()
+    customers_path = os.path.join(s3_root, bucket, folder, curate_transformed.CUSTOMERS_TABLE)
+
+    return {'rows': count_parquet_rows(customers_path), 'bytes_written': get_directory_bytes(s3_root) - bytes_before}
+
+def run_child(connection, target, args):
+    try:
+        start_time = time.perf_counter()
+        result = target(*args)
+        seconds = time.perf_counter() - start_time
+
+        result.update({
+            'seconds': round(seconds, 3),
+            'rows_per_second': round(result['rows'] / seconds, 1) if seconds else None,
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        })
+
+        connection.send(result)
+    except Exception:
+        connection.send({'error': traceback.format_exc()})
+
+def run_stage(name, target, *args):
+    # Every stage runs in its own forked process so peak RSS belongs to that stage alone
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_child, args=(sender, target, args))
+
+    process.start()
+    result = receiver.recv()
+    process.join()
+
+    if 'error' in result:
+        raise RuntimeError(f"Stage {name} failed:\n{result['error']}")
+
+    print(f"{name}: {result['rows']} rows in {result['seconds']}s, "
+          f"{result['rows_per_second']} rows/s, peak RSS {result['peak_rss_mb']} MB, "
+          f"{result['bytes_written']} bytes written")
+
+    return result
+
+def compare_to_baseline(report, baseline, tolerance):
+    regressions = []
+
+    if baseline['rows'] != report['rows']:
+        print(f"Baseline was recorded with {baseline['rows']} rows, comparing rates anyway")
+
+    for name, stage in report['stages'].items():
+        previous = baseline['stages'].get(name)
+
+        if previous is None:
+            continue
+
+        throughput_change = stage['rows_per_second'] / previous['rows_per_second'] - 1
+        memory_change = stage['peak_rss_mb'] / previous['peak_rss_mb'] - 1
+
+        print(f"{name}: rows/s {throughput_change:+.1%}, peak RSS {memory_change:+.1%} against baseline")
+
+        if throughput_change < -tolerance or memory_change > tolerance:
+            regressions.append(name)
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Run ingest_sources, load_raw, transform_raw and curate_transformed end to end against synthetic data and local AWS stand-ins.')
+    parser.add_argument('--rows', type=int, default=200_000, help='line items to generate, options and date_dim rows come on top')
+    parser.add_argument('--chunk-size', type=int, default=250_000, help='line items generated per chunk')
+    parser.add_argument('--days', type=int, default=180)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backfill-ranges', type=int, help='ingest the empty watermarks as a backfill split into this many created_at ranges')
+    parser.add_argument('--workdir', help='keep the generated database and objects here instead of a temporary directory')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check', action='store_true', help='exit non-zero when a stage regresses past the tolerance')
+    parser.add_argument('--tolerance', type=float, default=0.15)
+    parser.add_argument('--output', help='write the report as JSON')
+    args = parser.parse_args()
+
+    configure_environment()
+
+    # Every table starts without a watermark here, so the whole ingest stage runs as the backfill
+    if args.backfill_ranges:
+        os.environ['BACKFILL_RANGES'] = str(args.backfill_ranges)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='pipeline-benchmark-')
+    db_path = os.path.join(workdir, 'source.db')
+    s3_root = os.path.join(workdir, 's3')
+
+    os.makedirs(workdir, exist_ok=True)
+    shutil.rmtree(s3_root, ignore_errors=True)
+
+    try:
+        stages = {
+            'generate': run_stage('generate', generate_source, db_path, args.rows, args.chunk_size, args.days, args.seed),
+            'ingest': run_stage('ingest', run_ingest, db_path, s3_root),
+            'load': run_stage('load', run_load, s3_root),
+            'transform': run_stage('transform', run_transform, s3_root),
+            'curate': run_stage('curate', run_curate, s3_root),
+        }
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    # Ranges split at shared bounds, a row read twice or skipped shows up as a load count off the source count
+    if stages['load']['rows'] != stages['ingest']['rows']:
+        print(f"Loaded {stages['load']['rows']} rows from {stages['ingest']['rows']} source rows")
+
+    report = {
+        'rows': args.rows,
+        'settings': {name: os.getenv(name) for name in ['INGEST_CHUNK_SIZE', 'INGEST_MAX_WORKERS', 'OUTPUT_FILE_FORMAT', 'CSV_COMPRESSION', 'PARQUET_COMPRESSION', 'S3_UPLOAD_MODE', 'S3_LAYOUT', 'CLEAN_DATA_ENGINE', 'CLEAN_DATA_WORKERS', 'INGEST_PUSHDOWN', 'BACKFILL_RANGES', 'BACKFILL_STRATEGY']},
+        'stages': stages,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+
+        with open(args.baseline, 'w') as file:
+            json.dump(report, file, indent=2)
+            file.write('\n')
+
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            regressions = compare_to_baseline(report, json.load(file), args.tolerance)
+
+        if regressions and args.check:
+            print(f"Regressed past {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
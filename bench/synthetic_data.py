@@ -0,0 +1,146 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+APP_NAMES = ['franchise-app', 'web', 'kiosk', 'pos']
+CURRENCIES = ['USD', 'CAD']
+
+# Menu items by category, popularity within the menu follows a Zipf curve
+MENU = {
+    'Burgers': ['Classic Burger', 'Cheeseburger', 'Bacon Burger', 'Veggie Burger', 'Double Stack'],
+    'Chicken': ['Chicken Sandwich', 'Nuggets 6pc', 'Nuggets 10pc', 'Spicy Wrap'],
+    'Sides': ['Fries', 'Onion Rings', 'Side Salad', 'Mac and Cheese'],
+    'Drinks': ['Cola', 'Lemonade', 'Iced Tea', 'Coffee', 'Milkshake'],
+    'Desserts': ['Brownie', 'Sundae', 'Apple Pie'],
+}
+
+OPTIONS = {
+    'Size': [('Small', 0.0), ('Medium', 0.5), ('Large', 1.0)],
+    'Extras': [('Extra cheese', 0.75), ('Bacon', 1.25), ('Avocado', 1.5)],
+    'Sauce': [('Ketchup', 0.0), ('BBQ', 0.0), ('Ranch', 0.25), ('Hot sauce', 0.0)],
+    'Milk': [('Whole', 0.0), ('Oat milk', 0.6), ('Almond milk', 0.6)],
+}
+
+HOLIDAYS = {(1, 1), (7, 4), (12, 25), (12, 31)}
+
+def zipf_weights(count, exponent):
+    weights = 1.0 / np.arange(1, count + 1) ** exponent
+
+    return weights / weights.sum()
+
+def check_columns(table_name, df, file_structures):
+    required_columns = file_structures[table_name]['required_columns']
+
+    if list(df.columns) != required_columns:
+        raise ValueError(f"Synthetic {table_name} columns {list(df.columns)} do not match FILE_STRUCTURES {required_columns}")
+
+    return df
+
+def make_date_dim(start_date, days, file_structures):
+    dates = pd.date_range(start_date, periods=days, freq='D')
+
+    df = pd.DataFrame({
+        'date_key': dates.strftime('%Y%m%d').astype(int),
+        'year': dates.year,
+        'month': dates.month,
+        'week': dates.isocalendar().week.to_numpy().astype(int),
+        'day_of_week': dates.dayofweek,
+        'is_weekend': dates.dayofweek >= 5,
+        'is_holiday': [(date.month, date.day) in HOLIDAYS for date in dates],
+        'created_at': dates,
+    })
+
+    return check_columns('date_dim', df, file_structures)
+
+class FranchiseGenerator:
+    def __init__(self, file_structures, restaurants=60, users=None, start_date=datetime.date(2025, 1, 1), days=180, seed=0):
+        self.file_structures = file_structures
+        self.restaurants = restaurants
+        self.users = users
+        self.start = np.datetime64(start_date, 's')
+        self.days = days
+        self.rng = np.random.default_rng(seed)
+        self.next_order_id = 1
+
+        self.items = np.array([(category, name) for category, names in MENU.items() for name in names], dtype=object)
+        self.item_prices = np.round(self.rng.uniform(1.5, 14.0, len(self.items)), 2)
+        self.item_weights = zipf_weights(len(self.items), 1.1)
+        self.restaurant_weights = zipf_weights(restaurants, 0.8)
+
+        self.options = np.array([(group, name, price) for group, choices in OPTIONS.items() for name, price in choices], dtype=object)
+        self.option_weights = zipf_weights(len(self.options), 0.9)
+
+    def make_chunk(self, line_item_count):
+        rng = self.rng
+
+        # Orders hold one or more line items, a few regulars place most of the orders
+        items_per_order = rng.geometric(0.55, line_item_count)
+        order_count = int(np.searchsorted(np.cumsum(items_per_order), line_item_count)) + 1
+        items_per_order = items_per_order[:order_count]
+        items_per_order[-1] -= items_per_order.sum() - line_item_count
+
+        order_ids = np.arange(self.next_order_id, self.next_order_id + order_count)
+        self.next_order_id += order_count
+
+        user_pool = self.users or max(line_item_count // 8, 10)
+        order_users = (rng.pareto(1.2, order_count) * user_pool / 20).astype(np.int64) % user_pool + 1
+        order_restaurants = rng.choice(self.restaurants, order_count, p=self.restaurant_weights) + 1
+        order_loyalty = order_users % 3 == 0
+        order_apps = rng.choice(len(APP_NAMES), order_count, p=[0.5, 0.2, 0.15, 0.15])
+
+        # Lunch and dinner peaks over the day
+        order_days = rng.integers(0, self.days, order_count)
+        order_hours = np.clip(np.where(rng.random(order_count) < 0.55, rng.normal(12.5, 1.2, order_count), rng.normal(18.5, 1.5, order_count)), 0, 23.99)
+        order_times = self.start + (order_days * 86400 + (order_hours * 3600).astype(np.int64)).astype('timedelta64[s]')
+
+        order_index = np.repeat(np.arange(order_count), items_per_order)
+        lineitem_ids = np.arange(line_item_count) - np.repeat(np.cumsum(items_per_order) - items_per_order, items_per_order) + 1
+        item_index = rng.choice(len(self.items), line_item_count, p=self.item_weights)
+        creation_times = order_times[order_index]
+
+        line_items = pd.DataFrame({
+            'app_name': np.asarray(APP_NAMES, dtype=object)[order_apps[order_index]],
+            'restaurant_id': order_restaurants[order_index],
+            'creation_time_utc': creation_times,
+            'order_id': order_ids[order_index],
+            'user_id': order_users[order_index],
+            'is_loyalty': order_loyalty[order_index],
+            'currency': np.where(order_restaurants[order_index] > self.restaurants * 0.9, CURRENCIES[1], CURRENCIES[0]).astype(object),
+            'lineitem_id': lineitem_ids,
+            'item_category': self.items[item_index, 0],
+            'item_name': self.items[item_index, 1],
+            'item_price': self.item_prices[item_index],
+            'item_quantity': rng.choice([1, 1, 1, 2, 2, 3, 4], line_item_count),
+            'created_at': creation_times + rng.integers(1, 900, line_item_count).astype('timedelta64[s]'),
+        })
+
+        # Most line items carry no options, some carry several
+        options_per_item = rng.poisson(0.8, line_item_count)
+        option_item_index = np.repeat(np.arange(line_item_count), options_per_item)
+        option_index = rng.choice(len(self.options), len(option_item_index), p=self.option_weights)
+
+        options = pd.DataFrame({
+            'order_id': line_items['order_id'].to_numpy()[option_item_index],
+            'lineitem_id': lineitem_ids[option_item_index],
+            'option_group_name': self.options[option_index, 0],
+            'option_name': self.options[option_index, 1],
+            'option_price': self.options[option_index, 2].astype(float),
+            'option_quantity': np.ones(len(option_item_index), dtype=np.int64),
+            'created_at': line_items['created_at'].to_numpy()[option_item_index],
+        })
+
+        # One line item can pick the same option twice, the source keys it per option
+        options = options.drop_duplicates(['order_id', 'lineitem_id', 'option_group_name', 'option_name'])
+
+        return check_columns('order_item_options', line_items, self.file_structures), check_columns('order_items', options, self.file_structures)
+
+    def iter_chunks(self, line_item_count, chunk_size=250_000):
+        # Generated chunk by chunk so 10M+ line items never sit in memory at once
+        remaining = line_item_count
+
+        while remaining > 0:
+            size = min(chunk_size, remaining)
+            remaining -= size
+
+            yield self.make_chunk(size)
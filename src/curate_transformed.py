@@ -1,194 +1,668 @@
 import datetime
+import io
 import json
+import math
 import os
-import time
+from concurrent.futures import ThreadPoolExecutor
 
-from aws_secretsmanager_caching import SecretCache, SecretCacheConfig
-import boto3
-from botocore.exceptions import ClientError
-import sqlalchemy as sa
- 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from botocore.exceptions import ClientError
+
+import metrics
+import resource_cache
+import s3_layout
+
+MODULE_NAME = 'curate_transformed'
+
+ORDER_LINES_TABLE = 'order_lines'
+CUSTOMERS_TABLE = 'customer_metrics'
+SALES_CUBE_TABLE = 'sales_cube'
+
+ORDER_LINE_COLUMNS = ['user_id', 'order_id', 'creation_time_utc', 'line_revenue', 'is_loyalty']
+
+STATE_COLUMNS = {
+    'user_id': 'object',
+    'first_order_at': 'datetime64[ns]',
+    'last_order_at': 'datetime64[ns]',
+    'last_order_id': 'object',
+    'order_count': 'int64',
+    'total_spend': 'float64',
+    'gap_count': 'int64',
+    'gap_mean': 'float64',
+    'gap_m2': 'float64',
+    'period': 'int64',
+    'period_spend': 'float64',
+    'previous_period_spend': 'float64',
+    'is_loyalty': 'bool',
+}
+
+# Dimensions of every sales cube cell, the time grain comes on top
+CUBE_DIMENSIONS = ['restaurant_id', 'item_category', 'is_loyalty']
+CUBE_COLUMNS = ['order_id', 'item_category', 'is_loyalty', 'line_revenue', 'item_quantity', 'restaurant_id']
+
+# Additive measures, averages are derived from them at every grain instead of being summed
+CUBE_MEASURES = ['revenue', 'order_count', 'line_count', 'item_quantity']
 
-# Constants
-AWS_RDS_DATA = 'rds-data'
-AWS_S3 = 's3'
-AWS_SECRETS_MANAGER = 'secretsmanager'
-AWS_DYNAMODB = 'dynamodb'
-
-# Environment Variables (Configured in Lambda)
-ENVIRONMENT = os.getenv('ENVIRONMENT')
-AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
-AWS_SECRET_ACCESS_KEY= os.getenv('AWS_SECRET_ACCESS_KEY')
-AWS_DB_HOST = os.getenv('AWS_DB_HOST')
-AWS_DB_CREDENTIALS = os.getenv('AWS_DB_CREDENTIALS')
-AWS_S3_BUCKET_NAME = os.getenv('AWS_S3_BUCKET_NAME')
-AWS_DYNAMODB_TABLE_NAME = os.getenv('AWS_DYNAMODB_TABLE_NAME')
-AWS_S3_FOLDER_PATH = os.getenv('AWS_S3_FOLDER_PATH')
-AWS_REGION_NAME = os.getenv('AWS_REGION_NAME')
-AWS_DB_NAME = os.getenv('AWS_DB_NAME') 
-
-# Generate Timestamp for File Naming
-timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+# Ids the transform could not resolve, they never belong to a customer
+MISSING_IDS = ['', '-1', 'nan', 'None', '<NA>']
+
+# Rank sketched per bucket, the quantiles behind CLV tiers and RFM scores come from merging these
+SKETCHED_COLUMNS = ['total_spend', 'order_count']
 
 def get_service_client(service_name):
-    session = boto3.session.Session()    
-        
-    if ENVIRONMENT == 'development':
-        client = session.client(
-            service_name=service_name,
-            region_name=AWS_REGION_NAME,
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY
-        )
-    else:
-        client = session.client(
-            service_name=service_name,
-            region_name=AWS_REGION_NAME
-        )
-    
-    return client
-
-def get_secret(secret_name):
-    try:
-        client = get_service_client(AWS_SECRETS_MANAGER)
-        cache_config = SecretCacheConfig()
-        cache = SecretCache(config=cache_config, client=client)
-        secret = cache.get_secret_string(secret_id=secret_name)
-        get_secret_value_response = client.get_secret_value(SecretId=secret_name)
-    except ClientError as e:
-        # For a list of exceptions thrown, see
-        # https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
-        print(f'Could not connect to client: {e}')
-        raise e
-    except Exception as e:
-        print(f'An unexpected error occurred: {e}')
-        raise e 
-    
-    secret = get_secret_value_response['SecretString']
+    # Clients are cached across warm invocations
+    return resource_cache.get_client(service_name)
 
-    return secret
+def get_transformed_location():
+    bucket = os.getenv('AWS_S3_TRANSFORMED_BUCKET_NAME') or os.getenv('AWS_S3_BUCKET_NAME')
 
-def get_secret_dict(secret_name):
-    try:
-        secret = get_secret(secret_name)
-        return json.loads(secret)  # Convert JSON string to dictionary
-    except Exception as e:
-        print(f"Error retrieving secret {secret_name}: {e}")
-        raise e
+    return bucket, os.getenv('AWS_S3_TRANSFORMED_FOLDER_PATH') or 'transformed'
 
-def get_last_processed_date(table_name, client):
-    print(f"Retrieving last processed date for table: {table_name}")
-    
+def get_curated_location():
+    bucket = os.getenv('AWS_S3_CURATED_BUCKET_NAME') or os.getenv('AWS_S3_TRANSFORMED_BUCKET_NAME') or os.getenv('AWS_S3_BUCKET_NAME')
+
+    return bucket, os.getenv('AWS_S3_CURATED_FOLDER_PATH') or 'curated'
+
+def get_watermark_name(table_name):
+    return f"{MODULE_NAME}:{table_name}"
+
+def get_last_processed_key(table_name, client):
     response = client.get_item(
-        TableName=AWS_DYNAMODB_TABLE_NAME,
+        TableName=os.getenv('AWS_DYNAMODB_TABLE_NAME'),
         ConsistentRead=True,
-        ProjectionExpression='processed_date',
-        Key={'table_name': {'S': table_name}}
+        Key={'table_name': {'S': get_watermark_name(table_name)}}
     )
 
-    if 'Item' not in response:
-        print(f"No processing date found for table: {table_name}")
+    if 'Item' not in response or 'processed_key' not in response['Item']:
+        print(f"No processed transform run recorded for table: {table_name}")
+        return ''
+
+    return response['Item']['processed_key']['S']
+
+def mark_last_processed_key(table_name, key, client):
+    client.put_item(
+        TableName=os.getenv('AWS_DYNAMODB_TABLE_NAME'),
+        Item={'table_name': {'S': get_watermark_name(table_name)}, 'processed_key': {'S': key}}
+    )
+
+def read_object(s3_client, bucket, key):
+    try:
+        return s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+            raise e
+
+        return None
+
+def list_runs(s3_client, start_after=''):
+    bucket, folder = get_transformed_location()
+    prefix = f"{folder}/_runs/"
+    keys = []
+
+    request = {'Bucket': bucket, 'Prefix': prefix, 'StartAfter': max(start_after, prefix)}
+
+    while True:
+        response = s3_client.list_objects_v2(**request)
+        keys.extend(s3_object['Key'] for s3_object in response.get('Contents', []))
+
+        if not response.get('IsTruncated'):
+            break
+
+        request['ContinuationToken'] = response['NextContinuationToken']
+
+    return keys
+
+def list_new_runs(s3_client, start_after):
+    # transform_raw writes one manifest per run, so only the runs since the last curation are listed
+    keys = list_runs(s3_client, start_after)
+
+    print(f"Found {len(keys)} new transform runs")
+
+    return keys
+
+def list_committed_run_ids(s3_client):
+    # A transform run is committed once its manifest landed, part files of a run that died before it are never counted
+    return {os.path.basename(key)[:-len('.json')] for key in list_runs(s3_client)}
+
+def get_part_run_id(key):
+    # transform_raw names day objects part-{run_id}-{flush}.parquet
+    return os.path.basename(key)[len('part-'):].rsplit('-', 1)[0]
+
+def read_run_partitions(s3_client, run_keys):
+    bucket, _ = get_transformed_location()
+
+    return [key for run_key in run_keys for key in json.loads(read_object(s3_client, bucket, run_key))['order_lines']]
+
+def read_order_lines(s3_client, key):
+    bucket, _ = get_transformed_location()
+    table = pq.read_table(io.BytesIO(read_object(s3_client, bucket, key)), columns=ORDER_LINE_COLUMNS)
+
+    return table.set_column(0, 'user_id', table['user_id'].cast(pa.string())).set_column(1, 'order_id', table['order_id'].cast(pa.string()))
+
+def aggregate_orders(tables, names=('creation_time_utc', 'line_revenue', 'is_loyalty')):
+    table = pa.concat_tables(tables)
+    table = table.filter(pc.invert(pc.is_in(table['user_id'], value_set=pa.array(MISSING_IDS))))
+
+    # Line items collapse to one row per order in Arrow once per batch of day objects
+    aggregated = table.group_by(['user_id', 'order_id']).aggregate([(names[0], 'min'), (names[1], 'sum'), (names[2], 'max')])
+    aggregated = aggregated.select(['user_id', 'order_id', f'{names[0]}_min', f'{names[1]}_sum', f'{names[2]}_max'])
+
+    return aggregated.rename_columns(['user_id', 'order_id', 'order_at', 'revenue', 'is_loyalty'])
+
+def read_orders(s3_client, keys, batch_rows, recorder):
+    max_workers = int(os.getenv('CURATE_MAX_WORKERS') or 8)
+    batch = []
+    batch_size = 0
+    orders = []
+
+    # Day objects are read side by side and come back in key order
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for table in recorder.time_iter('read', executor.map(lambda key: read_order_lines(s3_client, key), keys)):
+            batch.append(table)
+            batch_size += table.num_rows
+
+            if batch_size >= batch_rows:
+                orders.append(aggregate_orders(batch))
+                batch, batch_size = [], 0
+
+    if batch:
+        orders.append(aggregate_orders(batch))
+
+    if not orders:
         return None
+
+    # Line items of one order can land in different partitions, batches or runs
+    orders = aggregate_orders(orders, names=('order_at', 'revenue', 'is_loyalty')).to_pandas()
+
+    return orders.dropna(subset=['order_at'])
+
+def get_bucket_count():
+    return int(os.getenv('CURATE_STATE_BUCKETS') or 64)
+
+def assign_buckets(user_ids, bucket_count):
+    # hash_pandas_object uses a fixed key, a user lands in the same bucket on every run
+    return (pd.util.hash_pandas_object(user_ids, index=False).to_numpy() % np.uint64(bucket_count)).astype(np.int64)
+
+class QuantileSketch:
+    # Log-bucketed counts (DDSketch), quantiles are within relative_accuracy of the true value and
+    # sketches from any number of buckets merge by adding counts
+    def __init__(self, relative_accuracy=0.01, counts=None, zero_count=0):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.counts = counts or {}
+        self.zero_count = zero_count
+
+    @property
+    def count(self):
+        return self.zero_count + sum(self.counts.values())
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        positive = values[values > 0]
+
+        self.zero_count += len(values) - len(positive)
+
+        indexes, counts = np.unique(np.ceil(np.log(positive) / math.log(self.gamma)).astype(np.int64), return_counts=True)
+
+        for index, count in zip(indexes.tolist(), counts.tolist()):
+            self.counts[index] = self.counts.get(index, 0) + count
+
+        return self
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+
+        self.zero_count += other.zero_count
+
+        return self
+
+    def quantile(self, q):
+        total = self.count
+
+        if not total:
+            return float('nan')
+
+        rank = q * (total - 1)
+
+        if rank < self.zero_count:
+            return 0.0
+
+        seen = self.zero_count
+
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+
+            if seen > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+
+        return 2 * self.gamma ** max(self.counts) / (self.gamma + 1)
+
+    def to_dict(self):
+        return {'relative_accuracy': self.relative_accuracy, 'zero_count': self.zero_count, 'counts': [[index, count] for index, count in sorted(self.counts.items())]}
+
+    @classmethod
+    def from_dict(cls, value):
+        return cls(value['relative_accuracy'], {index: count for index, count in value['counts']}, value['zero_count'])
+
+def get_state_key(bucket_index):
+    _, folder = get_curated_location()
+
+    return f"{folder}/_state/customers/bucket-{bucket_index:04d}.parquet"
+
+def get_sketch_index_key():
+    _, folder = get_curated_location()
+
+    return f"{folder}/_state/customers/sketches.json"
+
+def create_empty_state():
+    return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in STATE_COLUMNS.items()})
+
+def load_state(s3_client, bucket_index):
+    bucket, _ = get_curated_location()
+    body = read_object(s3_client, bucket, get_state_key(bucket_index))
+
+    if body is None:
+        return create_empty_state(), ''
+
+    table = pq.read_table(io.BytesIO(body))
+    applied_through = (table.schema.metadata or {}).get(b'applied_through', b'').decode('utf-8')
+
+    return table.to_pandas(), applied_through
+
+def save_state(s3_client, bucket_index, state, applied_through):
+    bucket, _ = get_curated_location()
+    table = pa.Table.from_pandas(state, preserve_index=False)
+
+    # The last run folded into this bucket travels with it, a retried run skips buckets it already updated
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'applied_through': applied_through.encode('utf-8')})
+
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression='snappy', coerce_timestamps='us', allow_truncated_timestamps=True)
+    s3_client.put_object(Bucket=bucket, Key=get_state_key(bucket_index), Body=buffer.getvalue())
+
+    return buffer.tell()
+
+def load_sketch_index(s3_client):
+    bucket, _ = get_curated_location()
+    body = read_object(s3_client, bucket, get_sketch_index_key())
+
+    return json.loads(body) if body else {}
+
+def save_sketch_index(s3_client, sketch_index):
+    bucket, _ = get_curated_location()
+
+    s3_client.put_object(Bucket=bucket, Key=get_sketch_index_key(), Body=json.dumps(sketch_index).encode('utf-8'))
+
+def sketch_state(state):
+    return {column: QuantileSketch().add(state[column].to_numpy(dtype=np.float64)).to_dict() for column in SKETCHED_COLUMNS}
+
+def get_period(order_at, period_days):
+    return (order_at.to_numpy(dtype='datetime64[D]').astype(np.int64) // period_days).astype(np.int64)
+
+def combine_gap_statistics(state, gaps):
+    # Chan's parallel form of Welford's update, the batch of new gaps merges into the running count, mean and M2
+    by_user = gaps.groupby('user_id', sort=False)['gap']
+    batch = pd.DataFrame({'count': by_user.count(), 'mean': by_user.mean(), 'm2': by_user.var(ddof=0) * by_user.count()})
+    batch = batch.reindex(state.index, fill_value=0)
+
+    count_a = state['gap_count'].to_numpy(dtype=np.float64)
+    count_b = batch['count'].to_numpy(dtype=np.float64)
+    count = count_a + count_b
+    share_b = count_b / np.maximum(count, 1)
+    delta = batch['mean'].to_numpy() - state['gap_mean'].to_numpy()
+
+    state['gap_count'] = count.astype(np.int64)
+    state['gap_mean'] = state['gap_mean'].to_numpy() + delta * share_b
+    state['gap_m2'] = state['gap_m2'].to_numpy() + batch['m2'].to_numpy() + delta ** 2 * count_a * share_b
+
+    return state
+
+def combine_period_spend(state, orders, period_days):
+    # Spend per (user, period) from the state's two latest periods and the new orders, then the latest two are kept
+    spend = pd.concat([
+        pd.DataFrame({'user_id': state.index, 'period': state['period'].to_numpy(), 'spend': state['period_spend'].to_numpy()}),
+        pd.DataFrame({'user_id': state.index, 'period': state['period'].to_numpy() - 1, 'spend': state['previous_period_spend'].to_numpy()}),
+        pd.DataFrame({'user_id': orders['user_id'].to_numpy(), 'period': get_period(orders['order_at'], period_days), 'spend': orders['revenue'].to_numpy()}),
+    ], ignore_index=True)
+
+    spend = spend.groupby(['user_id', 'period'], sort=False)['spend'].sum().reset_index()
+    latest = spend.groupby('user_id')['period'].max()
+    spend['latest'] = spend['user_id'].map(latest)
+
+    current = spend[spend['period'] == spend['latest']].set_index('user_id')['spend']
+    previous = spend[spend['period'] == spend['latest'] - 1].set_index('user_id')['spend']
+
+    state['period'] = latest.reindex(state.index).to_numpy()
+    state['period_spend'] = current.reindex(state.index).fillna(0).to_numpy()
+    state['previous_period_spend'] = previous.reindex(state.index).fillna(0).to_numpy()
+
+    return state
+
+def merge_orders(state, orders, period_days):
+    state = state.set_index('user_id')
+
+    # An order split across runs continues the user's last order, it adds spend but not another order or gap
+    last_order_ids = orders['user_id'].map(state['last_order_id'])
+    continued = (orders['order_id'] == last_order_ids).to_numpy()
+    new_orders = orders[~continued]
+
+    users = state.index.union(pd.Index(orders['user_id'].unique()))
+    state = state.reindex(users)
+
+    known = state['order_count'].notna().to_numpy()
+    state = state.fillna({'order_count': 0, 'total_spend': 0.0, 'gap_count': 0, 'gap_mean': 0.0, 'gap_m2': 0.0, 'period_spend': 0.0, 'previous_period_spend': 0.0})
+
+    # Gaps between consecutive orders, the first new order of a known user follows their last stored order.
+    # A late order older than the stored last order only contributes the gap to that order.
+    timeline = new_orders[['user_id', 'order_at']]
+
+    if known.any():
+        timeline = pd.concat([pd.DataFrame({'user_id': state.index[known], 'order_at': state['last_order_at'].to_numpy()[known]}), timeline], ignore_index=True)
+
+    timeline = timeline.sort_values(['user_id', 'order_at'], kind='stable')
+
+    timeline['gap'] = timeline.groupby('user_id', sort=False)['order_at'].diff() / pd.Timedelta(days=1)
+    state = combine_gap_statistics(state, timeline.dropna(subset=['gap']))
+
+    by_user = new_orders.sort_values('order_at', kind='stable').groupby('user_id', sort=False)
+    batch = by_user.agg(
+        count=('order_id', 'size'),
+        first=('order_at', 'min'),
+        last=('order_at', 'max'),
+        last_order_id=('order_id', 'last'),
+        is_loyalty=('is_loyalty', 'last'),
+    ).reindex(state.index)
+
+    spend = orders.groupby('user_id', sort=False)['revenue'].sum().reindex(state.index).fillna(0)
+    is_newer = (batch['last'] > state['last_order_at']) | state['last_order_at'].isna()
+
+    state['order_count'] = (state['order_count'] + batch['count'].fillna(0)).astype(np.int64)
+    state['total_spend'] = (state['total_spend'] + spend).astype(np.float64)
+    state['first_order_at'] = state['first_order_at'].where(batch['first'].isna() | (state['first_order_at'] <= batch['first']), batch['first'])
+    state['last_order_id'] = state['last_order_id'].where(~is_newer, batch['last_order_id'])
+    # The reindexed batch holds NaN for users without new orders, np.where never reads those and skips the object downcast
+    state['is_loyalty'] = np.where(is_newer, batch['is_loyalty'], state['is_loyalty']).astype(bool)
+    state['last_order_at'] = state['last_order_at'].where(~is_newer, batch['last'])
+
+    state = combine_period_spend(state, orders, period_days)
+
+    return state.rename_axis('user_id').reset_index().astype(STATE_COLUMNS)
+
+def get_as_of_date():
+    # Backfills and tests pin the date metrics are measured from
+    value = os.getenv('CURATE_AS_OF_DATE')
+
+    return pd.Timestamp(value) if value else pd.Timestamp(datetime.datetime.now(datetime.timezone.utc).date())
+
+def get_thresholds(sketch_index):
+    sketches = {column: QuantileSketch() for column in SKETCHED_COLUMNS}
+
+    for bucket_sketches in sketch_index.values():
+        for column in SKETCHED_COLUMNS:
+            sketches[column].merge(QuantileSketch.from_dict(bucket_sketches[column]))
+
+    # README tiers: top 20% high CLV, middle 60% medium, bottom 20% low; F and M scores split at the median
+    return {
+        'clv_high': sketches['total_spend'].quantile(0.8),
+        'clv_low': sketches['total_spend'].quantile(0.2),
+        'monetary_high': sketches['total_spend'].quantile(0.5),
+        'frequency_high': sketches['order_count'].quantile(0.5),
+    }
+
+def build_customer_metrics(state, thresholds, as_of_date, period_days, at_risk_days):
+    days_since_last_order = ((as_of_date - state['last_order_at']) / pd.Timedelta(days=1)).to_numpy()
+
+    # Periods the user has not ordered in since their last order carry no spend
+    as_of_period = int(as_of_date.to_datetime64().astype('datetime64[D]').astype(np.int64) // period_days)
+    period = state['period'].to_numpy()
+    current_spend = np.where(period == as_of_period, state['period_spend'].to_numpy(), 0.0)
+    previous_spend = np.select([period == as_of_period, period == as_of_period - 1], [state['previous_period_spend'].to_numpy(), state['period_spend'].to_numpy()], 0.0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        spend_change = np.where(previous_spend > 0, (current_spend - previous_spend) / previous_spend * 100, np.nan)
+        gap_std = np.sqrt(np.where(state['gap_count'] > 1, state['gap_m2'] / (state['gap_count'] - 1), np.nan))
+
+    total_spend = state['total_spend'].to_numpy()
+    order_count = state['order_count'].to_numpy()
+
+    # Consecutive gaps telescope, so the average is exact even when orders arrived out of order
+    average_gap = np.where(order_count > 1, ((state['last_order_at'] - state['first_order_at']) / pd.Timedelta(days=1)).to_numpy() / np.maximum(order_count - 1, 1), np.nan)
+
+    recent = days_since_last_order <= at_risk_days
+    frequent = order_count >= thresholds['frequency_high']
+    spends = total_spend >= thresholds['monetary_high']
+
+    return pd.DataFrame({
+        'user_id': state['user_id'],
+        'is_loyalty': state['is_loyalty'],
+        'first_order_at': state['first_order_at'],
+        'last_order_at': state['last_order_at'],
+        'order_count': order_count,
+        'total_spend': total_spend,
+        'average_order_value': total_spend / np.maximum(order_count, 1),
+        'days_since_last_order': days_since_last_order,
+        'average_gap_days': average_gap,
+        'gap_std_days': gap_std,
+        'current_period_spend': current_spend,
+        'previous_period_spend': previous_spend,
+        'spend_change_pct': spend_change,
+        'is_at_risk': ~recent,
+        'clv_tier': np.select([total_spend >= thresholds['clv_high'], total_spend < thresholds['clv_low']], ['High', 'Low'], 'Medium'),
+        'rfm_segment': np.select([recent & frequent & spends, recent & ~frequent, ~recent & ~frequent], ['VIP', 'New Customer', 'Churn Risk'], 'Regular'),
+        'as_of_date': as_of_date,
+    })
+
+def write_customer_metrics(s3_client, bucket_index, customers):
+    bucket, folder = get_curated_location()
+    key = f"{folder}/{CUSTOMERS_TABLE}/part-{bucket_index:04d}.parquet"
+
+    buffer = io.BytesIO()
+    pq.write_table(pa.Table.from_pandas(customers, preserve_index=False), buffer, compression='snappy', coerce_timestamps='us', allow_truncated_timestamps=True)
+    s3_client.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
+
+    return buffer.tell()
+
+def update_customer_state(s3_client, keys, applied_through, recorder):
+    bucket_count = get_bucket_count()
+    period_days = int(os.getenv('CURATE_PERIOD_DAYS') or 30)
+    batch_rows = int(os.getenv('CURATE_BATCH_ROWS') or 1_000_000)
+
+    orders = read_orders(s3_client, keys, batch_rows, recorder)
+    sketch_index = load_sketch_index(s3_client)
+
+    if orders is None or orders.empty:
+        return sketch_index
+
+    orders['bucket'] = assign_buckets(orders['user_id'], bucket_count)
+
+    # Only buckets holding a user from the new orders are read and rewritten
+    for bucket_index, bucket_orders in orders.groupby('bucket', sort=True):
+        with recorder.time('merge') as counts:
+            state, state_applied_through = load_state(s3_client, bucket_index)
+
+            if state_applied_through < applied_through:
+                state = merge_orders(state, bucket_orders, period_days)
+                counts['bytes'] = save_state(s3_client, bucket_index, state, applied_through)
+
+            sketch_index[str(bucket_index)] = sketch_state(state)
+            counts['rows'] = len(bucket_orders)
+
+    save_sketch_index(s3_client, sketch_index)
+
+    return sketch_index
+
+def publish_customer_metrics(s3_client, sketch_index, recorder):
+    thresholds = get_thresholds(sketch_index)
+    as_of_date = get_as_of_date()
+    period_days = int(os.getenv('CURATE_PERIOD_DAYS') or 30)
+    at_risk_days = int(os.getenv('CURATE_AT_RISK_DAYS') or 45)
+
+    print(f"Customer thresholds as of {as_of_date.date()}: {thresholds}")
+
+    # Recency moves for every customer each day, the mart is rebuilt from the compact state and never from order history
+    for bucket_key in sorted(sketch_index, key=int):
+        with recorder.time('publish') as counts:
+            state, _ = load_state(s3_client, int(bucket_key))
+            customers = build_customer_metrics(state, thresholds, as_of_date, period_days, at_risk_days)
+            counts['bytes'] = write_customer_metrics(s3_client, int(bucket_key), customers)
+            counts['rows'] = len(customers)
+
+def curate_customers(s3_client, keys, applied_through):
+    recorder = metrics.get_recorder(MODULE_NAME, CUSTOMERS_TABLE)
+
+    if keys:
+        sketch_index = update_customer_state(s3_client, keys, applied_through, recorder)
     else:
-        processing_date = response['Item']['processed_date']['S']
+        print("No new order lines for customers, refreshing recency only")
+        sketch_index = load_sketch_index(s3_client)
 
-        print(processing_date)
+    if sketch_index:
+        publish_customer_metrics(s3_client, sketch_index, recorder)
 
-        return processing_date
+def get_cube_key(grain, period_start):
+    _, folder = get_curated_location()
 
-def mark_last_processed_date(table_name, timestamp, client):
-    client.put_item(
-        TableName=AWS_DYNAMODB_TABLE_NAME,
-        Item={'table_name': {'S': table_name}, 'processed_date': {'S': timestamp}}
-    )
+    return f"{folder}/{SALES_CUBE_TABLE}/grain={grain}/period_start={period_start}/part-0.parquet"
 
-def create_query(table_name, client):
-    latest_processed_date = get_last_processed_date(table_name, client)
+def list_day_partitions(s3_client, order_date, committed_run_ids):
+    bucket, folder = get_transformed_location()
+    request = {'Bucket': bucket, 'Prefix': f"{folder}/{ORDER_LINES_TABLE}/order_date={order_date}/"}
+    keys = []
 
-    # Query to fetch data from the source table
-    if latest_processed_date:
-        query = f"SELECT * FROM {table_name} WHERE created_at > '{latest_processed_date}'::timestamp ORDER BY created_at DESC;"
-    else:           
-        query = f"SELECT * FROM {table_name} ORDER BY created_at DESC;"
+    while True:
+        response = s3_client.list_objects_v2(**request)
+        keys.extend(s3_object['Key'] for s3_object in response.get('Contents', []) if s3_object['Key'].endswith('.parquet'))
 
-    print(f"Query for {table_name}: {query}")
+        if not response.get('IsTruncated'):
+            break
 
-    return query
+        request['ContinuationToken'] = response['NextContinuationToken']
 
-def get_db_connection(secret):
-    username = secret['username']
-    password = secret['password']
-    host = AWS_DB_HOST  
-    db = AWS_DB_NAME
+    committed = [key for key in keys if get_part_run_id(key) in committed_run_ids]
 
-    engine = sa.create_engine(f'postgresql+psycopg2://{username}:{password}@{host}/{db}')
+    if len(committed) < len(keys):
+        print(f"Skipping {len(keys) - len(committed)} order line objects of uncommitted transform runs for {order_date}")
 
-    return engine.connect()
+    return committed
 
-def upload_to_s3(conn):
-    source_tables = [
-        'order_items',
-        'order_item_options',
-        'date_dim',
-    ]
+def read_cube_lines(s3_client, key):
+    bucket, _ = get_transformed_location()
+    table = pq.read_table(io.BytesIO(read_object(s3_client, bucket, key)), columns=CUBE_COLUMNS)
 
-    dynamo_db_client = get_service_client(AWS_DYNAMODB)
+    return table.set_column(1, 'item_category', table['item_category'].cast(pa.string())).set_column(5, 'restaurant_id', table['restaurant_id'].cast(pa.string()))
 
-    for table_name in source_tables:
-        print(f"Processing table: {table_name}")    
+def build_day_cells(s3_client, order_date, committed_run_ids):
+    max_workers = int(os.getenv('CURATE_MAX_WORKERS') or 8)
 
-        query = create_query(table_name, dynamo_db_client)        
-        print(f"Executing query: {query}")
-        
-        rows = conn.execute(query)
+    # A touched day is rebuilt from the objects of every committed run, so late data and retried runs never double count
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tables = list(executor.map(lambda key: read_cube_lines(s3_client, key), list_day_partitions(s3_client, order_date, committed_run_ids)))
 
-        df = pd.DataFrame(data=rows)
+    table = pa.concat_tables(tables)
+    cells = table.group_by(CUBE_DIMENSIONS).aggregate([
+        ('line_revenue', 'sum'),
+        ('order_id', 'count_distinct'),
+        ('order_id', 'count'),
+        ('item_quantity', 'sum'),
+    ])
 
-        if df.empty:
-            print(f"No new data found for table: {table_name}")
-            continue
-        
-        last_processed_date = pd.to_datetime(df['created_at'].max()) if not df.empty else None
-        last_processed_date = str(last_processed_date) if last_processed_date else None
-        print(f"Last processed date for {table_name}: {last_processed_date}")
+    cells = cells.select([*CUBE_DIMENSIONS, 'line_revenue_sum', 'order_id_count_distinct', 'order_id_count', 'item_quantity_sum'])
 
-        # Save DataFrame to CSV
-        file_name = f"{table_name}_{timestamp}.csv"
-        file_path = f"./{file_name}"
-        df.to_csv(file_path, index=False)
+    return cells.rename_columns([*CUBE_DIMENSIONS, *CUBE_MEASURES]).to_pandas(), table.num_rows
 
-        print(f"Data for {table_name} saved to {file_path}")
+def write_cube_cells(s3_client, grain, period_start, cells):
+    bucket, _ = get_curated_location()
 
-        # Upload to S3
-        s3_client = get_service_client(AWS_S3)
-        file_name = f"{table_name}_{timestamp}.json"
-        
-        repsonse = s3_client.upload_file(file_path, AWS_S3_BUCKET_NAME, AWS_S3_FOLDER_PATH + '/' + file_name)
-        
-        print(f"Uploaded {table_name} data to S3 at {file_name}")
-        print(repsonse)
+    cells = cells.sort_values(CUBE_DIMENSIONS, kind='stable').reset_index(drop=True)
+    cells['revenue'] = cells['revenue'].astype('float64')
+    cells['item_quantity'] = cells['item_quantity'].astype('int64')
+    cells['average_order_value'] = cells['revenue'] / cells['order_count'].where(cells['order_count'] > 0)
 
-        mark_last_processed_date(table_name, last_processed_date, dynamo_db_client)
+    buffer = io.BytesIO()
+    pq.write_table(pa.Table.from_pandas(cells, preserve_index=False), buffer, compression='snappy')
+    s3_client.put_object(Bucket=bucket, Key=get_cube_key(grain, period_start), Body=buffer.getvalue())
 
-def ingest_sources():
-    try:
-        secret = get_secret(AWS_DB_CREDENTIALS)
-        secret = json.loads(secret)  # Convert JSON string to dictionary
+    return buffer.tell()
 
-        conn = get_db_connection(secret)
-        
-        upload_to_s3(conn)
+def read_cube_cells(s3_client, grain, period_start):
+    bucket, _ = get_curated_location()
+    body = read_object(s3_client, bucket, get_cube_key(grain, period_start))
 
-    except Exception as e:
-        print(f"Error in handler: {e}")
-        raise e
+    return None if body is None else pd.read_parquet(io.BytesIO(body), columns=[*CUBE_DIMENSIONS, *CUBE_MEASURES])
+
+def roll_up_cells(s3_client, days):
+    # An order belongs to exactly one day, so order counts stay additive across days
+    frames = [cells for cells in (read_cube_cells(s3_client, 'day', day.strftime('%Y-%m-%d')) for day in days) if cells is not None]
+
+    if not frames:
+        return None
+
+    return pd.concat(frames, ignore_index=True).groupby(CUBE_DIMENSIONS, sort=False, as_index=False)[CUBE_MEASURES].sum()
+
+def curate_sales_cube(s3_client, keys):
+    recorder = metrics.get_recorder(MODULE_NAME, SALES_CUBE_TABLE)
+    touched_days = sorted({s3_layout.parse_partition_values(key)['order_date'] for key in keys} - {'unknown'})
+
+    if not touched_days:
+        print("No new order lines for the sales cube")
+        return
+
+    committed_run_ids = list_committed_run_ids(s3_client)
+
+    for order_date in touched_days:
+        with recorder.time('day') as counts:
+            cells, counts['rows'] = build_day_cells(s3_client, order_date, committed_run_ids)
+            counts['bytes'] = write_cube_cells(s3_client, 'day', order_date, cells)
+
+    days = pd.DatetimeIndex(touched_days)
+
+    # Weeks start on Monday, weekly and monthly cells are sums of the daily cells, order lines are not read again
+    periods = {
+        'week': sorted(set(days - pd.to_timedelta(days.dayofweek, unit='D'))),
+        'month': sorted(set(days.to_period('M').to_timestamp())),
+    }
+
+    for grain, starts in periods.items():
+        for start in starts:
+            end = start + (pd.Timedelta(days=7) if grain == 'week' else pd.offsets.MonthBegin(1))
 
-# Start script timer        
-start_time = time.time()
+            with recorder.time(grain) as counts:
+                cells = roll_up_cells(s3_client, pd.date_range(start, end - pd.Timedelta(days=1), freq='D'))
+                counts['rows'] = len(cells)
+                counts['bytes'] = write_cube_cells(s3_client, grain, start.strftime('%Y-%m-%d'), cells)
 
-# Transfer raw data from source to S3
-ingest_sources()
+    print(f"Updated sales cube for {len(touched_days)} days, {len(periods['week'])} weeks and {len(periods['month'])} months")
+
+def curate(s3_client, dynamo_db_client):
+    run_keys = list_new_runs(s3_client, get_last_processed_key(ORDER_LINES_TABLE, dynamo_db_client))
+    keys = read_run_partitions(s3_client, run_keys)
+
+    curate_customers(s3_client, keys, run_keys[-1] if run_keys else '')
+    curate_sales_cube(s3_client, keys)
+
+    # The watermark moves once the customer state, the mart and every touched cube period are written
+    if run_keys:
+        mark_last_processed_key(ORDER_LINES_TABLE, run_keys[-1], dynamo_db_client)
+
+@metrics.profiled(MODULE_NAME)
+def run():
+    try:
+        s3_client = get_service_client(os.getenv('AWS_S3'))
+        dynamo_db_client = get_service_client(os.getenv('AWS_DYNAMODB'))
+
+        with metrics.get_recorder(MODULE_NAME, 'all').time('run'):
+            curate(s3_client, dynamo_db_client)
+    except Exception as e:
+        print(f"Error in curation: {e}")
+        raise e
+    finally:
+        metrics.flush()
 
-# Print script execution time
-print("--- %s minutes ---" % str((time.time() - start_time)/60))
\ No newline at end of file
+if __name__ == '__main__':
+    run()
@@ -1,43 +1,74 @@
 import datetime
+import gzip
+import io
+import itertools
 import json
 import os
 import re
+import threading
 import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
 
-import pandas as pd
-import numpy as np
+import lazy_imports
+import metrics
+import resource_cache
+import s3_layout
+import table_registry
 
-from aws_secretsmanager_caching import SecretCache, SecretCacheConfig
-import boto3
-from botocore.exceptions import ClientError
-import sqlalchemy as sa
+# Imported on first use, a cold start that writes CSV never loads pyarrow
+pd = lazy_imports.lazy_import('pandas')
+np = lazy_imports.lazy_import('numpy')
+pa = lazy_imports.lazy_import('pyarrow')
+pq = lazy_imports.lazy_import('pyarrow.parquet')
+sa = lazy_imports.lazy_import('sqlalchemy')
+botocore_exceptions = lazy_imports.lazy_import('botocore.exceptions')
 
-print("NumPy location:", os.__file__)
+MODULE_NAME = 'ingest_sources'
 
-# Generate Timestamp for File Naming
-timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+# Per-thread state for concurrent ingestion workers
+worker_state = threading.local()
 
-def has_valid_structure(file_name, df):
-    file_structures = json.loads(os.getenv('FILE_STRUCTURES'))
+def has_valid_columns(file_name, columns):
+    structure = table_registry.match_file(file_name)
+    missing_columns = structure.get_missing_columns(columns) if structure else []
+
+    valid = not missing_columns
 
-    valid = True
-    for prefix in file_structures.keys():
-        if file_name.startswith(prefix):
-            required_columns = file_structures[prefix]['required_columns']
-            valid = all(col in df.columns for col in required_columns)
-    
     print(f"File {file_name} has valid structure: {valid}")
 
+    if missing_columns:
+        print(f"Missing columns for {file_name}: {', '.join(missing_columns)}")
+
     return valid
 
+def has_valid_structure(file_name, df):
+    return has_valid_columns(file_name, df.columns)
+
+def get_column_types(table_name):
+    structure = table_registry.get_table(table_name)
+
+    return structure.column_types if structure else {}
+
+def get_primary_key(table_name):
+    structure = table_registry.get_table(table_name)
+
+    return structure.primary_key if structure else []
+
 def replace_non_printable(text):
     if isinstance(text, str):
         # Remove non-printable ASCII characters (0-31 and 127)
         return re.sub(r'[\x00-\x1F\x7F]', ' ', text)
     return text
 
+# Translation table mapping non-printable ASCII characters (0-31 and 127) to spaces
+NON_PRINTABLE_TABLE = str.maketrans({chr(code): ' ' for code in [*range(32), 127]})
 
-def clean_data(df):
+# The same characters as a Postgres regular expression, text values cannot hold NUL
+NON_PRINTABLE_PATTERN = r'[\x01-\x1f\x7f]'
+
+def clean_data_legacy(df, fill_nulls=True, typed_columns=()):
     if df.empty:
         print("DataFrame is empty, skipping cleaning.")
         return df
@@ -47,7 +78,9 @@ def clean_data(df):
 
     # Replace empty cells with NOVALUE
     df.replace(r'^\s*$', None, regex=True, inplace=True)
-    df.fillna(-1, inplace=True)        
+
+    if fill_nulls:
+        df.fillna({column_name: -1 for column_name in df.columns if column_name not in typed_columns}, inplace=True)
 
     # Convert 'created_at' to datetime
     df['created_at'] = pd.to_datetime(df['created_at'], errors='coerce', format='%Y-%m-%d_%H:%M:%S')
@@ -59,35 +92,150 @@ def clean_data(df):
 
     # Peform additional cleaning steps here
 
-def get_service_client(service_name):
-    if not service_name:
-        raise ValueError("Environment variable for service name is not set.")
+def clean_strings(strings):
+    strings = strings.str.translate(NON_PRINTABLE_TABLE)
 
-    session = boto3.session.Session()    
-        
-    if os.getenv('ENVIRONMENT') == 'development':
-        client = session.client(
-            service_name=service_name,
-            region_name=os.getenv('AWS_REGION_NAME'),
-            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-        )
-    else:
-        client = session.client(
-            service_name=service_name,
-            region_name=os.getenv('AWS_REGION_NAME')
-        )
-    
-    return client
+    # Blank or whitespace-only strings become nulls
+    blank = (strings.str.len() == 0) | strings.str.isspace()
+
+    return strings.mask(blank, None)
+
+def clean_categorical_column(column):
+    # Clean the categories instead of the rows, blank categories become nulls
+    cleaned = clean_strings(pd.Series(column.cat.categories, dtype=object)).to_numpy()
+    codes = column.cat.codes.to_numpy()
+
+    values = cleaned[codes]
+    values[codes == -1] = None
+
+    return pd.Series(pd.Categorical(values), index=column.index, name=column.name)
+
+def clean_string_column(column):
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return clean_categorical_column(column) if column.cat.categories.dtype == object else column
+
+    inferred_type = pd.api.types.infer_dtype(column, skipna=True)
+
+    if inferred_type == 'string':
+        # Clean each distinct value once, then expand back to the rows that use it
+        codes, uniques = pd.factorize(column)
+        cleaned = clean_strings(pd.Series(uniques, dtype=object)).to_numpy()
+
+        values = cleaned[codes]
+        values[codes == -1] = None
+
+        return pd.Series(values, index=column.index, name=column.name, dtype=object)
+
+    if inferred_type.startswith('mixed'):
+        is_string = column.map(type).eq(str)
+
+        column = column.copy()
+        column[is_string] = clean_strings(column[is_string])
+
+        return column
+
+    # Numeric, boolean, decimal and timestamp columns have nothing to clean
+    return column
+
+def fill_null_placeholders(df, typed_columns=()):
+    # Fill nulls column by column so columns without nulls keep their dtype, declared types keep typed nulls
+    for column_name in df.columns[df.isna().any()]:
+        if column_name not in typed_columns:
+            df[column_name] = df[column_name].fillna(-1)
+
+    return df
+
+def clean_data_vectorized(df, fill_nulls=True, typed_columns=()):
+    if df.empty:
+        print("DataFrame is empty, skipping cleaning.")
+        return df
+
+    df = df.copy()
+
+    # Only object and categorical columns can hold strings, everything else keeps its dtype untouched
+    for column_name in df.columns[(df.dtypes == object) | (df.dtypes == 'category')]:
+        df[column_name] = clean_string_column(df[column_name])
+
+    if fill_nulls:
+        df = fill_null_placeholders(df, typed_columns)
+
+    # Convert 'created_at' to datetime, psycopg2 already returns timestamps as datetimes
+    if not pd.api.types.is_datetime64_any_dtype(df['created_at']):
+        df['created_at'] = pd.to_datetime(df['created_at'], errors='coerce', format='%Y-%m-%d_%H:%M:%S')
+
+    # Drop any duplicate rows
+    df.drop_duplicates(inplace=True)
+
+    return df
+
+CLEAN_DATA_ENGINES = {
+    'legacy': clean_data_legacy,
+    'vectorized': clean_data_vectorized,
+}
+
+def clean_shard(df, fill_nulls, typed_columns, engine):
+    # Runs in a pool process, the executor pickles the shard on the way in and the cleaned frame on the way out
+    df = CLEAN_DATA_ENGINES[engine](df, fill_nulls, typed_columns)
+
+    return df, pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+def clean_data_sharded(df, fill_nulls, typed_columns, engine, workers, min_shard_rows):
+    try:
+        pool = resource_cache.get_process_pool(workers)
+    except OSError as e:
+        # Lambda has no /dev/shm for the pool's queues, clean in process instead
+        print(f"Could not start clean data workers, cleaning in process: {e}")
+        return CLEAN_DATA_ENGINES[engine](df, fill_nulls, typed_columns)
+
+    bounds = np.linspace(0, len(df), min(workers, len(df) // min_shard_rows) + 1, dtype=int)
+    frames = [df.iloc[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+    # map hands the shards back in submission order, whichever worker finishes first
+    try:
+        results = list(pool.map(clean_shard, frames, itertools.repeat(fill_nulls), itertools.repeat(dict(typed_columns)), itertools.repeat(engine)))
+    except BrokenProcessPool as e:
+        # A worker died, out of memory or killed, the cached pool is unusable for every later chunk
+        print(f"Clean data workers died, cleaning in process: {e}")
+        resource_cache.discard_process_pool(workers)
+        return CLEAN_DATA_ENGINES[engine](df, fill_nulls, typed_columns)
+
+    shards = [shard for shard, _ in results]
+    cleaned = pd.concat(shards)
+
+    # Each shard dropped its own duplicates, rows repeated across shard boundaries go here, the first occurrence wins
+    keep = ~pd.Series(np.concatenate([hashes for _, hashes in results])).duplicated().to_numpy()
+    cleaned = cleaned[keep]
+
+    # Shards build their own categories, concat falls back to object when they differ
+    for column_name in df.columns:
+        if isinstance(shards[0][column_name].dtype, pd.CategoricalDtype) and not isinstance(cleaned[column_name].dtype, pd.CategoricalDtype):
+            cleaned[column_name] = cleaned[column_name].astype('category')
 
-def get_secret(secret_name):
+    return cleaned
+
+def clean_data(df, fill_nulls=True, typed_columns=()):
+    engine = os.getenv('CLEAN_DATA_ENGINE') or 'vectorized'
+
+    if engine not in CLEAN_DATA_ENGINES:
+        raise ValueError(f"Unknown clean data engine: {engine}")
+
+    # Chunks big enough for at least two shards are spread over worker processes, one core cleans the rest
+    workers = int(os.getenv('CLEAN_DATA_WORKERS') or 1)
+    min_shard_rows = max(int(os.getenv('CLEAN_DATA_MIN_SHARD_ROWS') or 50000), 1)
+
+    if workers > 1 and len(df) >= 2 * min_shard_rows:
+        return clean_data_sharded(df, fill_nulls, typed_columns, engine, workers, min_shard_rows)
+
+    return CLEAN_DATA_ENGINES[engine](df, fill_nulls, typed_columns)
+
+def get_service_client(service_name, scope=None):
+    # Clients are cached across warm invocations, scope keeps separate clients per worker thread
+    return resource_cache.get_client(service_name, scope)
+
+def get_secret(secret_name, refresh=False):
     try:
-        client = get_service_client(os.getenv('AWS_SECRETS_MANAGER'))
-        cache_config = SecretCacheConfig()
-        cache = SecretCache(config=cache_config, client=client)
-        secret = cache.get_secret_string(secret_id=secret_name)
-        get_secret_value_response = client.get_secret_value(SecretId=secret_name)
-    except ClientError as e:
+        secret = resource_cache.get_secret(secret_name, refresh)
+    except botocore_exceptions.ClientError as e:
         # For a list of exceptions thrown, see
         # https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
         print(f'Could not connect to client: {e}')
@@ -95,8 +243,6 @@ def get_secret(secret_name):
     except Exception as e:
         print(f'An unexpected error occurred: {e}')
         raise e 
-    
-    secret = get_secret_value_response['SecretString']
 
     return secret
 
@@ -108,108 +254,1468 @@ def get_secret_dict(secret_name):
         print(f"Error retrieving secret {secret_name}: {e}")
         raise e
 
-def get_last_processed_date(table_name, client):
-    print(f"Retrieving last processed date for table: {table_name}")
-    
-    response = client.get_item(
-        TableName=os.getenv('AWS_DYNAMODB_TABLE_NAME'),
-        ConsistentRead=True,
-        ProjectionExpression='processed_date',
-        Key={'table_name': {'S': table_name}}
-    )
+def parse_watermark_item(item):
+    watermark = {'processed_date': item['processed_date']['S'] if 'processed_date' in item else None}
 
-    if 'Item' not in response:
-        print(f"No processing date found for table: {table_name}")
-        return None
-    else:
-        processing_date = response['Item']['processed_date']['S']
+    if 'checkpoint_created_at' in item:
+        watermark['checkpoint'] = {
+            'base': item['checkpoint_base']['S'] or None,
+            'created_at': item['checkpoint_created_at']['S'],
+            'key': json.loads(item['checkpoint_key']['S']),
+        }
+
+    return watermark
+
+def get_watermarks(table_names, client):
+    print(f"Retrieving watermarks for tables: {', '.join(table_names)}")
+
+    dynamo_db_table_name = os.getenv('AWS_DYNAMODB_TABLE_NAME')
+    watermarks = {table_name: {'processed_date': None} for table_name in table_names}
 
-        print(processing_date)
+    # BatchGetItem takes at most 100 keys per request
+    for start in range(0, len(table_names), 100):
+        request_items = {
+            dynamo_db_table_name: {
+                'Keys': [{'table_name': {'S': table_name}} for table_name in table_names[start:start + 100]],
+                'ConsistentRead': True,
+            }
+        }
 
-        return processing_date
+        while request_items:
+            response = client.batch_get_item(RequestItems=request_items)
+
+            for item in response.get('Responses', {}).get(dynamo_db_table_name, []):
+                watermarks[item['table_name']['S']] = parse_watermark_item(item)
+
+            # Throttled keys come back unprocessed and are retried
+            request_items = response.get('UnprocessedKeys')
+
+            if request_items:
+                time.sleep(0.1)
+
+    for table_name, watermark in watermarks.items():
+        print(f"Last processed date for {table_name}: {watermark['processed_date']}")
+
+    return watermarks
+
+def is_conditional_check_failure(error):
+    return error.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
 
 def mark_last_processed_date(table_name, timestamp, client):
-    client.put_item(
-        TableName=os.getenv('AWS_DYNAMODB_TABLE_NAME'),
-        Item={'table_name': {'S': table_name}, 'processed_date': {'S': timestamp}}
-    )
+    # The condition stops a slower concurrent run from moving the watermark backwards
+    try:
+        client.update_item(
+            TableName=os.getenv('AWS_DYNAMODB_TABLE_NAME'),
+            Key={'table_name': {'S': table_name}},
+            UpdateExpression='SET processed_date = :processed_date REMOVE checkpoint_base, checkpoint_created_at, checkpoint_key',
+            ConditionExpression='attribute_not_exists(processed_date) OR processed_date <= :processed_date',
+            ExpressionAttributeValues={':processed_date': {'S': timestamp}}
+        )
+    except botocore_exceptions.ClientError as e:
+        if not is_conditional_check_failure(e):
+            raise e
+
+        print(f"Processed date for {table_name} is already past {timestamp}, leaving it unchanged")
+
+def save_checkpoint(table_name, base, created_at, key, client):
+    try:
+        client.update_item(
+            TableName=os.getenv('AWS_DYNAMODB_TABLE_NAME'),
+            Key={'table_name': {'S': table_name}},
+            UpdateExpression='SET checkpoint_base = :base, checkpoint_created_at = :created_at, checkpoint_key = :key',
+            ConditionExpression='attribute_not_exists(checkpoint_created_at) OR checkpoint_created_at <= :created_at',
+            ExpressionAttributeValues={
+                ':base': {'S': base or ''},
+                ':created_at': {'S': created_at},
+                ':key': {'S': json.dumps(key, default=str)},
+            }
+        )
+    except botocore_exceptions.ClientError as e:
+        if not is_conditional_check_failure(e):
+            raise e
+
+        print(f"Checkpoint for {table_name} is already past {created_at}, leaving it unchanged")
 
-def create_query(table_name, client):
-    latest_processed_date = get_last_processed_date(table_name, client)
+def is_pushdown_enabled(table_name):
+    structure = table_registry.get_table(table_name)
+
+    # Without declared columns there is nothing to project, SELECT * and pandas cleaning stay in place
+    return os.getenv('INGEST_PUSHDOWN') == 'true' and structure is not None and bool(structure.required_columns)
+
+def create_clean_column(column_name):
+    # Same rules as clean_strings: control characters become spaces, blank strings become nulls
+    cleaned = f"regexp_replace({column_name}, '{NON_PRINTABLE_PATTERN}', ' ', 'g')"
+
+    return f"CASE WHEN btrim({cleaned}) = '' THEN NULL ELSE {cleaned} END AS {column_name}"
+
+def create_select(table_name, pushdown=False):
+    if not pushdown:
+        return "SELECT *"
+
+    # Only declared columns cross the network, already cleaned and without duplicate rows
+    structure = table_registry.get_table(table_name)
+    columns = [create_clean_column(column_name) if column_name in structure.text_columns else column_name for column_name in structure.required_columns]
+
+    return f"SELECT DISTINCT {', '.join(columns)}"
+
+def create_query(table_name, latest_processed_date, inclusive=False, pushdown=False):
+    # Query to fetch data from the source table, nothing downstream relies on row order
+    query = f"{create_select(table_name, pushdown)} FROM {table_name}"
+    params = {}
 
-    # Query to fetch data from the source table
     if latest_processed_date:
-        query = f"SELECT * FROM {table_name} WHERE created_at > '{latest_processed_date}'::timestamp ORDER BY created_at DESC;"
-    else:           
-        query = f"SELECT * FROM {table_name} ORDER BY created_at DESC;"
+        query += f" WHERE created_at {'>=' if inclusive else '>'} CAST(:processed_date AS timestamp)"
+        params['processed_date'] = latest_processed_date
 
-    print(f"Query for {table_name}: {query}")
+    print(f"Query for {table_name}: {query} {params}")
+
+    return query, params
+
+def create_copy_queries(table_name, latest_processed_date):
+    # COPY takes no bind parameters, both queries use psycopg2 placeholders and the watermark is bound client side
+    condition = " WHERE created_at > CAST(%(processed_date)s AS timestamp)" if latest_processed_date else ""
+    params = {'processed_date': latest_processed_date} if latest_processed_date else {}
+
+    copy_query = f"COPY ({create_select(table_name, pushdown=True)} FROM {table_name}{condition}) TO STDOUT WITH (FORMAT csv, HEADER true)"
+    watermark_query = f"SELECT max(created_at) FROM {table_name}{condition}"
+
+    return copy_query, watermark_query, params
+
+def create_range_query(table_name, first, last, pushdown=False):
+    # Ranges are half-open except the last, rows without created_at ride along with the first range
+    conditions = ["created_at >= :low", "created_at <= :high" if last else "created_at < :high"]
+    query = f"{create_select(table_name, pushdown)} FROM {table_name} WHERE ({' AND '.join(conditions)})"
+
+    if first:
+        query += " OR created_at IS NULL"
 
     return query
 
-def get_db_connection(secret):
-    return sa.create_engine(f"postgresql+psycopg2://{secret['username']}:{secret['password']}@{secret['host']}/{secret['dbname']}")
+def create_keyset_query(table_name, primary_key, latest_processed_date, cursor, chunk_size):
+    # Rows come in (created_at, primary key) order so a cursor on the last row marks exact progress
+    sort_columns = ['created_at', *primary_key]
+    conditions = ["created_at IS NOT NULL"]
+    params = {'limit': chunk_size}
 
-def upload_to_s3(conn):
-    file_structures = json.loads(os.getenv('FILE_STRUCTURES'))
+    if latest_processed_date:
+        conditions.append("created_at > CAST(:processed_date AS timestamp)")
+        params['processed_date'] = latest_processed_date
 
-    print("File structures:", file_structures.keys())
+    if cursor:
+        placeholders = [f":cursor_{index}" for index in range(len(sort_columns))]
+        conditions.append(f"({', '.join(sort_columns)}) > ({', '.join(placeholders)})")
+        params.update({f"cursor_{index}": value for index, value in enumerate([cursor['created_at'], *cursor['key']])})
 
-    dynamo_db_client = get_service_client(os.getenv('AWS_DYNAMODB'))
+    query = f"SELECT * FROM {table_name} WHERE {' AND '.join(conditions)} ORDER BY {', '.join(sort_columns)} LIMIT :limit"
 
-    s3_client = get_service_client(os.getenv('AWS_S3'))
+    return query, params
 
-    for table_name in file_structures.keys():        
-        file_name = f"{table_name}_{timestamp}.csv"
+def get_backfill_ranges(conn, table_name, range_count, strategy='time'):
+    if strategy == 'quantile':
+        # Cut points at evenly spaced quantiles of created_at so every range holds about the same rows
+        fractions = [index / range_count for index in range(1, range_count)]
+        low, high, cuts = conn.execute(
+            sa.text(f"SELECT min(created_at), max(created_at), percentile_disc(CAST(:fractions AS double precision[])) WITHIN GROUP (ORDER BY created_at) FROM {table_name}"),
+            {'fractions': fractions}
+        ).one()
+        cuts = cuts or []
+    elif strategy == 'time':
+        # Cut points at fixed time slices between the oldest and newest rows
+        low, high = conn.execute(sa.text(f"SELECT min(created_at), max(created_at) FROM {table_name}")).one()
+        cuts = [low + (high - low) * index / range_count for index in range(1, range_count)] if low is not None else []
+    else:
+        raise ValueError(f"Unknown backfill strategy: {strategy}")
 
-        print(f"Processing table: {table_name}")    
+    if low is None:
+        return []
 
-        query = create_query(table_name, dynamo_db_client)        
-        
-        rows = conn.execute(query)
+    bounds = sorted(set([low, *cuts, high]))
+
+    if len(bounds) == 1:
+        return [(low, high)]
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def get_source_engine(pool_size):
+    secret_name = os.getenv('AWS_SOURCE_DB_CREDENTIALS')
+    engine = resource_cache.get_engine(secret_name, lambda secret: get_db_connection(secret, pool_size))
+
+    try:
+        # Fail fast when the cached credentials were rotated since the last invocation
+        with engine.connect():
+            pass
+    except sa.exc.OperationalError as e:
+        print(f"Could not connect with cached credentials, refreshing secret: {e}")
+        get_secret(secret_name, refresh=True)
+        engine = resource_cache.get_engine(secret_name, lambda secret: get_db_connection(secret, pool_size))
+
+    return engine
+
+def get_db_connection(secret, pool_size=5):
+    return sa.create_engine(
+        f"postgresql+psycopg2://{secret['username']}:{secret['password']}@{secret['host']}/{secret['dbname']}",
+        pool_size=pool_size,
+        pool_pre_ping=True
+    )
 
-        # Create data frame from query results
-        df = pd.DataFrame(data=rows)
+def execute_query(conn, query, chunk_size=None, params=None):
+    if params is not None:
+        query = sa.text(query)
 
-        # Clean the data file        
-        df = clean_data(df)
+    # Use a server-side cursor so the column metadata is known before any rows are fetched
+    options = {'stream_results': True}
 
-        csv_file_path =  f"/tmp/{file_name}"
+    if chunk_size:
+        options['max_row_buffer'] = chunk_size
 
-        # Save DataFrame to CSV
-        df.to_csv(csv_file_path, index=False)
+    return conn.execution_options(**options).execute(query, params or {})
 
-        if df.empty or not has_valid_structure(table_name, df):
-            print(f"No data to process for {table_name} or invalid structure")
-            s3_client.upload_file(csv_file_path, os.getenv('AWS_S3_ERROR_BUCKET_NAME'), f'{file_name}_empty_or_invalid_stricture.csv')
+def apply_column_types(df, column_types):
+    for column_name, dtype in column_types.items():
+        if column_name not in df.columns or df[column_name].dtype == dtype:
             continue
-                    
-        last_processed_date = df['created_at'].max() if not df.empty else None
-        last_processed_date = str(last_processed_date) if last_processed_date else None
-        print(f"Last processed date for {table_name}: {last_processed_date}")
 
-        print(f"Data for {table_name} saved to {csv_file_path}")
+        column = df[column_name]
 
-        # Upload to S3
-        repsonse = s3_client.upload_file(csv_file_path, os.getenv('AWS_S3_BUCKET_NAME'), os.getenv('AWS_S3_FOLDER_PATH') + '/' + file_name)
-        
-        print(f"Uploaded {table_name} data to S3 at {file_name}")
-        print(repsonse)
+        if dtype.startswith('datetime64'):
+            column = pd.to_datetime(column, errors='coerce')
+        elif dtype not in ('category', 'string', 'boolean', 'bool') and column.dtype == object:
+            # Numeric columns arrive as Python ints, Decimals or None
+            column = pd.to_numeric(column)
+
+        df[column_name] = column.astype(dtype)
+
+    return df
+
+def prepare_frame(df, column_types=None, quarantine=None):
+    # Rows are checked in their raw form, type coercion would turn bad values into nulls or raise
+    if quarantine is not None:
+        df = quarantine.filter(df)
+
+    return apply_column_types(df, column_types) if column_types else df
+
+def read_data_frames(result, chunk_size=None, column_types=None, quarantine=None, keep_objects=False):
+    columns = list(result.keys())
+
+    # Rows bound for the quarantine stay Python objects, one bad value would otherwise retype the whole column
+    dtype = object if quarantine is not None or keep_objects else None
+
+    def create_frame(rows):
+        return prepare_frame(pd.DataFrame(data=rows, columns=columns, dtype=dtype), column_types, quarantine)
+
+    if not chunk_size:
+        try:
+            # Create data frame from query results
+            yield create_frame(result.fetchall())
+        finally:
+            result.close()
+
+        return
+
+    # Only one chunk of rows is held in memory at a time
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+
+            if not rows:
+                break
+
+            frame = create_frame(rows)
+
+            # A fully quarantined chunk would read as the end of the table downstream
+            if quarantine is not None and frame.empty:
+                continue
+
+            yield frame
+    finally:
+        result.close()
+
+class CsvFrameWriter:
+    def __init__(self, file):
+        self.file = file
+        self.header = True
+
+    def write(self, df):
+        # Append the frame to the CSV, writing the header only once
+        self.file.write(df.to_csv(index=False, header=self.header).encode('utf-8'))
+        self.header = False
+
+    def close(self):
+        pass
+
+# Undeclared NUMERIC columns are written with the widest precision Redshift takes and at least this scale,
+# a later chunk with more decimal places than the first still fits the file's schema
+UNDECLARED_DECIMAL_SCALE = 18
+
+def get_arrow_type(dtype):
+    # Categories are written as their string values, the index width of a dictionary can change between chunks
+    if dtype in ('category', 'string', 'object'):
+        return pa.string()
+
+    return pa.Schema.from_pandas(pd.DataFrame({'column': pd.Series(dtype=dtype)}), preserve_index=False).field('column').type
+
+class ParquetFrameWriter:
+    def __init__(self, file, compression, column_types=None):
+        self.file = file
+        self.compression = compression
+        self.column_types = column_types or {}
+        self.writer = None
+
+    def get_field_type(self, field):
+        # Declared types win, the first chunk alone cannot tell the type of a column that is null so far
+        if field.name in self.column_types:
+            return get_arrow_type(self.column_types[field.name])
+
+        if pa.types.is_dictionary(field.type):
+            return field.type.value_type
+
+        if pa.types.is_null(field.type):
+            print(f"Column {field.name} is null in the first chunk and has no declared type, writing it as strings")
+            return pa.string()
+
+        if pa.types.is_decimal(field.type):
+            return pa.decimal128(38, max(field.type.scale, UNDECLARED_DECIMAL_SCALE))
+
+        return field.type
+
+    def write(self, df):
+        table = pa.Table.from_pandas(df, preserve_index=False)
+
+        if self.writer is None:
+            schema = pa.schema([pa.field(field.name, self.get_field_type(field)) for field in table.schema], metadata=table.schema.metadata)
+
+            # Redshift reads Parquet timestamps in microseconds at most
+            self.writer = pq.ParquetWriter(
+                self.file,
+                schema,
+                compression=self.compression,
+                coerce_timestamps='us',
+                allow_truncated_timestamps=True
+            )
+
+        # Every chunk is inferred on its own and cast to the schema of the file, a lossy cast still raises
+        self.writer.write_table(table.select(self.writer.schema.names).cast(self.writer.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+class S3MultipartWriter:
+    def __init__(self, s3_client, bucket, key, part_size, max_concurrency):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self.buffer = bytearray()
+        self.bytes_written = 0
+        self.upload_id = None
+        self.executor = None
+        self.futures = []
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.bytes_written
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_written += len(data)
+
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self.upload_part(part)
+
+        return len(data)
+
+    def send_part(self, part_number, body):
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body
+        )
+
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def upload_part(self, body):
+        if self.upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+            self.upload_id = response['UploadId']
+            self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+
+        # Wait for a slot so no more than max_concurrency parts are held in memory
+        pending = [future for future in self.futures if not future.done()]
+        if len(pending) >= self.max_concurrency:
+            wait(pending, return_when=FIRST_COMPLETED)
+
+        self.futures.append(self.executor.submit(self.send_part, len(self.futures) + 1, body))
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+
+        # Small files never start a multipart upload and go up in a single request
+        if self.upload_id is None:
+            self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+            return
+
+        try:
+            if self.buffer:
+                self.upload_part(bytes(self.buffer))
+                self.buffer = bytearray()
+
+            parts = [future.result() for future in self.futures]
+
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def abort(self):
+        self.closed = True
+
+        if self.upload_id is not None:
+            print(f"Aborting multipart upload for s3://{self.bucket}/{self.key}")
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+def hash_columns(df, columns):
+    # Hash the text form so fingerprints stay stable when a column's dtype changes between runs
+    return pd.util.hash_pandas_object(df[columns].astype(str), index=False).to_numpy()
+
+class DedupIndex:
+    def __init__(self, s3_client, table_name, key_columns=None):
+        self.s3_client = s3_client
+        self.table_name = table_name
+        self.key_columns = key_columns
+        self.bucket = os.getenv('AWS_S3_BUCKET_NAME')
+        self.prefix = f"{os.getenv('DEDUP_INDEX_PREFIX')}/{table_name}"
+        self.days = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get_key(self, day):
+        return f"{self.prefix}/{day}.npy"
+
+    def load_day(self, day):
+        # Each day is a sorted uint64 array of row fingerprints, loaded once per run
+        if day not in self.days:
+            try:
+                body = self.s3_client.get_object(Bucket=self.bucket, Key=self.get_key(day))['Body'].read()
+                self.days[day] = np.load(io.BytesIO(body))
+            except botocore_exceptions.ClientError as e:
+                if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                    raise e
+
+                self.days[day] = np.array([], dtype=np.uint64)
+
+        return self.days[day]
+
+    def hash_rows(self, df):
+        return hash_columns(df, [column for column in (self.key_columns or df.columns) if column in df.columns])
+
+    def filter(self, df):
+        if df.empty:
+            return df
+
+        hashes = self.hash_rows(df)
+        days = pd.to_datetime(df['created_at'], errors='coerce').dt.strftime('%Y-%m-%d').fillna('unknown').to_numpy()
+
+        # Duplicates inside the chunk itself
+        keep = ~pd.Series(hashes).duplicated().to_numpy()
+
+        with self.lock:
+            for day in np.unique(days):
+                in_day = days == day
+                seen = self.load_day(day)
+
+                if day in self.pending:
+                    seen = np.union1d(seen, np.concatenate(self.pending[day]))
+
+                positions = np.searchsorted(seen, hashes[in_day])
+                found = seen[np.minimum(positions, len(seen) - 1)] == hashes[in_day] if len(seen) else np.zeros(in_day.sum(), dtype=bool)
+
+                keep[in_day] &= ~found
+
+                self.pending.setdefault(day, []).append(hashes[in_day & keep])
+
+        dropped = len(df) - keep.sum()
+
+        if dropped:
+            print(f"Dropped {dropped} rows of {self.table_name} already ingested")
+
+        return df[keep]
+
+    def commit(self):
+        # Only called once the rows behind the pending fingerprints have landed in S3
+        with self.lock:
+            for day, hashes in self.pending.items():
+                merged = np.union1d(self.load_day(day), np.concatenate(hashes)).astype(np.uint64)
+
+                buffer = io.BytesIO()
+                np.save(buffer, merged)
+                self.s3_client.put_object(Bucket=self.bucket, Key=self.get_key(day), Body=buffer.getvalue())
+
+                self.days[day] = merged
+
+            self.pending = {}
+
+class SnapshotState:
+    def __init__(self, s3_client, table_name):
+        self.s3_client = s3_client
+        self.table_name = table_name
+        self.bucket = os.getenv('AWS_S3_BUCKET_NAME')
+        self.key = f"{os.getenv('SNAPSHOT_STATE_PREFIX') or '_snapshots'}/{table_name}.parquet"
+
+    def load(self, key_columns):
+        # Primary key values with key and row fingerprints of the last emitted snapshot, sorted by key fingerprint
+        try:
+            body = self.s3_client.get_object(Bucket=self.bucket, Key=self.key)['Body'].read()
+        except botocore_exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                raise e
+
+            return pd.DataFrame({**{column: [] for column in key_columns}, 'key_hash': np.array([], dtype=np.uint64), 'row_hash': np.array([], dtype=np.uint64)})
+
+        return pq.read_table(io.BytesIO(body)).to_pandas()
+
+    def save(self, state):
+        buffer = io.BytesIO()
+        pq.write_table(pa.Table.from_pandas(state, preserve_index=False), buffer)
+
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=buffer.getvalue())
+
+def diff_snapshot_chunk(chunk, key_columns, previous_keys, previous_rows):
+    keys = hash_columns(chunk, key_columns)
+    rows = hash_columns(chunk, list(chunk.columns))
+
+    if len(previous_keys):
+        positions = np.minimum(np.searchsorted(previous_keys, keys), len(previous_keys) - 1)
+        found = previous_keys[positions] == keys
+        changed = ~found | (previous_rows[positions] != rows)
+    else:
+        found = np.zeros(len(chunk), dtype=bool)
+        changed = ~found
+
+    changes = chunk[changed].assign(change_op=np.where(found[changed], 'update', 'insert'))
+    current = chunk[key_columns].assign(key_hash=keys, row_hash=rows)
+
+    return changes, current
+
+def export_snapshot_diff(engine, table_name, file_name, s3_client, chunk_size=None, run_manifest=None):
+    structure = table_registry.get_table(table_name)
+    state = SnapshotState(s3_client, table_name)
+    recorder = metrics.get_recorder(MODULE_NAME, table_name)
+
+    with recorder.time('snapshot_load') as counts:
+        previous = state.load(structure.primary_key).sort_values('key_hash', ignore_index=True)
+        counts['rows'] = len(previous)
+
+    previous_keys = previous['key_hash'].to_numpy(dtype=np.uint64)
+    previous_rows = previous['row_hash'].to_numpy(dtype=np.uint64)
+
+    pushdown = is_pushdown_enabled(table_name)
+    query, params = create_query(table_name, None, pushdown=pushdown)
+    changes = []
+    current = []
+
+    with engine.connect() as conn:
+        with recorder.time('query'):
+            result = execute_query(conn, query, chunk_size, params)
+
+        columns = list(result.keys())
+
+        if not has_valid_columns(table_name, columns):
+            result.close()
+            reject_columns(table_name, columns, file_name, s3_client)
+            return False, 0
+
+        quarantine = get_quarantine(table_name, file_name, s3_client)
+
+        for chunk in recorder.time_iter('fetch', read_data_frames(result, chunk_size, get_column_types(table_name), quarantine)):
+            with recorder.time('diff') as counts:
+                # Rows are compared in their cleaned form, only a change that reaches the output counts
+                if not pushdown:
+                    chunk = clean_data(chunk, fill_nulls=False, typed_columns=structure.column_types)
+
+                chunk_changes, chunk_current = diff_snapshot_chunk(chunk, structure.primary_key, previous_keys, previous_rows)
+                changes.append(chunk_changes)
+                current.append(chunk_current)
+                counts['rows'] = len(chunk_changes)
+
+    current = pd.concat(current, ignore_index=True) if current else previous.iloc[:0]
+    changes = pd.concat(changes, ignore_index=True) if changes else pd.DataFrame(columns=[*columns, 'change_op'])
+
+    # A quarantined row still exists at the source, its last emitted version is kept instead of being deleted
+    held = np.isin(previous_keys, quarantine.hash_keys(structure.primary_key, pushdown)) if quarantine is not None else np.zeros(len(previous), dtype=bool)
+    held &= ~np.isin(previous_keys, current['key_hash'].to_numpy(dtype=np.uint64))
+
+    if held.any():
+        current = pd.concat([current, previous[held]], ignore_index=True)
+
+    # Keys of the last snapshot missing from this one were deleted at the source, only their key values are sent
+    deleted = previous[~np.isin(previous_keys, current['key_hash'].to_numpy(dtype=np.uint64))]
+    deletes = deleted[structure.primary_key].assign(change_op='delete')
+
+    if not deletes.empty:
+        # Nullable integers keep the other columns of the key-only delete rows from turning integers into floats
+        changes = changes.astype({column_name: 'Int64' for column_name in changes.columns if changes[column_name].dtype.kind in 'iu'})
+        changes = pd.concat([changes, deletes], ignore_index=True)[changes.columns] if not changes.empty else deletes.reindex(columns=changes.columns)
+
+    # load_raw copies change files into a staging table by position, the declared columns come first in their declared order
+    changes = changes.reindex(columns=[*structure.required_columns, 'change_op'])
+
+    operations = changes['change_op'].value_counts()
+    print(f"Snapshot diff for {table_name}: {operations.get('insert', 0)} inserted, {operations.get('update', 0)} updated, {operations.get('delete', 0)} deleted")
+
+    if changes.empty:
+        if quarantine is not None:
+            quarantine.commit()
+
+        return True, 0
+
+    # The dedup index would drop updates, their keys were shipped before
+    valid, row_count, _ = export_frames(iter([changes]), table_name, file_name, s3_client, run_manifest=run_manifest)
+
+    if not valid:
+        return False, 0
+
+    if quarantine is not None:
+        quarantine.commit()
+
+    # Saved only once the change file landed, a failed upload is diffed again next run
+    with recorder.time('snapshot_save') as counts:
+        state.save(current.sort_values('key_hash', ignore_index=True))
+        counts['rows'] = len(current)
+
+    return True, row_count
+
+class RowQuarantine:
+    def __init__(self, s3_client, table_name, rules, file_name):
+        self.s3_client = s3_client
+        self.table_name = table_name
+        self.rules = rules
+        self.bucket = os.getenv('AWS_S3_ERROR_BUCKET_NAME')
+        self.key = f"{file_name}_quarantined.csv"
+        self.frames = []
+        self.lock = threading.Lock()
+
+    def check(self, column, rule):
+        # True where the row fails the rule, nulls only fail when the rule says the column is required
+        nulls = column.isna()
+        check = rule['check']
+
+        if check == 'not_null':
+            return nulls.to_numpy(), 'null'
+
+        if check == 'timestamp':
+            # The same coercion apply_column_types uses, so exactly the values it would turn into NaT fail
+            failed = pd.to_datetime(column, errors='coerce').isna() & ~nulls
+            reason = 'not a timestamp'
+        elif check == 'numeric':
+            values = pd.to_numeric(column, errors='coerce')
+            failed = values.isna() & ~nulls
+            reason = 'not numeric'
+
+            if 'min' in rule:
+                failed |= values < rule['min']
+                reason += f" or below {rule['min']}"
+
+            if 'max' in rule:
+                failed |= values > rule['max']
+                reason += f" or above {rule['max']}"
+        else:
+            failed = ~column.isin(rule.get('values', [])) & ~nulls
+            reason = 'not an allowed value'
+
+        if rule.get('required'):
+            failed |= nulls
+            reason += ' or null'
+
+        return failed.to_numpy(), reason
+
+    def filter(self, df):
+        # Frames arrive as object columns, the rows left over get the dtypes they would have had without the failing ones
+        if df.empty:
+            return df.infer_objects()
+
+        failures = [
+            (*self.check(df[rule['column']], rule), rule['column'])
+            for rule in self.rules if rule['column'] in df.columns
+        ]
+
+        if not failures:
+            return df.infer_objects()
+
+        failed = np.logical_or.reduce([mask for mask, _, _ in failures])
+
+        if not failed.any():
+            return df.infer_objects()
+
+        # Every failed rule of a row is listed, rules are few so the loop is over rules, not rows
+        reasons = np.full(failed.sum(), '', dtype=object)
+
+        for mask, reason, column_name in failures:
+            hit = mask[failed]
+            reasons[hit] = reasons[hit] + f"{column_name}: {reason}; "
+
+        quarantined = df[failed].assign(quarantine_reason=pd.Series(reasons, index=df.index[failed]).str[:-2])
+
+        with self.lock:
+            self.frames.append(quarantined)
+
+        print(f"Quarantined {len(quarantined)} rows of {self.table_name}")
+
+        # infer_objects also copies, types are applied to a frame of its own rather than a slice
+        return df[~failed].infer_objects()
+
+    def hash_keys(self, key_columns, cleaned=False):
+        # Fingerprints of the quarantined rows' keys as hash_columns builds them from cleaned rows
+        with self.lock:
+            frames = [frame[key_columns] for frame in self.frames]
+
+        if not frames:
+            return np.array([], dtype=np.uint64)
+
+        keys = pd.concat(frames, ignore_index=True)
+
+        # Pushdown rows were cleaned by the source query, the others get the string cleaning clean_data applies
+        if not cleaned:
+            for column_name in keys.columns[(keys.dtypes == object) | (keys.dtypes == 'category')]:
+                keys[column_name] = clean_string_column(keys[column_name])
+
+        return hash_columns(keys, key_columns)
+
+    def commit(self):
+        # Called once the valid rows landed, the raw failing values go to the error bucket as they came
+        with self.lock:
+            frames, self.frames = self.frames, []
+
+        if not frames:
+            return 0
+
+        quarantined = pd.concat(frames, ignore_index=True)
+
+        with metrics.get_recorder(MODULE_NAME, self.table_name).time('quarantine') as counts:
+            body = quarantined.to_csv(index=False).encode('utf-8')
+            self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=body)
+            counts['rows'] = len(quarantined)
+            counts['bytes'] = len(body)
+
+        print(f"Quarantined {len(quarantined)} rows of {self.table_name} to s3://{self.bucket}/{self.key}")
+
+        return len(quarantined)
+
+def get_quarantine(table_name, file_name, s3_client):
+    structure = table_registry.get_table(table_name)
+
+    if structure is None or not structure.row_rules:
+        return None
+
+    return RowQuarantine(s3_client, table_name, structure.row_rules, file_name)
+
+def get_dedup_index(table_name, s3_client):
+    if not os.getenv('DEDUP_INDEX_PREFIX'):
+        return None
+
+    structure = table_registry.get_table(table_name)
+
+    return DedupIndex(s3_client, table_name, structure.dedup_key if structure else None)
+
+# File name extensions for compressed CSV output
+COMPRESSION_EXTENSIONS = {
+    'gzip': 'gz',
+    'zstd': 'zst',
+}
+
+def get_output_format(table_name):
+    structure = table_registry.get_table(table_name)
+    table_format = structure.file_format if structure else None
+    table_compression = structure.compression if structure else None
+
+    file_format = table_format or os.getenv('OUTPUT_FILE_FORMAT') or 'csv'
+
+    if file_format == 'parquet':
+        compression = table_compression or os.getenv('PARQUET_COMPRESSION') or 'snappy'
+    elif file_format == 'csv':
+        compression = table_compression or os.getenv('CSV_COMPRESSION') or None
+        compression = None if compression == 'none' else compression
+
+        if compression is not None and compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError(f"Unsupported CSV compression for {table_name}: {compression}")
+    else:
+        raise ValueError(f"Unsupported output file format for {table_name}: {file_format}")
+
+    return file_format, compression
+
+def get_file_extension(file_format, compression=None):
+    # Parquet compresses internally, only CSV files carry a compression extension
+    if file_format == 'csv' and compression:
+        return f"csv.{COMPRESSION_EXTENSIONS[compression]}"
+
+    return file_format
+
+def open_compressed_stream(file, compression):
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=file, mode='wb')
+
+    if compression == 'zstd':
+        import zstandard
+
+        return zstandard.ZstdCompressor().stream_writer(file, closefd=False)
+
+    return None
+
+def create_frame_writer(file, file_format, compression=None, column_types=None):
+    if file_format == 'parquet':
+        return ParquetFrameWriter(file, compression, column_types)
+
+    return CsvFrameWriter(file)
+
+class FileFrameSink:
+    def __init__(self, file, file_format='csv', compression=None, column_types=None):
+        self.file = file
+        self.file_format = file_format
+        self.stream = open_compressed_stream(file, compression) if file_format == 'csv' else None
+        self.writer = create_frame_writer(self.stream or file, file_format, compression, column_types)
+
+    def write(self, df):
+        position = self.file.tell()
+        self.writer.write(df)
+
+        return self.file.tell() - position
+
+    def close(self):
+        self.writer.close()
+
+        # Flush the compression trailer, the underlying file stays open
+        if self.stream is not None:
+            self.stream.close()
+
+def format_partition_values(column):
+    # Whole floats from nullable integer columns keep one partition per value instead of 7 and 7.0
+    if pd.api.types.is_float_dtype(column) and (column.dropna() % 1 == 0).all():
+        column = column.astype('Int64')
+
+    return column.astype(str).where(column.notna(), s3_layout.DEFAULT_PARTITION)
+
+def get_multipart_settings():
+    part_size = max(int(os.getenv('S3_PART_SIZE_MB') or 8), 5) * 1024 * 1024
+    max_concurrency = int(os.getenv('S3_UPLOAD_CONCURRENCY') or 4)
+
+    return part_size, max_concurrency
+
+class PartitionedFrameSink:
+    def __init__(self, key, partition_columns, file_format='csv', compression=None, s3_client=None, bucket=None, column_types=None):
+        self.key = key
+        self.partition_columns = partition_columns
+        self.file_format = file_format
+        self.compression = compression
+        self.column_types = column_types
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.partitions = {}
+
+    def open_partition(self, values):
+        key = s3_layout.add_partition(self.key, dict(zip(self.partition_columns, values)))
+
+        if self.s3_client is not None:
+            # Every partition streams into its own multipart upload, small partitions stay in memory until close
+            file_path = None
+            file = S3MultipartWriter(self.s3_client, self.bucket, key, *get_multipart_settings())
+        else:
+            # Every partition spools to its own temporary file, memory stays bounded by the chunk
+            file_path = f"/tmp/{uuid.uuid4().hex}_{os.path.basename(key)}"
+            file = open(file_path, 'wb')
+
+        return {'key': key, 'file_path': file_path, 'file': file, 'sink': FileFrameSink(file, self.file_format, self.compression, self.column_types), 'rows': 0}
+
+    def write(self, df):
+        written = 0
+        keys = [format_partition_values(df[column]) for column in self.partition_columns]
+
+        for values, part in df.groupby(keys, sort=False):
+            if values not in self.partitions:
+                self.partitions[values] = self.open_partition(values)
+
+            partition = self.partitions[values]
+            written += partition['sink'].write(part)
+            partition['rows'] += len(part)
+
+        return written
+
+    def close(self):
+        # Multipart writers stay open, closing them completes the uploads
+        for partition in self.partitions.values():
+            partition['sink'].close()
+
+            if partition['file_path'] is not None:
+                partition['file'].close()
+
+    def abort(self):
+        # Uploads that already completed stay, a failing close aborts its own upload
+        for partition in self.partitions.values():
+            if partition['file_path'] is None and not partition['file'].closed:
+                partition['file'].abort()
+
+def write_frames(frames, sink, dedup_index=None, structure=None, pushdown=False):
+    row_count = 0
+    last_processed_date = None
+    recorder = metrics.get_recorder(MODULE_NAME, structure.name if structure else 'unknown')
+
+    for chunk in frames:
+        with recorder.time('clean') as counts:
+            typed_columns = structure.column_types if structure else ()
+
+            # Clean the data chunk, Parquet keeps typed nulls instead of the -1 placeholder
+            if not pushdown:
+                chunk = clean_data(chunk, fill_nulls=sink.file_format == 'csv', typed_columns=typed_columns)
+            elif sink.file_format == 'csv':
+                # The source query already cleaned strings and dropped duplicates
+                chunk = fill_null_placeholders(chunk, typed_columns)
+
+            # Drop rows an earlier chunk or an earlier run already shipped
+            if dedup_index is not None:
+                chunk = dedup_index.filter(chunk)
+
+            counts['rows'] = len(chunk)
+
+        with recorder.time('encode') as counts:
+            counts['bytes'] = sink.write(chunk)
+            counts['rows'] = len(chunk)
+
+        row_count += len(chunk)
+
+        if not chunk.empty:
+            chunk_max = chunk['created_at'].max()
+
+            if pd.notna(chunk_max) and (last_processed_date is None or chunk_max > last_processed_date):
+                last_processed_date = chunk_max
+
+    sink.close()
+
+    return row_count, last_processed_date
+
+def write_frames_to_s3(frames, s3_client, bucket, key, file_format='csv', compression=None, dedup_index=None, structure=None, pushdown=False):
+    recorder = metrics.get_recorder(MODULE_NAME, structure.name if structure else 'unknown')
+    column_types = structure.column_types if structure else None
+
+    if os.getenv('S3_UPLOAD_MODE') == 'multipart':
+        # Stream encoded chunks straight into multipart parts, nothing is written to disk
+        writer = S3MultipartWriter(s3_client, bucket, key, *get_multipart_settings())
+
+        try:
+            row_count, last_processed_date = write_frames(frames, FileFrameSink(writer, file_format, compression, column_types), dedup_index, structure, pushdown)
+
+            # Parts already went out while encoding, this waits for the rest and completes the upload
+            with recorder.time('upload') as counts:
+                writer.close()
+                counts['bytes'] = writer.bytes_written
+        except Exception:
+            writer.abort()
+            raise
+
+        print(f"Streamed {row_count} rows ({writer.bytes_written} bytes) to s3://{bucket}/{key}")
+
+        return row_count, last_processed_date
+
+    # Hive keys end in the same part-{timestamp} name for every table, tables ingested side by side must not share a file
+    file_path = f"/tmp/{uuid.uuid4().hex}_{os.path.basename(key)}"
+
+    # Checkpoint chunks and backfill parts each get their own file, a warm container would otherwise fill /tmp
+    try:
+        with open(file_path, 'wb') as file:
+            row_count, last_processed_date = write_frames(frames, FileFrameSink(file, file_format, compression, column_types), dedup_index, structure, pushdown)
+
+        print(f"Wrote {row_count} rows to {file_path}")
+
+        with recorder.time('upload') as counts:
+            s3_client.upload_file(file_path, bucket, key)
+            counts['bytes'] = os.path.getsize(file_path)
+    finally:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    return row_count, last_processed_date
+
+def write_partitioned_frames_to_s3(frames, s3_client, bucket, key, partition_columns, file_format='csv', compression=None, dedup_index=None, structure=None, pushdown=False):
+    recorder = metrics.get_recorder(MODULE_NAME, structure.name if structure else 'unknown')
+    column_types = structure.column_types if structure else None
+
+    if os.getenv('S3_UPLOAD_MODE') == 'multipart':
+        sink = PartitionedFrameSink(key, partition_columns, file_format, compression, s3_client, bucket, column_types)
+
+        try:
+            row_count, last_processed_date = write_frames(frames, sink, dedup_index, structure, pushdown)
+
+            # Full parts already went out while encoding, this sends the rest of every partition side by side
+            with recorder.time('upload') as counts:
+                with ThreadPoolExecutor(max_workers=get_multipart_settings()[1]) as executor:
+                    list(executor.map(lambda partition: partition['file'].close(), sink.partitions.values()))
+
+                counts['bytes'] = sum(partition['file'].bytes_written for partition in sink.partitions.values())
+        except Exception:
+            sink.abort()
+            raise
+
+        print(f"Streamed {row_count} rows to {len(sink.partitions)} partitions under s3://{bucket}/{os.path.dirname(key)}")
+
+        return row_count, last_processed_date, [(partition['key'], partition['rows']) for partition in sink.partitions.values()]
+
+    sink = PartitionedFrameSink(key, partition_columns, file_format, compression, column_types=column_types)
+
+    try:
+        row_count, last_processed_date = write_frames(frames, sink, dedup_index, structure, pushdown)
+
+        # Partition objects are small and independent, they go up side by side
+        with recorder.time('upload') as counts:
+            with ThreadPoolExecutor(max_workers=int(os.getenv('S3_UPLOAD_CONCURRENCY') or 4)) as executor:
+                list(executor.map(lambda partition: s3_client.upload_file(partition['file_path'], bucket, partition['key']), sink.partitions.values()))
+
+            counts['bytes'] = sum(os.path.getsize(partition['file_path']) for partition in sink.partitions.values())
+    finally:
+        sink.close()
+
+        for partition in sink.partitions.values():
+            if os.path.exists(partition['file_path']):
+                os.remove(partition['file_path'])
+
+    print(f"Wrote {row_count} rows to {len(sink.partitions)} partitions under s3://{bucket}/{os.path.dirname(key)}")
+
+    return row_count, last_processed_date, [(partition['key'], partition['rows']) for partition in sink.partitions.values()]
+
+def export_frames(frames, table_name, file_name, s3_client, allow_empty=False, dedup_index=None, run_manifest=None, pushdown=False, commit_dedup=True):
+    file_format, compression = get_output_format(table_name)
+    extension = get_file_extension(file_format, compression)
+
+    # Check the first chunk before anything is written so invalid data goes straight to the error bucket
+    first_frame = next(frames, None)
+
+    if allow_empty and (first_frame is None or first_frame.empty):
+        print(f"No rows for {file_name}")
+        return True, 0, None
+
+    valid = first_frame is not None and not first_frame.empty and has_valid_structure(table_name, first_frame)
+
+    if first_frame is not None:
+        frames = itertools.chain([first_frame], frames)
+
+    if not valid:
+        print(f"No data to process for {table_name} or invalid structure")
+        write_frames_to_s3(frames, s3_client, os.getenv('AWS_S3_ERROR_BUCKET_NAME'), f'{file_name}_empty_or_invalid_stricture.{extension}', file_format, compression)
+        return False, 0, None
+
+    # Clean and upload query results, chunk by chunk in streaming mode
+    structure = table_registry.get_table(table_name)
+    key = os.getenv('AWS_S3_FOLDER_PATH') + '/' + file_name
+    partition_columns = structure.partition_by if structure and s3_layout.get_layout() == 'hive' else []
+
+    if partition_columns:
+        row_count, last_processed_date, objects = write_partitioned_frames_to_s3(frames, s3_client, os.getenv('AWS_S3_BUCKET_NAME'), key, partition_columns, file_format, compression, dedup_index, structure, pushdown)
+    else:
+        row_count, last_processed_date = write_frames_to_s3(frames, s3_client, os.getenv('AWS_S3_BUCKET_NAME'), key, file_format, compression, dedup_index, structure, pushdown)
+        objects = [(key, row_count)]
+
+    print(f"Uploaded {table_name} data to S3 at {file_name}")
+
+    # Callers exporting side by side into one index commit it themselves once every export landed
+    if dedup_index is not None and commit_dedup:
+        dedup_index.commit()
+
+    if run_manifest is not None:
+        run_manifest.add(table_name, objects)
+
+    return True, row_count, last_processed_date
+
+def copy_to_file(cursor, copy_query, file, compression=None):
+    stream = open_compressed_stream(file, compression)
+
+    # psycopg2 hands the server's CSV bytes straight to the file, no rows are built in Python
+    cursor.copy_expert(copy_query, stream or file)
+
+    if stream is not None:
+        stream.close()
+
+    return cursor.rowcount
+
+def copy_to_s3(cursor, copy_query, s3_client, bucket, key, compression=None):
+    if os.getenv('S3_UPLOAD_MODE') == 'multipart':
+        writer = S3MultipartWriter(s3_client, bucket, key, *get_multipart_settings())
+
+        try:
+            row_count = copy_to_file(cursor, copy_query, writer, compression)
+            writer.close()
+        except Exception:
+            writer.abort()
+            raise
+
+        return row_count, writer.bytes_written
+
+    # Hive keys end in the same part-{timestamp} name for every table, tables ingested side by side must not share a file
+    file_path = f"/tmp/{uuid.uuid4().hex}_{os.path.basename(key)}"
+
+    try:
+        with open(file_path, 'wb') as file:
+            row_count = copy_to_file(cursor, copy_query, file, compression)
+
+        s3_client.upload_file(file_path, bucket, key)
+
+        return row_count, os.path.getsize(file_path)
+    finally:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+def export_copy(engine, table_name, latest_processed_date, file_name, s3_client, run_manifest=None):
+    structure = table_registry.get_table(table_name)
+    file_format, compression = get_output_format(table_name)
+
+    if file_format != 'csv':
+        raise ValueError(f"The copy engine writes CSV only, {table_name} is configured for {file_format}")
+
+    if not structure.required_columns:
+        raise ValueError(f"The copy engine needs required_columns for {table_name}")
+
+    if structure.partition_by and s3_layout.get_layout() == 'hive':
+        print(f"The copy engine writes one object, partition_by is not applied to {table_name}")
+
+    copy_query, watermark_query, params = create_copy_queries(table_name, latest_processed_date)
+    bucket = os.getenv('AWS_S3_BUCKET_NAME')
+    key = os.getenv('AWS_S3_FOLDER_PATH') + '/' + file_name
+    recorder = metrics.get_recorder(MODULE_NAME, table_name)
+
+    connection = engine.raw_connection()
+
+    try:
+        cursor = connection.cursor()
+
+        # Both statements read one snapshot, rows committed while the COPY runs are left for the next run
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+
+        with recorder.time('query'):
+            cursor.execute(watermark_query, params)
+            last_processed_date = cursor.fetchone()[0]
+
+        if last_processed_date is None:
+            print(f"No new rows for {table_name}")
+            return True, 0, None
+
+        print(f"Copying {table_name} to s3://{bucket}/{key}")
+
+        with recorder.time('copy') as counts:
+            row_count, counts['bytes'] = copy_to_s3(cursor, cursor.mogrify(copy_query, params).decode('utf-8'), s3_client, bucket, key, compression)
+            counts['rows'] = row_count
+    finally:
+        # Returning the connection to the pool rolls the read-only transaction back
+        connection.close()
+
+    print(f"Copied {row_count} rows for {table_name}")
+
+    if run_manifest is not None:
+        run_manifest.add(table_name, [(key, row_count)])
+
+    return True, row_count, last_processed_date
+
+def reject_columns(table_name, columns, file_name, s3_client):
+    file_format, compression = get_output_format(table_name)
+    extension = get_file_extension(file_format, compression)
+
+    # Only the header is shipped, no rows were fetched for an invalid table
+    print(f"Invalid structure for {table_name}, skipping extract")
+    write_frames_to_s3(iter([pd.DataFrame(columns=columns)]), s3_client, os.getenv('AWS_S3_ERROR_BUCKET_NAME'), f'{file_name}_empty_or_invalid_stricture.{extension}', file_format, compression)
+
+def export_query(conn, table_name, query, file_name, s3_client, chunk_size=None, params=None, allow_empty=False, dedup_index=None, run_manifest=None, pushdown=False, commit_dedup=True):
+    recorder = metrics.get_recorder(MODULE_NAME, table_name)
+
+    with recorder.time('query'):
+        result = execute_query(conn, query, chunk_size, params)
+
+    columns = list(result.keys())
+
+    if not has_valid_columns(table_name, columns):
+        result.close()
+        reject_columns(table_name, columns, file_name, s3_client)
+        return False, 0, None
+
+    quarantine = get_quarantine(table_name, file_name, s3_client)
+    frames = recorder.time_iter('fetch', read_data_frames(result, chunk_size, get_column_types(table_name), quarantine))
+
+    # With row rules an empty result is not an error, the rows may all have been quarantined
+    valid, row_count, last_processed_date = export_frames(frames, table_name, file_name, s3_client, allow_empty or quarantine is not None, dedup_index, run_manifest, pushdown, commit_dedup)
+
+    if valid and quarantine is not None:
+        quarantine.commit()
+
+    return valid, row_count, last_processed_date
+
+def export_with_checkpoints(engine, table_name, watermark, s3_client, dynamo_db_client, file_prefix, extension, chunk_size, dedup_index=None, run_manifest=None):
+    primary_key = get_primary_key(table_name)
+    latest_processed_date = watermark['processed_date']
+    checkpoint = watermark.get('checkpoint')
+
+    # A checkpoint only applies to the watermark it was taken against
+    cursor = checkpoint if checkpoint and checkpoint['base'] == latest_processed_date else None
+
+    if cursor:
+        print(f"Resuming {table_name} after checkpoint {cursor['created_at']} {cursor['key']}")
+
+    chunk_index = 0
+    row_count = 0
+    recorder = metrics.get_recorder(MODULE_NAME, table_name)
+
+    with engine.connect() as conn:
+        while True:
+            query, params = create_keyset_query(table_name, primary_key, latest_processed_date, cursor, chunk_size)
+
+            with recorder.time('query'):
+                result = execute_query(conn, query, chunk_size, params)
+
+            if chunk_index == 0 and not has_valid_columns(table_name, result.keys()):
+                columns = list(result.keys())
+                result.close()
+                reject_columns(table_name, columns, f"{file_prefix}_chunk-{chunk_index:05d}.{extension}", s3_client)
+                return False, row_count, None
+
+            file_name = f"{file_prefix}_chunk-{chunk_index:05d}.{extension}"
+            quarantine = get_quarantine(table_name, file_name, s3_client)
+
+            with recorder.time('fetch') as counts:
+                raw = next(read_data_frames(result, keep_objects=quarantine is not None))
+                counts['rows'] = len(raw)
+
+            if raw.empty:
+                break
+
+            # Take the cursor from the raw rows, cleaning may rewrite key values and quarantine may drop the last row
+            next_cursor = {
+                'base': latest_processed_date,
+                'created_at': str(raw['created_at'].iloc[-1]),
+                'key': raw[primary_key].iloc[-1].tolist(),
+            }
+
+            frame = prepare_frame(raw, get_column_types(table_name), quarantine)
+
+            # Every chunk lands as its own object so finished chunks survive a timeout
+            valid, chunk_rows, _ = export_frames(iter([frame]), table_name, file_name, s3_client, allow_empty=quarantine is not None, dedup_index=dedup_index, run_manifest=run_manifest)
+
+            if not valid:
+                return False, row_count, None
+
+            if quarantine is not None:
+                quarantine.commit()
+
+            cursor = next_cursor
+            save_checkpoint(table_name, latest_processed_date, cursor['created_at'], cursor['key'], dynamo_db_client)
+
+            chunk_index += 1
+            row_count += chunk_rows
+
+            if len(raw) < chunk_size:
+                break
+
+    print(f"Exported {row_count} rows for {table_name} in {chunk_index} checkpointed chunks")
+
+    # Rows are in created_at order, so the final cursor holds the newest created_at
+    return True, row_count, cursor['created_at'] if cursor else None
+
+def export_range(engine, table_name, query, params, file_name, s3_client, chunk_size=None, dedup_index=None, run_manifest=None, pushdown=False):
+    with engine.connect() as conn:
+        # The ranges share one dedup index, backfill_table commits it once all of them landed
+        return export_query(conn, table_name, query, file_name, s3_client, chunk_size, params, allow_empty=True, dedup_index=dedup_index, run_manifest=run_manifest, pushdown=pushdown, commit_dedup=False)
+
+def backfill_table(table_name, engine, s3_client, file_prefix, extension, chunk_size=None, dedup_index=None, run_manifest=None):
+    range_count = int(os.getenv('BACKFILL_RANGES') or 1)
+    max_workers = int(os.getenv('BACKFILL_MAX_WORKERS') or 4)
+    pushdown = is_pushdown_enabled(table_name)
+
+    with engine.connect() as conn:
+        ranges = get_backfill_ranges(conn, table_name, range_count, os.getenv('BACKFILL_STRATEGY') or 'time')
+
+    print(f"Backfilling {table_name} in {len(ranges)} created_at ranges")
+
+    # Every range is extracted over its own connection and lands as its own S3 part
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                export_range,
+                engine,
+                table_name,
+                create_range_query(table_name, index == 0, index == len(ranges) - 1, pushdown),
+                {'low': low, 'high': high},
+                f"{file_prefix}_part-{index:04d}.{extension}",
+                s3_client,
+                chunk_size,
+                dedup_index,
+                run_manifest,
+                pushdown
+            )
+            for index, (low, high) in enumerate(ranges)
+        ]
+
+        # Any failed range raises here, before the watermark can move
+        results = [future.result() for future in futures]
+
+    row_count = sum(count for _, count, _ in results)
+
+    # Every range rejected its header to the error bucket, the table is skipped like any invalid extract and keeps no watermark
+    if not all(valid for valid, _, _ in results):
+        print(f"Invalid structure for {table_name}, skipping backfill")
+        return False, row_count, None
+
+    # Pending fingerprints of every range are saved together, a range failing above leaves the index untouched
+    if dedup_index is not None:
+        dedup_index.commit()
+
+    dates = [last for _, _, last in results if last is not None]
+
+    print(f"Backfilled {row_count} rows for {table_name}")
+
+    return True, row_count, max(dates) if dates else None
+
+def ingest_table(table_name, engine, s3_client, dynamo_db_client, watermark, timestamp, chunk_size=None, run_manifest=None):
+    file_format, compression = get_output_format(table_name)
+    extension = get_file_extension(file_format, compression)
+    file_prefix = s3_layout.get_file_prefix(table_name, timestamp)
+
+    print(f"Processing table: {table_name}")    
+
+    latest_processed_date = watermark['processed_date']
+    structure = table_registry.get_table(table_name)
+
+    if structure is not None and structure.extract_mode == 'snapshot':
+        # Dimensions are diffed against the last emitted snapshot, the created_at watermark plays no part
+        export_snapshot_diff(engine, table_name, f"{file_prefix}.{extension}", s3_client, chunk_size, run_manifest)
+        return
+
+    dedup_index = get_dedup_index(table_name, s3_client)
+
+    if structure is not None and structure.engine == 'copy':
+        # Rows never reach pandas, so the dedup index and checkpoints do not apply
+        valid, row_count, last_processed_date = export_copy(engine, table_name, latest_processed_date, f"{file_prefix}.{extension}", s3_client, run_manifest)
+    elif latest_processed_date is None and 'checkpoint' not in watermark and int(os.getenv('BACKFILL_RANGES') or 1) > 1:
+        valid, row_count, last_processed_date = backfill_table(table_name, engine, s3_client, file_prefix, extension, chunk_size, dedup_index, run_manifest)
+    elif chunk_size and os.getenv('INGEST_CHECKPOINTS') == 'true' and get_primary_key(table_name):
+        valid, row_count, last_processed_date = export_with_checkpoints(engine, table_name, watermark, s3_client, dynamo_db_client, file_prefix, extension, chunk_size, dedup_index, run_manifest)
+    else:
+        # With the dedup index in place rows sharing the watermark's timestamp are re-read instead of skipped
+        pushdown = is_pushdown_enabled(table_name)
+        query, params = create_query(table_name, latest_processed_date, inclusive=dedup_index is not None, pushdown=pushdown)
+
+        with engine.connect() as conn:
+            valid, row_count, last_processed_date = export_query(conn, table_name, query, f"{file_prefix}.{extension}", s3_client, chunk_size, params, dedup_index=dedup_index, run_manifest=run_manifest, pushdown=pushdown)
+
+    if not valid:
+        return
+
+    last_processed_date = str(last_processed_date) if last_processed_date is not None else None
+    print(f"Last processed date for {table_name}: {last_processed_date}")
+
+    if last_processed_date is None:
+        print(f"No valid created_at values for {table_name}, keeping previous processed date")
+        return
+
+    mark_last_processed_date(table_name, last_processed_date, dynamo_db_client)
+
+def init_ingest_worker(worker_slots):
+    # Number each pool thread so its boto3 clients can be reused by the same slot on warm invocations
+    worker_state.slot = next(worker_slots)
+
+def ingest_table_worker(table_name, engine, watermark, timestamp, chunk_size=None, run_manifest=None):
+    # Each worker gets its own boto3 clients and checks connections out of the shared pool
+    scope = f"ingest-worker-{worker_state.slot}"
+    dynamo_db_client = get_service_client(os.getenv('AWS_DYNAMODB'), scope)
+    s3_client = get_service_client(os.getenv('AWS_S3'), scope)
+
+    ingest_table(table_name, engine, s3_client, dynamo_db_client, watermark, timestamp, chunk_size, run_manifest)
+
+def upload_to_s3_concurrently(engine, table_names, watermarks, max_workers, timestamp, chunk_size=None, run_manifest=None):
+    failed_tables = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers, initializer=init_ingest_worker, initargs=(itertools.count(),)) as executor:
+        futures = {
+            executor.submit(ingest_table_worker, table_name, engine, watermarks[table_name], timestamp, chunk_size, run_manifest): table_name
+            for table_name in table_names
+        }
+
+        for future in as_completed(futures):
+            table_name = futures[future]
+
+            # A failing table is recorded and the remaining tables keep going
+            try:
+                future.result()
+                print(f"Finished ingesting table: {table_name}")
+            except Exception as e:
+                print(f"Error ingesting table {table_name}: {e}")
+                failed_tables[table_name] = e
+
+    if failed_tables:
+        raise Exception(f"Ingestion failed for tables: {', '.join(sorted(failed_tables))}")
+
+def upload_to_s3(conn):
+    file_structures = table_registry.get_tables()
+
+    print("File structures:", file_structures.keys())
+
+    # Rows fetched per round trip in streaming mode, unset or 0 fetches the whole table at once
+    chunk_size = int(os.getenv('INGEST_CHUNK_SIZE') or 0)
+
+    # Number of tables ingested in parallel, unset or 1 processes them one at a time
+    max_workers = int(os.getenv('INGEST_MAX_WORKERS') or 1)
+
+    dynamo_db_client = get_service_client(os.getenv('AWS_DYNAMODB'))
+
+    # Read every table's watermark in one round trip up front
+    with metrics.get_recorder(MODULE_NAME, 'all').time('watermark_lookup') as counts:
+        watermarks = get_watermarks(list(file_structures.keys()), dynamo_db_client)
+        counts['rows'] = len(watermarks)
+
+    # Taken per invocation, a warm container reusing an import-time value would overwrite the previous run's files
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+
+    s3_client = get_service_client(os.getenv('AWS_S3'))
+
+    # Every object written this run is listed in the run's manifest parts, downstream jobs read them instead of listing the raw folder
+    run_manifest = s3_layout.RunManifest(f"{timestamp}_{uuid.uuid4().hex[:8]}", s3_client, os.getenv('AWS_S3_BUCKET_NAME'))
+
+    if max_workers > 1:
+        upload_to_s3_concurrently(conn, list(file_structures.keys()), watermarks, max_workers, timestamp, chunk_size, run_manifest)
+    else:
+        for table_name in file_structures.keys():
+            ingest_table(table_name, conn, s3_client, dynamo_db_client, watermarks[table_name], timestamp, chunk_size, run_manifest)
 
-        mark_last_processed_date(table_name, last_processed_date, dynamo_db_client)
+    print(f"Listed {len(run_manifest.entries)} objects in {run_manifest.parts} run manifest parts")
 
+@metrics.profiled(MODULE_NAME)
 def lambda_handler(event, context):
     try:
-        secret = get_secret(os.getenv('AWS_SOURCE_DB_CREDENTIALS'))
-        secret = json.loads(secret)  # Convert JSON string to dictionary
+        # Size the connection pool so every ingestion worker can hold a connection per backfill range worker
+        max_workers = max(int(os.getenv('INGEST_MAX_WORKERS') or 1), 1)
+        backfill_workers = max(int(os.getenv('BACKFILL_MAX_WORKERS') or 4), 1) if int(os.getenv('BACKFILL_RANGES') or 1) > 1 else 1
 
-        conn = get_db_connection(secret)
+        conn = get_source_engine(pool_size=max_workers * backfill_workers)
         
         upload_to_s3(conn)
 
     except Exception as e:
         print(f"Error in handler: {e}")
         raise e
+    finally:
+        metrics.flush()
     
     return {
         'statusCode': 200,
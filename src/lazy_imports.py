@@ -0,0 +1,22 @@
+import importlib
+import types
+
+class LazyModule(types.ModuleType):
+    # Stands in for a module until one of its attributes is first read, the real import happens then
+    def __getattr__(self, attribute):
+        module = self.__dict__.get('_module')
+
+        if module is None:
+            # The import system's per-module lock makes a first use from several threads safe
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_module'] = module
+
+        return getattr(module, attribute)
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__.get('_module') is not None else 'not loaded'
+        return f"<lazy module '{self.__name__}' ({state})>"
+
+def lazy_import(name):
+    # Cold starts only pay for the libraries the invocation's code path actually touches
+    return LazyModule(name)
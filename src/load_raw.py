@@ -1,11 +1,19 @@
+import datetime
+import itertools
 import logging
 import json
 import os
-
-import boto3
+import re
+import time
+import uuid
+from urllib.parse import unquote_plus
 
 import traceback
 
+import metrics
+import resource_cache
+import table_registry
+
 def get_test_event():
     with open('./load_raw_test.json', 'r') as file:
         data = file.read()
@@ -13,68 +21,391 @@ def get_test_event():
     
     return None
 
-def get_copy_query(file_name):
-    file_structures = json.loads(os.getenv('FILE_STRUCTURES'))
+def get_target_table(copy_query):
+    match = re.match(r"\s*copy\s+(\S+)\s+from\s", copy_query, re.IGNORECASE)
 
-    for prefix in file_structures.keys():
-        if file_name.startswith(prefix):
-            query = file_structures[prefix]['copy_query']
-            s3uri = f"'s3://{os.getenv('AWS_S3_BUCKET_NAME')}/{os.getenv('AWS_S3_FOLDER_PATH')}/{file_name}'"
-            
-            query = query.replace('s3uri', s3uri)
-            query = query.replace('iamrole', f"'{os.getenv('AWS_REDSHIFT_ROLE_ARN')}'")
+    if not match:
+        raise ValueError(f"Could not find target table in copy query: {copy_query}")
 
-            return query
-            
-    return None
+    return match.group(1)
+
+def get_parquet_copy_query(copy_query):
+    # Reuse the target table of the configured CSV COPY, Parquet needs no parsing options
+    return f"copy {get_target_table(copy_query)} from s3uri iam_role iamrole format as parquet;"
+
+# COPY options for compressed CSV objects, keyed by file name extension
+COMPRESSION_OPTIONS = {
+    '.gz': 'gzip',
+    '.zst': 'zstd',
+}
+
+def add_copy_option(query, option):
+    return query.rstrip().rstrip(';') + f" {option};"
+
+def get_file_type(file_name):
+    if file_name.endswith('.parquet'):
+        return '.parquet'
+
+    for extension in COMPRESSION_OPTIONS:
+        if file_name.endswith(extension):
+            return extension
+
+    return ''
+
+def compile_copy_template(query, file_type):
+    if file_type == '.parquet':
+        return get_parquet_copy_query(query)
+
+    if file_type in COMPRESSION_OPTIONS:
+        return add_copy_option(query, COMPRESSION_OPTIONS[file_type])
+
+    return query
+
+def get_copy_template(key):
+    structure = table_registry.match_key(key)
+
+    if structure is None or not structure.copy_query:
+        return None
+
+    # A template only depends on the table and the file type, so each is built once per process
+    file_type = get_file_type(key)
+
+    if file_type not in structure.copy_templates:
+        structure.copy_templates[file_type] = compile_copy_template(structure.copy_query, file_type)
+
+    return structure.copy_templates[file_type]
+
+def render_copy_query(query, s3uri, manifest=False):
+    if manifest:
+        query = add_copy_option(query, 'manifest')
+
+    query = query.replace('s3uri', f"'{s3uri}'")
+    query = query.replace('iamrole', f"'{os.getenv('AWS_REDSHIFT_ROLE_ARN')}'")
+
+    return query
 
 def get_service_client(service_name):
-    session = boto3.session.Session()    
-        
-    if os.getenv('ENVIRONMENT') == 'development':
-        client = session.client(
-            service_name=service_name,
-            region_name=os.getenv('AWS_REGION_NAME'),
-            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-        )
-    else:
-        client = session.client(
-            service_name=service_name,
-            region_name=os.getenv('AWS_REGION_NAME')
+    # Clients are cached across warm invocations
+    return resource_cache.get_client(service_name)
+
+def get_s3_records(event):
+    s3_records = []
+
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            # S3 notifications buffered through SQS arrive as a batch collected over the queue's batching window
+            body = json.loads(record['body'])
+            s3_records.extend((record['messageId'], s3_record) for s3_record in body.get('Records', []))
+        elif record.get('eventSource') == 'aws:s3':
+            s3_records.append((None, record))
+
+    return [
+        {
+            'message_id': message_id,
+            'bucket': s3_record['s3']['bucket']['name'],
+            'key': unquote_plus(s3_record['s3']['object']['key']),
+            'size': s3_record['s3']['object'].get('size', 0),
+        }
+        for message_id, s3_record in s3_records
+    ]
+
+def group_records(s3_records):
+    # Files sharing a COPY template go to the same table with the same options and can load together
+    groups = {}
+
+    for s3_record in s3_records:
+        template = get_copy_template(s3_record['key'])
+
+        if template is None:
+            print(f"No file structure matches {s3_record['key']}, skipping")
+            continue
+
+        groups.setdefault(template, []).append(s3_record)
+
+    return groups
+
+def write_copy_manifest(s3_client, template, s3_records):
+    bucket = os.getenv('AWS_S3_BUCKET_NAME')
+    manifest_folder = os.getenv('AWS_S3_MANIFEST_FOLDER_PATH') or 'manifests'
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    key = f"{manifest_folder}/{get_target_table(template)}_{timestamp}_{uuid.uuid4().hex[:8]}.manifest"
+
+    # content_length is required for Parquet and lets Redshift split work without listing objects
+    manifest = {
+        'entries': [
+            {
+                'url': f"s3://{s3_record['bucket']}/{s3_record['key']}",
+                'mandatory': True,
+                'meta': {'content_length': s3_record['size']},
+            }
+            for s3_record in s3_records
+        ]
+    }
+
+    s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode('utf-8'))
+
+    print(f"Wrote COPY manifest for {len(s3_records)} files to s3://{bucket}/{key}")
+
+    return f"s3://{bucket}/{key}"
+
+# Data API statement states that still hold a slot on the workgroup
+IN_FLIGHT_STATUSES = ['SUBMITTED', 'PICKED', 'STARTED']
+
+class StatementTracker:
+    def __init__(self, redshift_client, max_in_flight=4, timeout=600):
+        self.redshift_client = redshift_client
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.in_flight = {}
+        self.results = {}
+
+    def count_workgroup_in_flight(self):
+        # Statements started by other invocations on the same workgroup count against the cap too, other workgroups have their own slots
+        count = 0
+
+        for status in IN_FLIGHT_STATUSES:
+            response = self.redshift_client.list_statements(
+                Status=status,
+                RoleLevel=True,
+                WorkgroupName=os.getenv("AWS_REDSHIFT_WORKGROUP_NAME"),
+                MaxResults=self.max_in_flight + len(self.in_flight)
+            )
+            count += len([statement for statement in response.get('Statements', []) if statement['Id'] not in self.in_flight])
+
+        return count + len(self.in_flight)
+
+    def wait_for_slot(self):
+        deadline = time.monotonic() + self.timeout
+        delay = 0.25
+
+        while self.count_workgroup_in_flight() >= self.max_in_flight:
+            if time.monotonic() > deadline:
+                raise Exception(f"Timed out waiting for a free Redshift statement slot after {self.timeout}s")
+
+            print(f"{self.max_in_flight} Redshift statements in flight, waiting {delay}s for a free slot")
+            time.sleep(delay)
+            delay = min(delay * 2, 5)
+
+            self.poll()
+
+    def submit(self, sqls):
+        self.wait_for_slot()
+
+        for sql in sqls:
+            print(f'Executing Redshift copy command for file: {sql}')
+
+        statement_args = {
+            'WorkgroupName': os.getenv("AWS_REDSHIFT_WORKGROUP_NAME"),  # Redshift Serverless Workgroup ARN
+            'SecretArn': os.getenv("AWS_REDSHIFT_SECRET_ARN"),      # Secrets Manager ARN
+            'Database': os.getenv("AWS_REDSHIFT_DB"),               # DB name inside Redshift
+        }
+
+        # Several pending COPYs go in one batch statement, which Redshift runs as one transaction
+        if len(sqls) == 1:
+            response = self.redshift_client.execute_statement(Sql=sqls[0], **statement_args)
+        else:
+            response = self.redshift_client.batch_execute_statement(Sqls=sqls, **statement_args)
+
+        self.in_flight[response['Id']] = {'sqls': sqls, 'submitted_at': time.monotonic()}
+
+        return response['Id']
+
+    def record(self, statement_id, description):
+        submitted = self.in_flight.pop(statement_id)
+
+        # Batch statements report duration and rows per sub-statement
+        sub_statements = description.get('SubStatements') or [description]
+
+        result = {
+            'statement_id': statement_id,
+            'status': description['Status'],
+            'error': description.get('Error'),
+            'wall_seconds': round(time.monotonic() - submitted['submitted_at'], 3),
+            'statements': [
+                {
+                    'sql': sql,
+                    'status': sub_statement.get('Status'),
+                    'duration_ms': sub_statement.get('Duration', 0) / 1e6,
+                    'rows_loaded': sub_statement.get('ResultRows'),
+                }
+                for sql, sub_statement in zip(submitted['sqls'], sub_statements)
+            ],
+        }
+
+        print(json.dumps(result))
+
+        self.results[statement_id] = result
+
+    def poll(self):
+        for statement_id in list(self.in_flight):
+            description = self.redshift_client.describe_statement(Id=statement_id)
+
+            if description['Status'] in ('FINISHED', 'FAILED', 'ABORTED'):
+                self.record(statement_id, description)
+
+    def wait_all(self):
+        deadline = time.monotonic() + self.timeout
+        delay = 0.25
+
+        while self.in_flight:
+            self.poll()
+
+            if not self.in_flight:
+                break
+
+            if time.monotonic() > deadline:
+                raise Exception(f"Timed out waiting for Redshift statements: {', '.join(self.in_flight)}")
+
+            time.sleep(delay)
+            delay = min(delay * 2, 5)
+
+        return self.results
+
+def build_copy_query(s3_client, template, s3_records):
+    if len(s3_records) == 1:
+        s3_record = s3_records[0]
+        return render_copy_query(template, f"s3://{s3_record['bucket']}/{s3_record['key']}")
+
+    # One manifest COPY loads every file in parallel slices within a single transaction
+    manifest_uri = write_copy_manifest(s3_client, template, s3_records)
+
+    return render_copy_query(template, manifest_uri, manifest=True)
+
+def build_merge_queries(template, structure, s3_records):
+    # Snapshot change files are staged and applied by primary key, the raw table holds the current version of every row
+    target = get_target_table(template)
+    stage = f"{target.split('.')[-1]}_changes"
+    columns = ', '.join(structure.required_columns)
+    keys = ' AND '.join(f"{target}.{column} = {stage}.{column}" for column in structure.primary_key)
+    stage_template = re.sub(r"^\s*copy\s+\S+\s+from\s", f"copy {stage} from ", template, count=1, flags=re.IGNORECASE)
+
+    queries = [f"create temp table {stage} as select {columns}, cast(null as varchar(6)) as change_op from {target} limit 0;"]
+
+    # The run timestamp in the key puts a later run's changes last, its version of a row wins
+    for s3_record in sorted(s3_records, key=lambda s3_record: s3_record['key']):
+        queries += [
+            render_copy_query(stage_template, f"s3://{s3_record['bucket']}/{s3_record['key']}"),
+            f"delete from {target} using {stage} where {keys};",
+            f"insert into {target} ({columns}) select {columns} from {stage} where change_op <> 'delete';",
+            f"delete from {stage};",
+        ]
+
+    return queries + [f"drop table {stage};"]
+
+def record_copy_metrics(result, batch):
+    # A batch statement reports one sub-statement per query in submission order, a snapshot merge runs several per group
+    statements = iter(result['statements'])
+
+    for group, queries in batch:
+        group_statements = list(itertools.islice(statements, len(queries)))
+        copies = [statement for statement in group_statements if statement['sql'].lstrip().lower().startswith('copy')]
+        duration_ms = sum(statement['duration_ms'] for statement in group_statements)
+        recorder = metrics.get_recorder('load_raw', get_target_table(get_copy_template(group[0]['key'])))
+
+        recorder.add(
+            'copy',
+            duration_ms / 1000 if duration_ms else result['wall_seconds'],
+            rows=sum(statement['rows_loaded'] or 0 for statement in copies),
+            bytes=sum(s3_record['size'] for s3_record in group)
         )
-    
-    return client
 
+@metrics.profiled('load_raw')
 def lambda_handler(event, context):
     try:
         if os.getenv('ENVIRONMENT') =='development':
             event = get_test_event()
-    
-        object_key = event['Records'][0]['s3']['object']['key']
-        file_name = object_key.split('/')[1]
 
-        copy_sql_query = get_copy_query(file_name)
-
-        print(f'Executing Redshift copy command for file: {copy_sql_query}')
+        s3_records = get_s3_records(event)
+        groups = group_records(s3_records)
 
         redshift_client = get_service_client(os.getenv('AWS_REDSHIFT_DATA_API'))
-        response = redshift_client.execute_statement(
-            WorkgroupName=os.getenv("AWS_REDSHIFT_WORKGROUP_NAME"),  # Redshift Serverless Workgroup ARN
-            SecretArn=os.getenv("AWS_REDSHIFT_SECRET_ARN"),      # Secrets Manager ARN
-            Sql=copy_sql_query,                                  # Your COPY or INSERT SQL
-            Database=os.getenv("AWS_REDSHIFT_DB")                # DB name inside Redshift
+        s3_client = get_service_client(os.getenv('AWS_S3'))
+
+        tracker = StatementTracker(
+            redshift_client,
+            max_in_flight=int(os.getenv('REDSHIFT_MAX_IN_FLIGHT') or 4),
+            timeout=int(os.getenv('REDSHIFT_STATEMENT_TIMEOUT_SECONDS') or 600)
         )
+        batch_size = int(os.getenv('REDSHIFT_BATCH_SIZE') or 10)
+
+        failed_message_ids = set()
+        errors = []
+        pending = []
+        merges = []
+
+        # A failing table does not stop the other tables in the batch from loading
+        for template, group in groups.items():
+            try:
+                structure = table_registry.match_key(group[0]['key'])
+
+                if structure.extract_mode == 'snapshot':
+                    merges.append((group, build_merge_queries(template, structure, group)))
+                else:
+                    pending.append((group, [build_copy_query(s3_client, template, group)]))
+            except Exception as e:
+                logging.error(f"Error preparing COPY for {get_target_table(template)}: {e}")
+                errors.append(e)
+                failed_message_ids.update(s3_record['message_id'] for s3_record in group if s3_record['message_id'])
+
+        submitted = {}
+
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            submitted[tracker.submit([query for _, queries in batch for query in queries])] = batch
+
+        # A merge is a transaction of its own, a failing COPY batched with it would roll it back
+        for merge in merges:
+            submitted[tracker.submit(merge[1])] = [merge]
+
+        results = tracker.wait_all()
 
-        if (response['ResponseMetadata']['HTTPStatusCode'] != 200):
-            raise Exception(f"Failed to execute Redshift copy command: {response}")
+        # A batch statement is one transaction, a failing table rolls back every table batched with it.
+        # Members of a failed batch are retried one statement each so only the failing table is reported.
+        retried = set()
 
-        # Delete the local file after processing
-        if os.path.exists(file_name):
-            os.remove(file_name)
-        
-        # Upload the processed file to the raw table in Redshift
-        print(f'Loading data from {object_key} to Redshift...')
+        for statement_id, result in list(results.items()):
+            batch = submitted[statement_id]
+
+            if result['status'] == 'FINISHED' or len(batch) == 1:
+                continue
+
+            logging.warning(f"Redshift batch {statement_id} {result['status']}, retrying its {len(batch)} COPYs one at a time: {result['error']}")
+            retried.add(statement_id)
+
+            for group, queries in batch:
+                submitted[tracker.submit(queries)] = [(group, queries)]
+
+        if retried:
+            results = tracker.wait_all()
+
+        # COPY runs asynchronously, success is only known once the statement finishes
+        for statement_id, result in results.items():
+            if statement_id in retried:
+                continue
+
+            groups = [group for group, _ in submitted[statement_id]]
+            record_copy_metrics(result, submitted[statement_id])
+
+            if result['status'] == 'FINISHED':
+                for group in groups:
+                    for s3_record in group:
+                        print(f"Loaded data from {s3_record['key']} to Redshift")
+                continue
+
+            logging.error(f"Redshift statement {statement_id} {result['status']}: {result['error']}")
+            errors.append(Exception(result['error']))
+
+            for group in groups:
+                failed_message_ids.update(s3_record['message_id'] for s3_record in group if s3_record['message_id'])
+
+        # SQS batches report only the failed messages so the rest are not redelivered
+        if any(s3_record['message_id'] for s3_record in s3_records):
+            return {
+                'batchItemFailures': [{'itemIdentifier': message_id} for message_id in sorted(failed_message_ids)]
+            }
+
+        if errors:
+            raise Exception(f"{len(errors)} COPY statements failed")
 
         return {
             'statusCode': 200,
@@ -86,7 +417,7 @@ def lambda_handler(event, context):
 
         print(traceback.format_exc())
 
-        return {
-            'statusCode': 500,
-            'body': json.dumps(f"Lambda execution failed: {e}")
-        }
\ No newline at end of file
+        # Any return value counts as success, SQS would delete the whole batch and an S3 invocation would not be retried
+        raise e
+    finally:
+        metrics.flush()
@@ -0,0 +1,182 @@
+import contextlib
+import cProfile
+import datetime
+import functools
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+
+# Stage totals per (module, table), emitted as CloudWatch embedded metric format records on flush
+lock = threading.Lock()
+recorders = {}
+profiled_once = False
+
+METRIC_UNITS = {
+    'Duration': 'Milliseconds',
+    'Rows': 'Count',
+    'Bytes': 'Bytes',
+    'PeakMemory': 'Megabytes',
+}
+
+def get_peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux, the process high-water mark at the time of the call
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class StageRecorder:
+    def __init__(self, module, table_name):
+        self.module = module
+        self.table_name = table_name
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds, rows=0, bytes=0):
+        with self.lock:
+            totals = self.stages.setdefault(stage, {'seconds': 0.0, 'rows': 0, 'bytes': 0, 'calls': 0, 'peak_memory_mb': 0.0})
+
+            totals['seconds'] += seconds
+            totals['rows'] += rows or 0
+            totals['bytes'] += bytes or 0
+            totals['calls'] += 1
+            totals['peak_memory_mb'] = max(totals['peak_memory_mb'], get_peak_memory_mb())
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        # Callers fill in rows and bytes once they know them
+        counts = {'rows': 0, 'bytes': 0}
+        start_time = time.perf_counter()
+
+        try:
+            yield counts
+        finally:
+            self.add(stage, time.perf_counter() - start_time, counts['rows'], counts['bytes'])
+
+    def time_iter(self, stage, frames):
+        # Time spent waiting on each frame counts towards the stage, the consumer's time does not
+        frames = iter(frames)
+
+        while True:
+            start_time = time.perf_counter()
+            frame = next(frames, None)
+
+            if frame is None:
+                break
+
+            self.add(stage, time.perf_counter() - start_time, rows=len(frame))
+
+            yield frame
+
+def get_recorder(module, table_name):
+    with lock:
+        if (module, table_name) not in recorders:
+            recorders[(module, table_name)] = StageRecorder(module, table_name)
+
+        return recorders[(module, table_name)]
+
+def create_record(module, table_name, stage, totals):
+    return {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [
+                {
+                    'Namespace': os.getenv('METRICS_NAMESPACE') or 'RestaurantFranchiseELT',
+                    'Dimensions': [['Module', 'Stage'], ['Module', 'Table', 'Stage']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, unit in METRIC_UNITS.items()],
+                }
+            ],
+        },
+        'Module': module,
+        'Table': table_name,
+        'Stage': stage,
+        'Duration': round(totals['seconds'] * 1000, 3),
+        'Rows': totals['rows'],
+        'Bytes': totals['bytes'],
+        'PeakMemory': round(totals['peak_memory_mb'], 1),
+        'Calls': totals['calls'],
+    }
+
+def flush():
+    with lock:
+        pending = list(recorders.values())
+        recorders.clear()
+
+    # Lambda ships stdout to CloudWatch Logs, which extracts metrics from lines carrying the _aws block
+    for recorder in pending:
+        for stage, totals in recorder.stages.items():
+            print(json.dumps(create_record(recorder.module, recorder.table_name, stage, totals)))
+
+def write_profile(name, file_path):
+    output = os.getenv('PROFILE_OUTPUT') or '/tmp/profiles'
+
+    if not output.startswith('s3://'):
+        print(f"Wrote {name} profile to {file_path}")
+        return
+
+    # Only needed when profiles go to S3, resource_cache pulls in boto3
+    import resource_cache
+
+    bucket, _, prefix = output.replace('s3://', '', 1).partition('/')
+    key = '/'.join(filter(None, [prefix.rstrip('/'), os.path.basename(file_path)]))
+
+    resource_cache.get_client('s3').upload_file(file_path, bucket, key)
+
+    print(f"Uploaded {name} profile to s3://{bucket}/{key}")
+
+def get_profile_path(name, extension):
+    output = os.getenv('PROFILE_OUTPUT') or '/tmp/profiles'
+    directory = '/tmp' if output.startswith('s3://') else output
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+
+    os.makedirs(directory, exist_ok=True)
+
+    return os.path.join(directory, f"{name}_{timestamp}.{extension}")
+
+def profiled(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            global profiled_once
+
+            mode = os.getenv('PROFILE_MODE')
+
+            # Only the first invocation of a warm container is profiled, the rest run at full speed
+            with lock:
+                enabled = mode in ('cprofile', 'tracemalloc') and not profiled_once
+                profiled_once = profiled_once or enabled
+
+            if not enabled:
+                return function(*args, **kwargs)
+
+            if mode == 'cprofile':
+                profiler = cProfile.Profile()
+
+                try:
+                    return profiler.runcall(function, *args, **kwargs)
+                finally:
+                    file_path = get_profile_path(name, 'prof')
+                    profiler.dump_stats(file_path)
+                    write_profile(name, file_path)
+
+            tracemalloc.start(int(os.getenv('TRACEMALLOC_FRAMES') or 10))
+
+            try:
+                return function(*args, **kwargs)
+            finally:
+                snapshot = tracemalloc.take_snapshot()
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                print(f"tracemalloc {name}: peak traced memory {peak / 1024 / 1024:.1f} MB")
+
+                for statistic in snapshot.statistics('lineno')[:10]:
+                    print(f"tracemalloc {name}: {statistic}")
+
+                file_path = get_profile_path(name, 'tracemalloc')
+                snapshot.dump(file_path)
+                write_profile(name, file_path)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import lazy_imports
+
+# boto3 alone costs a noticeable share of a cold start, it loads with the first client
+boto3 = lazy_imports.lazy_import('boto3')
+
+# Resources kept at module level survive across warm Lambda invocations
+lock = threading.RLock()
+clients = {}
+engines = {}
+process_pools = {}
+secret_cache = None
+
+def get_fingerprint(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def create_client(service_name):
+    if not service_name:
+        raise ValueError("Environment variable for service name is not set.")
+
+    # Sessions are not thread safe, every client gets its own
+    session = boto3.session.Session()
+
+    if os.getenv('ENVIRONMENT') == 'development':
+        client = session.client(
+            service_name=service_name,
+            region_name=os.getenv('AWS_REGION_NAME'),
+            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
+        )
+    else:
+        client = session.client(
+            service_name=service_name,
+            region_name=os.getenv('AWS_REGION_NAME')
+        )
+
+    return client
+
+def get_client(service_name, scope=None):
+    # Static development credentials are part of the fingerprint so rotated keys get a new client
+    fingerprint = get_fingerprint([
+        os.getenv('ENVIRONMENT'),
+        os.getenv('AWS_REGION_NAME'),
+        os.getenv('AWS_ACCESS_KEY_ID'),
+        os.getenv('AWS_SECRET_ACCESS_KEY'),
+    ])
+
+    with lock:
+        entry = clients.get((service_name, scope))
+
+        if entry is None or entry[0] != fingerprint:
+            if entry is not None:
+                print(f"Credentials changed, rebuilding {service_name} client")
+
+            entry = (fingerprint, create_client(service_name))
+            clients[(service_name, scope)] = entry
+
+    return entry[1]
+
+def get_secret_cache():
+    global secret_cache
+
+    with lock:
+        if secret_cache is None:
+            # Only the ingestion image ships the caching library
+            from aws_secretsmanager_caching import SecretCache, SecretCacheConfig
+
+            cache_config = SecretCacheConfig(
+                secret_refresh_interval=int(os.getenv('SECRET_CACHE_TTL_SECONDS') or 3600)
+            )
+
+            secret_cache = SecretCache(config=cache_config, client=get_client(os.getenv('AWS_SECRETS_MANAGER')))
+
+    return secret_cache
+
+def get_secret(secret_name, refresh=False):
+    cache = get_secret_cache()
+
+    if refresh:
+        print(f"Refreshing cached secret: {secret_name}")
+        cache.refresh_secret_now(secret_name)
+
+    return cache.get_secret_string(secret_id=secret_name)
+
+def get_engine(secret_name, create_engine):
+    secret = get_secret(secret_name)
+    fingerprint = get_fingerprint(secret)
+
+    with lock:
+        entry = engines.get(secret_name)
+
+        # A changed secret means the credentials rotated, pooled connections use the old ones
+        if entry is not None and entry[0] != fingerprint:
+            print(f"Credentials for {secret_name} rotated, rebuilding database engine")
+            entry[1].dispose()
+            entry = None
+
+        if entry is None:
+            entry = (fingerprint, create_engine(json.loads(secret)))
+            engines[secret_name] = entry
+
+    return entry[1]
+
+def get_process_pool(max_workers):
+    with lock:
+        if max_workers not in process_pools:
+            # Spawned workers start clean, forking a process that runs boto3 and pool threads is not safe
+            context = multiprocessing.get_context('spawn')
+            process_pools[max_workers] = ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+
+    return process_pools[max_workers]
+
+def discard_process_pool(max_workers):
+    with lock:
+        pool = process_pools.pop(max_workers, None)
+
+    # A broken pool refuses new work for good, the next get_process_pool starts a fresh one
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
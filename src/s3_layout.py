@@ -0,0 +1,100 @@
+import datetime
+import json
+import os
+import threading
+from urllib.parse import quote, unquote
+
+# Partition value for nulls, the name Hive and Athena use
+DEFAULT_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+def get_layout():
+    # flat: AWS_S3_FOLDER_PATH/{table}_{timestamp}.csv, hive: AWS_S3_FOLDER_PATH/table=/ingest_date=/[restaurant_id=/]part-{timestamp}.csv
+    layout = os.getenv('S3_LAYOUT') or 'flat'
+
+    if layout not in ('flat', 'hive'):
+        raise ValueError(f"Unsupported S3 layout: {layout}")
+
+    return layout
+
+def get_file_prefix(table_name, timestamp):
+    if get_layout() == 'hive':
+        return f"table={table_name}/ingest_date={timestamp[:10]}/part-{timestamp}"
+
+    return f"{table_name}_{timestamp}"
+
+def add_partition(key, values):
+    # Partition folders go between the key's folder and its file name
+    folder, _, file_name = key.rpartition('/')
+    partitions = '/'.join(f"{name}={quote(str(value), safe='')}" for name, value in values.items())
+
+    return '/'.join(filter(None, [folder, partitions, file_name]))
+
+def parse_partition_values(key):
+    return {name: unquote(value) for name, _, value in (part.partition('=') for part in key.split('/')[:-1] if '=' in part)}
+
+def get_manifest_folder():
+    return os.getenv('AWS_S3_RUN_MANIFEST_FOLDER_PATH') or '_manifests'
+
+class RunManifest:
+    def __init__(self, run_id, s3_client, bucket):
+        self.run_id = run_id
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.entries = []
+        self.parts = 0
+        self.lock = threading.Lock()
+
+    def add(self, table_name, objects):
+        # Every export is written as its own manifest part as soon as its objects landed, a timed out run keeps what it uploaded
+        entries = [{'table': table_name, 'key': key, 'rows': int(rows), 'partition': parse_partition_values(key)} for key, rows in objects]
+
+        if not entries:
+            return None
+
+        # Tables are ingested on several threads, parts are numbered and written under the lock so key order is landing order
+        with self.lock:
+            key = f"{get_manifest_folder()}/{self.run_id}_{self.parts:05d}.json"
+
+            self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=json.dumps({'run_id': self.run_id, 'part': self.parts, 'entries': entries}).encode('utf-8'))
+
+            self.parts += 1
+            self.entries.extend(entries)
+
+        print(f"Wrote run manifest part for {len(entries)} {table_name} objects to s3://{self.bucket}/{key}")
+
+        return key
+
+def list_keys(s3_client, bucket, prefix, start_after=''):
+    keys = []
+    request = {'Bucket': bucket, 'Prefix': prefix, 'StartAfter': max(start_after, prefix)}
+
+    while True:
+        response = s3_client.list_objects_v2(**request)
+        keys.extend(s3_object['Key'] for s3_object in response.get('Contents', []))
+
+        if not response.get('IsTruncated'):
+            break
+
+        request['ContinuationToken'] = response['NextContinuationToken']
+
+    return keys
+
+def list_run_manifests(s3_client, bucket, start_after=''):
+    # Run ids start with the run's timestamp and parts are numbered within a run, overlapping runs can still land out of key order
+    return list_keys(s3_client, bucket, f"{get_manifest_folder()}/", start_after)
+
+def get_settle_key(prefix):
+    # Raw files and run manifests are named after the start of their ingestion run, a run still uploading started after this key
+    settle = datetime.timedelta(minutes=int(os.getenv('S3_SETTLE_MINUTES') or 30))
+
+    return prefix + (datetime.datetime.now() - settle).strftime('%Y-%m-%d_%H-%M-%S')
+
+def settle_keys(prefix, start_after, processed):
+    # Nothing can land before the settle key any more, the watermark moves past those keys and newer ones are remembered one by one
+    settle_key = get_settle_key(prefix)
+    start_after = max([start_after, *(key for key in processed if key < settle_key)])
+
+    return start_after, sorted(key for key in processed if key > start_after)
+
+def read_run_manifest(s3_client, bucket, key):
+    return json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
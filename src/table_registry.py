@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+
+import s3_layout
+
+# FILE_STRUCTURES compiled once per process, rebuilt only if the variable changes
+lock = threading.Lock()
+source = None
+registry = ({}, [])
+
+# Row checks a "row_rules" entry can name, see ingest_sources.RowQuarantine
+ROW_CHECKS = ('not_null', 'timestamp', 'numeric', 'in')
+
+class TableStructure:
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.required_columns = list(config.get('required_columns', []))
+        self.primary_key = list(config.get('primary_key', []))
+        self.dedup_key = list(config.get('dedup_key') or self.primary_key)
+        self.copy_query = config.get('copy_query')
+        self.file_format = config.get('file_format')
+        self.compression = config.get('compression')
+
+        # Declared pandas dtypes, applied to each frame as it is built
+        self.column_types = dict(config.get('column_types', {}))
+
+        # 'query' reads rows through SQLAlchemy and pandas, 'copy' streams COPY ... TO STDOUT straight to S3
+        self.engine = config.get('engine') or 'query'
+
+        if self.engine not in ('query', 'copy'):
+            raise ValueError(f"Unknown extract engine for {name}: {self.engine}")
+
+        # 'incremental' follows the created_at watermark, 'snapshot' diffs the whole table against the last emitted snapshot
+        self.extract_mode = config.get('extract_mode') or 'incremental'
+
+        if self.extract_mode not in ('incremental', 'snapshot'):
+            raise ValueError(f"Unknown extract mode for {name}: {self.extract_mode}")
+
+        # Change files carry exactly the declared columns, load_raw stages them and applies them by primary key
+        if self.extract_mode == 'snapshot' and not (self.primary_key and self.required_columns):
+            raise ValueError(f"Snapshot mode needs a primary_key and required_columns for {name}")
+
+        # Per-row checks run on every raw chunk, failing rows are quarantined instead of loaded
+        self.row_rules = list(config.get('row_rules', []))
+
+        for rule in self.row_rules:
+            if rule.get('check') not in ROW_CHECKS:
+                raise ValueError(f"Unknown row check for {name}: {rule.get('check')}")
+
+        # String columns the pushdown query cleans in the source database
+        self.text_columns = list(config.get('text_columns', []))
+
+        # Columns the hive layout splits objects on below table= and ingest_date=
+        self.partition_by = list(config.get('partition_by', []))
+
+        # COPY templates per file type, filled in by load_raw the first time each is needed
+        self.copy_templates = {}
+
+    def get_missing_columns(self, columns):
+        columns = set(columns)
+
+        return [column for column in self.required_columns if column not in columns]
+
+def compile_structures(value):
+    file_structures = json.loads(value) if value else {}
+    compiled = {name: TableStructure(name, config) for name, config in file_structures.items()}
+
+    # Longest prefix first so a table name that prefixes another never shadows it
+    return compiled, sorted(compiled, key=len, reverse=True)
+
+def get_registry():
+    global source, registry
+
+    value = os.getenv('FILE_STRUCTURES')
+
+    if value != source:
+        with lock:
+            if value != source:
+                registry = compile_structures(value)
+                source = value
+
+    return registry
+
+def get_tables():
+    return get_registry()[0]
+
+def get_table(table_name):
+    return get_tables().get(table_name)
+
+def match_file(file_name):
+    tables, prefixes = get_registry()
+
+    for prefix in prefixes:
+        if file_name.startswith(prefix):
+            return tables[prefix]
+
+    return None
+
+def match_key(key):
+    # Hive keys name their table in a table= folder, flat keys start the file name with it
+    table_name = s3_layout.parse_partition_values(key).get('table')
+
+    if table_name is not None:
+        return get_table(table_name)
+
+    return match_file(key.split('/')[-1])
+
+get_registry()
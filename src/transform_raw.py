@@ -1,163 +1,556 @@
+import contextlib
 import datetime
+import io
 import json
 import os
-import time
+import uuid
 
-from aws_secretsmanager_caching import SecretCache, SecretCacheConfig
-import boto3
-from botocore.exceptions import ClientError
-import sqlalchemy as sa
- 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from botocore.exceptions import ClientError
 
-# Generate Timestamp for File Naming
-timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+import metrics
+import resource_cache
+import s3_layout
 
-def get_service_client(service_name):
-    session = boto3.session.Session()    
-        
-    if os.getenv('ENVIRONMENT') == 'development':
-        client = session.client(
-            service_name=service_name,
-            region_name=os.getenv('AWS_REGION_NAME'),
-            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-        )
-    else:
-        client = session.client(
-            service_name=service_name,
-            region_name=os.getenv('AWS_REGION_NAME')
-        )
-    
-    return client
-
-def get_secret(secret_name):
-    try:
-        client = get_service_client(os.getenv('AWS_SECRETS_MANAGER'))
-        cache_config = SecretCacheConfig()
-        cache = SecretCache(config=cache_config, client=client)
-        secret = cache.get_secret_string(secret_id=secret_name)
-        get_secret_value_response = client.get_secret_value(SecretId=secret_name)
-    except ClientError as e:
-        # For a list of exceptions thrown, see
-        # https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
-        print(f'Could not connect to client: {e}')
-        raise e
-    except Exception as e:
-        print(f'An unexpected error occurred: {e}')
-        raise e 
-    
-    secret = get_secret_value_response['SecretString']
+MODULE_NAME = 'transform_raw'
 
-    return secret
+LINE_ITEMS_TABLE = 'order_item_options'
+OPTIONS_TABLE = 'order_items'
 
-def get_secret_dict(secret_name):
-    try:
-        secret = get_secret(secret_name)
-        return json.loads(secret)  # Convert JSON string to dictionary
-    except Exception as e:
-        print(f"Error retrieving secret {secret_name}: {e}")
-        raise e
+LINE_KEY = ['order_id', 'lineitem_id']
+
+# Watermark of the last committed run manifest
+RUNS_WATERMARK = 'order_lines'
+
+# Ids are joined as strings so CSV and Parquet raw files agree on the key type
+ID_COLUMNS = ['order_id', 'lineitem_id', 'user_id', 'restaurant_id']
+
+# The ingestion CSV writer fills nulls with -1
+NULL_PLACEHOLDER = -1
+
+ORDER_LINE_COLUMNS = [
+    'order_date',
+    'restaurant_id',
+    'order_id',
+    'lineitem_id',
+    'user_id',
+    'is_loyalty',
+    'app_name',
+    'currency',
+    'item_category',
+    'item_name',
+    'item_price',
+    'item_quantity',
+    'option_count',
+    'option_revenue',
+    'line_revenue',
+    'creation_time_utc',
+    'created_at',
+]
+
+def get_service_client(service_name):
+    # Clients are cached across warm invocations
+    return resource_cache.get_client(service_name)
+
+def get_watermark_name(table_name):
+    return f"{MODULE_NAME}:{table_name}"
 
-def get_last_processed_date(table_name, client):
-    print(f"Retrieving last processed date for table: {table_name}")
-    
+def get_last_processed_key(table_name, client):
     response = client.get_item(
         TableName=os.getenv('AWS_DYNAMODB_TABLE_NAME'),
         ConsistentRead=True,
-        ProjectionExpression='processed_date',
-        Key={'table_name': {'S': table_name}}
+        Key={'table_name': {'S': get_watermark_name(table_name)}}
     )
 
-    if 'Item' not in response:
-        print(f"No processing date found for table: {table_name}")
-        return None
-    else:
-        processing_date = response['Item']['processed_date']['S']
-
-        print(processing_date)
+    if 'Item' not in response or 'processed_key' not in response['Item']:
+        print(f"No processed raw file recorded for table: {table_name}")
+        return ''
 
-        return processing_date
+    return response['Item']['processed_key']['S']
 
-def mark_last_processed_date(table_name, timestamp, client):
+def mark_last_processed_key(table_name, key, client):
     client.put_item(
         TableName=os.getenv('AWS_DYNAMODB_TABLE_NAME'),
-        Item={'table_name': {'S': table_name}, 'processed_date': {'S': timestamp}}
+        Item={'table_name': {'S': get_watermark_name(table_name)}, 'processed_key': {'S': key}}
     )
 
-def create_query(table_name, client):
-    latest_processed_date = get_last_processed_date(table_name, client)
+def get_raw_prefix(table_name):
+    # The trailing underscore keeps order_item from matching order_item_options
+    return f"{os.getenv('AWS_S3_FOLDER_PATH')}/{table_name}_"
 
-    # Query to fetch data from the source table
-    if latest_processed_date:
-        query = f"SELECT * FROM {table_name} WHERE created_at > '{latest_processed_date}'::timestamp ORDER BY created_at DESC;"
-    else:           
-        query = f"SELECT * FROM {table_name} ORDER BY created_at DESC;"
+def get_listing(table_name, inputs, dynamo_db_client):
+    # Manifests of earlier versions recorded only the last key read
+    listing = inputs.get(table_name) or ''
+    listing = {'start_after': listing, 'processed': []} if isinstance(listing, str) else listing
 
-    print(f"Query for {table_name}: {query}")
+    # The watermark never runs ahead of the committed manifest, it only saves a run that died after the manifest a re-read
+    start_after = max(get_last_processed_key(table_name, dynamo_db_client), listing['start_after'])
 
-    return query
+    return {'start_after': start_after, 'processed': [key for key in listing['processed'] if key > start_after]}
 
-def get_db_connection(secret):
-    return sa.create_engine(f'postgresql+psycopg2://{secret['username']}:{secret['password']}@{secret['host']}/{secret['db']}')
+def list_manifest_files(s3_client, table_name, manifest_keys):
+    bucket = os.getenv('AWS_S3_BUCKET_NAME')
+    keys = []
 
-def transform_raw(conn):
-    
+    # Ingestion lists every object it uploads in a run manifest part, partitions are never listed
+    for manifest_key in manifest_keys:
+        keys.extend(entry['key'] for entry in s3_layout.read_run_manifest(s3_client, bucket, manifest_key)['entries'] if entry['table'] == table_name)
 
-    for table_name in source_tables:
-        print(f"Processing table: {table_name}")    
+    print(f"Found {len(keys)} new raw files for {table_name} in {len(manifest_keys)} run manifests")
 
-        query = create_query(table_name, dynamo_db_client)        
-        print(f"Executing query: {query}")
-        
-        rows = conn.execute(query)
+    return keys
 
-        df = pd.DataFrame(data=rows)
+def list_new_raw_files(s3_client, table_name, listing):
+    bucket = os.getenv('AWS_S3_BUCKET_NAME')
+    hive = s3_layout.get_layout() == 'hive'
+    prefix = f"{s3_layout.get_manifest_folder()}/" if hive else get_raw_prefix(table_name)
 
-        if df.empty:
-            print(f"No new data found for table: {table_name}")
-            continue
-        
-        last_processed_date = pd.to_datetime(df['created_at'].max()) if not df.empty else None
-        last_processed_date = str(last_processed_date) if last_processed_date else None
-        print(f"Last processed date for {table_name}: {last_processed_date}")
+    # Keys are named after their ingestion run's start, overlapping runs land out of key order.
+    # Keys after the watermark that were read before are skipped by name, the watermark only moves past settled keys.
+    listed = s3_layout.list_keys(s3_client, bucket, prefix, listing['start_after'])
+    processed = set(listing['processed'])
+    new_keys = [key for key in listed if key not in processed]
 
-        # Save DataFrame to CSV
-        file_name = f"{table_name}_{timestamp}.csv"
-        file_path = f"./{file_name}"
-        df.to_csv(file_path, index=False)
+    start_after, processed = s3_layout.settle_keys(prefix, listing['start_after'], processed | set(listed))
+    next_listing = {'start_after': start_after, 'processed': processed}
 
-        print(f"Data for {table_name} saved to {file_path}")
+    if hive:
+        return list_manifest_files(s3_client, table_name, new_keys), next_listing
 
-        # Upload to S3
-        s3_client = get_service_client(os.getenv('AWS_S3'))
-        file_name = f"{table_name}_{timestamp}.json"
-        
-        repsonse = s3_client.upload_file(file_path, os.getenv('AWS_S3_BUCKET_NAME'), os.getenv('AWS_S3_FOLDER_PATH') + '/' + file_name)
-        
-        print(f"Uploaded {table_name} data to S3 at {file_name}")
-        print(repsonse)
+    print(f"Found {len(new_keys)} new raw files for {table_name}")
+
+    return new_keys, next_listing
+
+class S3RangeFile(io.RawIOBase):
+    # Parquet readers seek to the footer and then to each row group, every read is one ranged GET
+    def __init__(self, s3_client, bucket, key):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.size = s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        self.position = max(base + offset, 0)
+
+        return self.position
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size)
+
+        if end <= self.position:
+            return 0
+
+        data = self.s3_client.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={self.position}-{end - 1}")['Body'].read()
+        buffer[:len(data)] = data
+        self.position += len(data)
+
+        return len(data)
+
+def read_raw_frames(s3_client, key, chunk_size):
+    bucket = os.getenv('AWS_S3_BUCKET_NAME')
+    # Raw files are never held whole, a chunk of rows at a time is parsed from the object as it is read
+    buffer_size = int(os.getenv('TRANSFORM_READ_BUFFER_MB') or 8) * 1024 * 1024
+
+    if key.endswith('.parquet'):
+        with io.BufferedReader(S3RangeFile(s3_client, bucket, key), buffer_size=buffer_size) as file:
+            for batch in pq.ParquetFile(file).iter_batches(batch_size=chunk_size):
+                yield batch.to_pandas()
+
+        return
+
+    compression = 'gzip' if key.endswith('.gz') else 'zstd' if key.endswith('.zst') else None
+
+    with contextlib.closing(s3_client.get_object(Bucket=bucket, Key=key)['Body']) as body:
+        yield from pd.read_csv(body, compression=compression, chunksize=chunk_size, dtype={column: str for column in ID_COLUMNS})
+
+def to_number(column):
+    column = pd.to_numeric(column, errors='coerce')
+
+    return column.mask(column == NULL_PLACEHOLDER)
+
+def normalize_ids(df):
+    for column_name in ID_COLUMNS:
+        if column_name in df.columns:
+            df[column_name] = df[column_name].astype(str)
+
+    return df
+
+def aggregate_options(df):
+    df = normalize_ids(df)
+
+    # Option revenue per line item, a missing price or quantity adds nothing
+    revenue = (to_number(df['option_price']).fillna(0) * to_number(df['option_quantity']).fillna(0)).to_numpy(dtype=np.float64)
+
+    aggregated = pd.DataFrame({
+        'order_id': df['order_id'].to_numpy(),
+        'lineitem_id': df['lineitem_id'].to_numpy(),
+        'option_revenue': revenue,
+        'option_count': 1,
+        'created_at': pd.to_datetime(df['created_at'], errors='coerce'),
+    })
+
+    return aggregated.groupby(LINE_KEY, sort=False).agg({'option_revenue': 'sum', 'option_count': 'sum', 'created_at': 'max'})
+
+def cap_option_totals(option_totals, max_rows):
+    if len(option_totals) <= max_rows:
+        return option_totals
+
+    # The oldest options go first, the same ones the age cutoff drops
+    print(f"Dropping {len(option_totals) - max_rows} oldest option totals over the cap of {max_rows}")
+
+    return option_totals.sort_values('created_at', na_position='first', kind='stable').iloc[-max_rows:]
+
+def merge_option_totals(totals, df):
+    if totals is None or totals.empty:
+        return df
+
+    # Rows for the same line item can arrive in different files
+    combined = pd.concat([totals, df])
+
+    return combined.groupby(level=LINE_KEY, sort=False).agg({'option_revenue': 'sum', 'option_count': 'sum', 'created_at': 'max'})
+
+def build_order_lines(line_items, option_totals):
+    line_items = normalize_ids(line_items)
+
+    joined = line_items.join(option_totals[['option_revenue', 'option_count']], on=LINE_KEY)
+
+    item_price = to_number(joined['item_price'])
+    item_quantity = to_number(joined['item_quantity'])
+    option_revenue = joined['option_revenue'].fillna(0)
+
+    creation_time = pd.to_datetime(joined['creation_time_utc'], errors='coerce')
+
+    order_lines = pd.DataFrame({
+        'order_date': creation_time.dt.strftime('%Y-%m-%d').fillna('unknown'),
+        'restaurant_id': joined['restaurant_id'],
+        'order_id': joined['order_id'],
+        'lineitem_id': joined['lineitem_id'],
+        'user_id': joined['user_id'],
+        'is_loyalty': joined['is_loyalty'].astype(str).str.lower().isin(['true', '1', 't']),
+        'app_name': joined['app_name'].astype('category'),
+        'currency': joined['currency'].astype('category'),
+        'item_category': joined['item_category'].astype('category'),
+        'item_name': joined['item_name'],
+        'item_price': item_price.astype('float64'),
+        'item_quantity': item_quantity.astype('Int32'),
+        'option_count': joined['option_count'].fillna(0).astype('int32'),
+        'option_revenue': option_revenue.astype('float64'),
+        'line_revenue': (item_price * item_quantity + option_revenue).astype('float64'),
+        'creation_time_utc': creation_time,
+        'created_at': pd.to_datetime(joined['created_at'], errors='coerce'),
+    }, columns=ORDER_LINE_COLUMNS)
+
+    return order_lines, joined['option_revenue'].notna().to_numpy()
+
+def write_partitions(s3_client, order_lines, part_name):
+    bucket = os.getenv('AWS_S3_TRANSFORMED_BUCKET_NAME') or os.getenv('AWS_S3_BUCKET_NAME')
+    folder = os.getenv('AWS_S3_TRANSFORMED_FOLDER_PATH') or 'transformed'
+    written = 0
+    keys = []
+
+    # A buffer whose line items were all held back writes nothing
+    if order_lines.empty:
+        return written, keys
+
+    # Convert once and sort by day and restaurant, every day is then a zero-copy slice of the same table.
+    # Within a day rows stay sorted by restaurant, so row group statistics let readers skip other restaurants.
+    order_lines = order_lines.sort_values(['order_date', 'restaurant_id', 'order_id'], kind='stable')
+    order_dates = order_lines['order_date'].to_numpy()
+    table = pa.Table.from_pandas(order_lines.drop(columns=['order_date']), preserve_index=False)
+
+    starts = np.flatnonzero(np.r_[True, order_dates[1:] != order_dates[:-1]])
+    ends = np.r_[starts[1:], len(order_dates)]
+
+    # One object per day and flush, a (day, restaurant) split made thousands of objects of a few rows each
+    for start, end in zip(starts, ends):
+        key = f"{folder}/order_lines/order_date={order_dates[start]}/part-{part_name}.parquet"
+
+        buffer = io.BytesIO()
+        pq.write_table(table.slice(start, end - start), buffer, compression='snappy', coerce_timestamps='us', allow_truncated_timestamps=True)
+
+        s3_client.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
+        written += buffer.tell()
+        keys.append(key)
+
+    return written, keys
+
+def write_run_manifest(s3_client, run_id, keys, inputs, pending):
+    bucket = os.getenv('AWS_S3_TRANSFORMED_BUCKET_NAME') or os.getenv('AWS_S3_BUCKET_NAME')
+    key = f"{os.getenv('AWS_S3_TRANSFORMED_FOLDER_PATH') or 'transformed'}/_runs/{run_id}.json"
+
+    # Run ids sort by start time, downstream jobs list this folder from their last run instead of every partition.
+    # The manifest is the run's commit point, it also names the raw input the run read up to and the pending state it left.
+    s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps({'run_id': run_id, 'order_lines': keys, 'inputs': inputs, 'pending': pending}).encode('utf-8'))
+
+    print(f"Wrote run manifest {key} with {len(keys)} partitions")
+
+    return key
+
+def load_last_run(s3_client, dynamo_db_client):
+    bucket = os.getenv('AWS_S3_TRANSFORMED_BUCKET_NAME') or os.getenv('AWS_S3_BUCKET_NAME')
+    prefix = f"{os.getenv('AWS_S3_TRANSFORMED_FOLDER_PATH') or 'transformed'}/_runs/"
+    start_after = get_last_processed_key(RUNS_WATERMARK, dynamo_db_client)
 
-        mark_last_processed_date(table_name, last_processed_date, dynamo_db_client)
+    # A run that died after its manifest but before its watermarks is newer than the recorded last run
+    response = s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix, StartAfter=max(start_after, prefix))
+    keys = [s3_object['Key'] for s3_object in response.get('Contents', [])]
+
+    while response.get('IsTruncated'):
+        response = s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix, StartAfter=max(start_after, prefix), ContinuationToken=response['NextContinuationToken'])
+        keys.extend(s3_object['Key'] for s3_object in response.get('Contents', []))
+
+    key = keys[-1] if keys else start_after
+
+    if not key:
+        return '', {}
+
+    return key, json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+
+def get_pending_key(run_id, name):
+    return f"{os.getenv('AWS_S3_TRANSFORMED_FOLDER_PATH') or 'transformed'}/_pending/{run_id}/{name}.parquet"
+
+def read_pending(s3_client, key):
+    bucket = os.getenv('AWS_S3_TRANSFORMED_BUCKET_NAME') or os.getenv('AWS_S3_BUCKET_NAME')
+
+    if not key:
+        return None
 
-def ingest_sources():
     try:
-        secret = get_secret(os.getenv('AWS_DB_CREDENTIALS'))
-        secret = json.loads(secret)  # Convert JSON string to dictionary
+        body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+            raise e
 
-        conn = get_db_connection(secret)
-        
-        upload_to_s3(conn)
+        return None
 
-    except Exception as e:
-        print(f"Error in handler: {e}")
-        raise e
+    return pq.read_table(io.BytesIO(body))
+
+def delete_pending(s3_client, pending):
+    bucket = os.getenv('AWS_S3_TRANSFORMED_BUCKET_NAME') or os.getenv('AWS_S3_BUCKET_NAME')
+
+    # Only once a newer run committed, until then a retry still reads them
+    for key in pending.values():
+        s3_client.delete_object(Bucket=bucket, Key=key)
+
+def load_pending_options(s3_client, key):
+    table = read_pending(s3_client, key)
+
+    if table is None:
+        return None, None
+
+    # The newest option created_at ever read travels with the totals, line items up to it have seen their options
+    options_through = (table.schema.metadata or {}).get(b'options_through', b'').decode('utf-8')
+
+    return table.to_pandas().set_index(LINE_KEY), pd.Timestamp(options_through) if options_through else None
+
+def save_pending_options(s3_client, run_id, option_totals, options_through=None):
+    bucket = os.getenv('AWS_S3_TRANSFORMED_BUCKET_NAME') or os.getenv('AWS_S3_BUCKET_NAME')
+    max_age = datetime.timedelta(days=int(os.getenv('TRANSFORM_PENDING_OPTION_DAYS') or 7))
+    max_rows = int(os.getenv('TRANSFORM_PENDING_OPTION_ROWS') or 2_000_000)
+
+    # Options whose line item never arrives are dropped once they are older than the cutoff
+    if option_totals is not None and not option_totals.empty:
+        cutoff = option_totals['created_at'].max() - max_age
+        expired = option_totals['created_at'] < cutoff
+
+        if expired.any():
+            print(f"Dropping {expired.sum()} option totals without a line item older than {cutoff}")
+            option_totals = option_totals[~expired]
+
+        option_totals = cap_option_totals(option_totals, max_rows)
+    else:
+        option_totals = pd.DataFrame({'option_revenue': [], 'option_count': [], 'created_at': pd.to_datetime([])}, index=pd.MultiIndex.from_arrays([[], []], names=LINE_KEY))
+
+    table = pa.Table.from_pandas(option_totals.reset_index(), preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'options_through': str(options_through or '').encode('utf-8')})
+
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer)
+    key = get_pending_key(run_id, 'option_totals')
+    s3_client.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
+
+    print(f"Carrying {len(option_totals)} option totals to the next run")
+
+    return key
+
+def load_held_lines(s3_client, key):
+    table = read_pending(s3_client, key)
+
+    return table.to_pandas() if table is not None and table.num_rows else None
+
+def save_held_lines(s3_client, run_id, held_lines):
+    bucket = os.getenv('AWS_S3_TRANSFORMED_BUCKET_NAME') or os.getenv('AWS_S3_BUCKET_NAME')
+    held = pd.concat(held_lines, ignore_index=True) if held_lines else pd.DataFrame({'held_at': pd.to_datetime([])})
+
+    # Raw files differ in their inferred types, held rows keep their raw values as text and build_order_lines parses them again
+    columns = held.columns.drop('held_at')
+    held[columns] = held[columns].apply(lambda column: column.map(str, na_action='ignore')).astype(object)
+
+    buffer = io.BytesIO()
+    held.to_parquet(buffer, index=False)
+    key = get_pending_key(run_id, 'line_items')
+    s3_client.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
+
+    print(f"Holding {len(held)} line items for options that may still arrive")
+
+    return key
+
+def get_held_lines(line_items, has_options, options_through, now, grace):
+    # Options are ingested before their line items, a line item newer than every option read so far may have options still in flight.
+    # It waits until the options catch up or the grace period runs out, whichever comes first.
+    created_at = pd.to_datetime(line_items['created_at'], errors='coerce')
+    held_at = pd.to_datetime(line_items['held_at']) if 'held_at' in line_items.columns else pd.Series(pd.NaT, index=line_items.index)
+
+    newer = created_at > options_through if options_through is not None else created_at.notna()
+    waiting = held_at.isna() | (now - held_at < grace)
 
-# Start script timer        
-start_time = time.time()
+    return (~has_options & newer.to_numpy() & waiting.to_numpy()), held_at.fillna(now)
 
-# Transfer raw data from source to S3
-ingest_sources()
+def transform_raw(s3_client, dynamo_db_client):
+    chunk_size = int(os.getenv('TRANSFORM_CHUNK_SIZE') or 500_000)
+    # Microseconds keep back to back runs in order, the newest manifest is the committed state
+    run_id = f"{datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')}-{uuid.uuid4().hex[:8]}"
+
+    # The last committed run's manifest wins over watermarks it did not get to move
+    last_run_key, last_run = load_last_run(s3_client, dynamo_db_client)
+    inputs = last_run.get('inputs', {})
+    pending = last_run.get('pending', {})
+
+    option_listing = get_listing(OPTIONS_TABLE, inputs, dynamo_db_client)
+    line_item_listing = get_listing(LINE_ITEMS_TABLE, inputs, dynamo_db_client)
+
+    # Listings run over raw keys in the flat layout and over run manifests in the hive layout
+    option_keys, option_next = list_new_raw_files(s3_client, OPTIONS_TABLE, option_listing)
+    line_item_keys, line_item_next = list_new_raw_files(s3_client, LINE_ITEMS_TABLE, line_item_listing)
+
+    # Line items held back by earlier runs go first, as if they were the first raw file
+    held = load_held_lines(s3_client, pending.get('line_items'))
+    grace = datetime.timedelta(minutes=int(os.getenv('TRANSFORM_PENDING_LINE_MINUTES') or 60))
+    now = pd.Timestamp.now()
+
+    if not option_keys and not line_item_keys and (held is None or not (now - pd.to_datetime(held['held_at']) >= grace).any()):
+        print("No new raw data to transform")
+
+        # Settled run manifests holding only other tables are skipped for good, unsettled ones are read again next run
+        for table_name, listing, next_listing in [(OPTIONS_TABLE, option_listing, option_next), (LINE_ITEMS_TABLE, line_item_listing, line_item_next)]:
+            if next_listing['start_after'] != listing['start_after']:
+                mark_last_processed_key(table_name, next_listing['start_after'], dynamo_db_client)
+
+        if last_run_key:
+            mark_last_processed_key(RUNS_WATERMARK, last_run_key, dynamo_db_client)
+
+        return
+
+    # Options are small next to line items, their totals per line item are built first
+    option_recorder = metrics.get_recorder(MODULE_NAME, OPTIONS_TABLE)
+    option_totals, options_through = load_pending_options(s3_client, pending.get('option_totals'))
+    max_option_rows = int(os.getenv('TRANSFORM_PENDING_OPTION_ROWS') or 2_000_000)
+
+    for key in option_keys:
+        for frame in option_recorder.time_iter('read', read_raw_frames(s3_client, key, chunk_size)):
+            with option_recorder.time('aggregate') as counts:
+                aggregated = aggregate_options(frame)
+                option_totals = cap_option_totals(merge_option_totals(option_totals, aggregated), max_option_rows)
+                counts['rows'] = len(frame)
+
+            if aggregated['created_at'].notna().any():
+                options_through = max(filter(None, [options_through, aggregated['created_at'].max()]))
+
+    if option_totals is None:
+        option_totals = aggregate_options(pd.DataFrame(columns=[*LINE_KEY, 'option_price', 'option_quantity', 'created_at']))
+
+    # Line items stream through one chunk at a time, only the option totals stay resident and they are capped
+    line_recorder = metrics.get_recorder(MODULE_NAME, LINE_ITEMS_TABLE)
+    buffer_rows = int(os.getenv('TRANSFORM_BUFFER_ROWS') or 1_000_000)
+    matched = []
+    held_lines = []
+    buffered = []
+    written_keys = []
+
+    def flush():
+        # Order lines of every chunk and file are buffered, each flush writes one object per order day
+        with line_recorder.time('write') as counts:
+            order_lines = pd.concat(buffered, ignore_index=True)
+            counts['bytes'], keys = write_partitions(s3_client, order_lines, f"{run_id}-{len(written_keys):04d}")
+            counts['rows'] = len(order_lines)
+            written_keys.append(keys)
+
+        buffered.clear()
+
+    sources = ([('held', iter([held]))] if held is not None else []) + [(key, read_raw_frames(s3_client, key, chunk_size)) for key in line_item_keys]
+
+    for key, frames in sources:
+        for frame in line_recorder.time_iter('read', frames):
+            with line_recorder.time('join') as counts:
+                order_lines, has_options = build_order_lines(frame, option_totals)
+                hold, held_at = get_held_lines(frame, has_options, options_through, now, grace)
+
+                if hold.any():
+                    held_lines.append(frame[hold].assign(held_at=held_at[hold]))
+                    order_lines = order_lines[~hold]
+
+                matched.append(order_lines.loc[has_options[~hold], LINE_KEY])
+                buffered.append(order_lines)
+                counts['rows'] = len(order_lines)
+
+            if sum(len(order_lines) for order_lines in buffered) >= buffer_rows:
+                flush()
+
+        print(f"Transformed {key}")
+
+    if buffered:
+        flush()
+
+    written_keys = [key for keys in written_keys for key in keys]
+
+    # Options that found their line item are done, the rest wait for a later run
+    if matched:
+        option_totals = option_totals[~option_totals.index.isin(pd.MultiIndex.from_frame(pd.concat(matched)))]
+
+    # Pending state is written per run, a run that dies before its manifest leaves the last committed state untouched
+    run_pending = {
+        'option_totals': save_pending_options(s3_client, run_id, option_totals, options_through),
+        'line_items': save_held_lines(s3_client, run_id, held_lines),
+    }
+
+    run_key = write_run_manifest(s3_client, run_id, written_keys, {OPTIONS_TABLE: option_next, LINE_ITEMS_TABLE: line_item_next}, run_pending)
+
+    # Watermarks only save the next run a manifest read, a retry after a crash here resumes from the manifest
+    for table_name, listing, next_listing in [(OPTIONS_TABLE, option_listing, option_next), (LINE_ITEMS_TABLE, line_item_listing, line_item_next)]:
+        if next_listing['start_after'] != listing['start_after']:
+            mark_last_processed_key(table_name, next_listing['start_after'], dynamo_db_client)
+
+    mark_last_processed_key(RUNS_WATERMARK, run_key, dynamo_db_client)
+
+    delete_pending(s3_client, pending)
+
+@metrics.profiled(MODULE_NAME)
+def run():
+    try:
+        s3_client = get_service_client(os.getenv('AWS_S3'))
+        dynamo_db_client = get_service_client(os.getenv('AWS_DYNAMODB'))
+
+        with metrics.get_recorder(MODULE_NAME, 'all').time('run'):
+            transform_raw(s3_client, dynamo_db_client)
+    except Exception as e:
+        print(f"Error in transform: {e}")
+        raise e
+    finally:
+        metrics.flush()
 
-# Print script execution time
-print("--- %s minutes ---" % str((time.time() - start_time)/60))
\ No newline at end of file
+if __name__ == '__main__':
+    run()
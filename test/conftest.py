@@ -0,0 +1,90 @@
+import json
+import os
+import sqlite3
+import sys
+
+import pytest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(TEST_DIR, '..')
+
+# Lambda puts each handler's folder on the path, the shared modules and the bench stand-ins are imported by plain name
+sys.path[:0] = [os.path.join(REPO_DIR, 'src'), os.path.join(REPO_DIR, 'bench')]
+
+import local_aws
+import resource_cache
+
+COPY_QUERY = "copy {table}_raw from s3uri iam_role iamrole delimiter ',' escape NULL as 'null' REMOVEQUOTES TIMEFORMAT 'auto' ignoreheader 1;"
+
+# Small tables of their own, the tests do not depend on the template's FILE_STRUCTURES
+FILE_STRUCTURES = {
+    'events': {
+        'required_columns': ['event_id', 'label', 'amount', 'created_at'],
+        'primary_key': ['event_id'],
+        'row_rules': [{'column': 'amount', 'check': 'numeric', 'min': 0}],
+        'column_types': {'created_at': 'datetime64[ns]'},
+        'text_columns': ['label'],
+        'copy_query': COPY_QUERY.format(table='events'),
+    },
+    'dims': {
+        'extract_mode': 'snapshot',
+        'required_columns': ['dim_key', 'label', 'created_at'],
+        'primary_key': ['dim_key'],
+        'row_rules': [{'column': 'label', 'check': 'not_null'}],
+        'column_types': {'created_at': 'datetime64[ns]'},
+        'copy_query': COPY_QUERY.format(table='dims'),
+    },
+    'order_items': {'copy_query': COPY_QUERY.format(table='order_items')},
+    'order_item_options': {'copy_query': COPY_QUERY.format(table='order_item_options')},
+}
+
+ENVIRONMENT = {
+    'AWS_S3': 's3',
+    'AWS_DYNAMODB': 'dynamodb',
+    'AWS_REDSHIFT_DATA_API': 'redshift-data',
+    'AWS_S3_BUCKET_NAME': 'test-raw',
+    'AWS_S3_FOLDER_PATH': 'raw_data',
+    'AWS_S3_ERROR_BUCKET_NAME': 'test-errors',
+    'AWS_DYNAMODB_TABLE_NAME': 'test-watermarks',
+    'AWS_REDSHIFT_ROLE_ARN': 'arn:aws:iam::000000000000:role/test',
+    'AWS_REDSHIFT_WORKGROUP_NAME': 'test-workgroup',
+    'FILE_STRUCTURES': json.dumps(FILE_STRUCTURES),
+}
+
+# Knobs a developer may have exported for the bench, every test starts from the defaults
+CLEARED_ENVIRONMENT = [
+    'S3_LAYOUT', 'S3_UPLOAD_MODE', 'OUTPUT_FILE_FORMAT', 'CSV_COMPRESSION', 'INGEST_PUSHDOWN', 'INGEST_CHECKPOINTS',
+    'DEDUP_INDEX_PREFIX', 'BACKFILL_RANGES', 'BACKFILL_STRATEGY', 'CLEAN_DATA_WORKERS', 'CLEAN_DATA_ENGINE',
+    'AWS_S3_TRANSFORMED_BUCKET_NAME', 'AWS_S3_TRANSFORMED_FOLDER_PATH', 'AWS_S3_CURATED_BUCKET_NAME', 'AWS_S3_CURATED_FOLDER_PATH',
+]
+
+@pytest.fixture
+def aws(tmp_path, monkeypatch):
+    for name in CLEARED_ENVIRONMENT:
+        monkeypatch.delenv(name, raising=False)
+
+    for name, value in ENVIRONMENT.items():
+        monkeypatch.setenv(name, value)
+
+    # install swaps resource_cache.get_client for the stand-ins, monkeypatch puts the real one back afterwards
+    monkeypatch.setattr(resource_cache, 'get_client', resource_cache.get_client)
+
+    return local_aws.install(str(tmp_path / 's3'))
+
+class SourceDatabase:
+    # A SQLite file behind the stand-in engine, tables are replaced whole between runs
+    def __init__(self, path):
+        self.path = path
+        self.engine = local_aws.create_source_engine(path)
+
+    def write(self, table_name, df):
+        with sqlite3.connect(self.path) as conn:
+            df.to_sql(table_name, conn, if_exists='replace', index=False)
+
+@pytest.fixture
+def source_db(tmp_path):
+    database = SourceDatabase(str(tmp_path / 'source.db'))
+
+    yield database
+
+    database.engine.dispose()
@@ -0,0 +1,96 @@
+import io
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import curate_transformed
+
+def make_orders(rows):
+    return pd.DataFrame(rows, columns=['user_id', 'order_id', 'order_at', 'revenue', 'is_loyalty']).astype({'order_at': 'datetime64[ns]'})
+
+def put_order_lines(s3_client, order_date, part_name, lines):
+    buffer = io.BytesIO()
+    pd.DataFrame(lines, columns=curate_transformed.CUBE_COLUMNS).to_parquet(buffer, index=False)
+    s3_client.put_object(Bucket='test-raw', Key=f"transformed/order_lines/order_date={order_date}/part-{part_name}.parquet", Body=buffer.getvalue())
+
+def test_quantile_sketch_stays_within_its_relative_accuracy():
+    values = np.arange(1, 10_001, dtype=np.float64)
+    sketch = curate_transformed.QuantileSketch(0.01).add(values)
+
+    for q in [0.1, 0.5, 0.9, 0.99]:
+        assert sketch.quantile(q) == pytest.approx(np.quantile(values, q), rel=0.01)
+
+def test_quantile_sketches_merge_like_one_sketch_over_all_values():
+    values = np.concatenate([np.zeros(10), np.random.default_rng(0).lognormal(3, 1, 5_000)])
+    merged = curate_transformed.QuantileSketch().add(values[:2_000]).merge(curate_transformed.QuantileSketch().add(values[2_000:]))
+    whole = curate_transformed.QuantileSketch().add(values)
+
+    # Bucket states travel as JSON between runs
+    merged = curate_transformed.QuantileSketch.from_dict(json.loads(json.dumps(merged.to_dict())))
+
+    assert merged.count == whole.count == len(values)
+    assert merged.counts == whole.counts
+    assert [merged.quantile(q) for q in [0, 0.5, 0.95]] == [whole.quantile(q) for q in [0, 0.5, 0.95]]
+
+def test_merging_orders_run_by_run_matches_merging_them_at_once():
+    orders = make_orders([
+        ['u1', 'o1', '2025-01-01', 10.0, False],
+        ['u1', 'o2', '2025-01-04', 20.0, False],
+        ['u2', 'o3', '2025-01-05', 5.0, True],
+        ['u1', 'o4', '2025-01-10', 30.0, True],
+        ['u2', 'o5', '2025-02-20', 7.0, True],
+    ])
+
+    at_once = curate_transformed.merge_orders(curate_transformed.create_empty_state(), orders, 30)
+    by_run = curate_transformed.create_empty_state()
+
+    for run_orders in [orders.iloc[:2], orders.iloc[2:4], orders.iloc[4:]]:
+        by_run = curate_transformed.merge_orders(by_run, run_orders.reset_index(drop=True), 30)
+
+    pd.testing.assert_frame_equal(by_run.sort_values('user_id', ignore_index=True), at_once.sort_values('user_id', ignore_index=True))
+
+    u1 = at_once.set_index('user_id').loc['u1']
+
+    assert (u1['order_count'], u1['total_spend'], u1['last_order_id'], u1['is_loyalty']) == (3, 60.0, 'o4', True)
+    assert (u1['gap_count'], u1['gap_mean']) == (2, pytest.approx(4.5))
+    assert u1['gap_m2'] == pytest.approx(4.5)
+
+def test_an_order_split_across_runs_counts_once():
+    state = curate_transformed.merge_orders(curate_transformed.create_empty_state(), make_orders([['u1', 'o1', '2025-01-01', 10.0, False]]), 30)
+    state = curate_transformed.merge_orders(state, make_orders([['u1', 'o1', '2025-01-01', 5.0, False]]), 30)
+
+    user = state.set_index('user_id').loc['u1']
+
+    assert (user['order_count'], user['total_spend'], user['gap_count'], user['period_spend']) == (1, 15.0, 0, 15.0)
+
+def test_cube_roll_up_adds_the_daily_cells(aws):
+    s3_client = aws['s3']
+    cells = pd.DataFrame({'restaurant_id': ['r1', 'r2'], 'item_category': ['Burgers', 'Burgers'], 'is_loyalty': [True, False], 'revenue': [10.0, 4.0], 'order_count': [2, 1], 'line_count': [3, 1], 'item_quantity': [3, 2]})
+
+    curate_transformed.write_cube_cells(s3_client, 'day', '2025-01-01', cells)
+    curate_transformed.write_cube_cells(s3_client, 'day', '2025-01-02', cells.iloc[:1])
+
+    rolled_up = curate_transformed.roll_up_cells(s3_client, pd.date_range('2025-01-01', '2025-01-07'))
+    rolled_up = rolled_up.sort_values('restaurant_id', ignore_index=True)
+
+    assert rolled_up[curate_transformed.CUBE_MEASURES].values.tolist() == [[20.0, 4, 6, 6], [4.0, 1, 1, 2]]
+    assert curate_transformed.roll_up_cells(s3_client, pd.date_range('2025-02-01', '2025-02-07')) is None
+
+def test_day_cells_skip_part_files_of_uncommitted_runs(aws):
+    s3_client = aws['s3']
+    lines = [['o1', 'Burgers', True, 10.0, 1, 'r1'], ['o1', 'Burgers', True, 5.0, 2, 'r1'], ['o2', 'Sides', False, 3.0, 1, 'r1']]
+
+    put_order_lines(s3_client, '2025-01-01', '20250101000000000000-aaaaaaaa-0000', lines)
+    s3_client.put_object(Bucket='test-raw', Key='transformed/_runs/20250101000000000000-aaaaaaaa.json', Body=b'{}')
+
+    # The same lines again from a run that died before writing its manifest
+    put_order_lines(s3_client, '2025-01-01', '20250102000000000000-bbbbbbbb-0000', lines)
+
+    cells, row_count = curate_transformed.build_day_cells(s3_client, '2025-01-01', curate_transformed.list_committed_run_ids(s3_client))
+    cells = cells.set_index('item_category')
+
+    assert row_count == 3
+    assert cells.loc['Burgers', curate_transformed.CUBE_MEASURES].tolist() == [15.0, 1, 2, 3]
+    assert cells.loc['Sides', curate_transformed.CUBE_MEASURES].tolist() == [3.0, 1, 1, 1]
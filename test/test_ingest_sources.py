@@ -0,0 +1,419 @@
+import gzip
+import io
+from concurrent.futures.process import BrokenProcessPool
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import zstandard
+
+import ingest_sources
+import resource_cache
+
+def make_events(event_ids, created_at='2025-01-01 00:00:00'):
+    return pd.DataFrame({'event_id': event_ids, 'label': 'a', 'amount': 1.0, 'created_at': pd.Timestamp(created_at)})
+
+def read_csv(s3_client, bucket, key):
+    return pd.read_csv(io.BytesIO(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()))
+
+def list_keys(s3_client, bucket, prefix):
+    return [s3_object['Key'] for s3_object in s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix)['Contents']]
+
+def test_chunked_export_matches_a_single_fetch(aws, source_db):
+    source_db.write('events', pd.concat([make_events(range(5), '2025-01-01'), make_events(range(5, 10), '2025-01-03')], ignore_index=True))
+    query, params = ingest_sources.create_query('events', None)
+
+    with source_db.engine.connect() as conn:
+        whole = ingest_sources.export_query(conn, 'events', query, 'events_whole.csv', aws['s3'], params=params)
+        chunked = ingest_sources.export_query(conn, 'events', query, 'events_chunked.csv', aws['s3'], chunk_size=3, params=params)
+
+    assert whole == chunked == (True, 10, pd.Timestamp('2025-01-03'))
+
+    # The header is written once, every chunk after the first only appends rows
+    pd.testing.assert_frame_equal(read_csv(aws['s3'], 'test-raw', 'raw_data/events_chunked.csv'), read_csv(aws['s3'], 'test-raw', 'raw_data/events_whole.csv'))
+
+def test_vectorized_clean_data_matches_the_legacy_engine():
+    df = pd.DataFrame({
+        'label': ['a\x07b', '   ', None, 'c', 'c', 'd\n'],
+        'amount': [1, 2, 3, 4, 4, 5],
+        'created_at': ['2025-01-01_10:00:00', '2025-01-01_11:00:00', 'never', '2025-01-02_10:00:00', '2025-01-02_10:00:00', None],
+    })
+
+    cleaned = ingest_sources.clean_data_vectorized(df.copy())
+
+    pd.testing.assert_frame_equal(cleaned, ingest_sources.clean_data_legacy(df.copy()), check_dtype=False)
+    assert cleaned['label'].tolist() == ['a b', -1, -1, 'c', 'd ']
+    assert cleaned['amount'].dtype == np.int64
+
+def test_a_failing_table_does_not_stop_the_other_tables(aws, source_db):
+    # dims has no table in the source database
+    source_db.write('events', make_events([1, 2], '2025-01-02'))
+    watermarks = ingest_sources.get_watermarks(['events', 'dims'], aws['dynamodb'])
+
+    with pytest.raises(Exception, match='Ingestion failed for tables: dims'):
+        ingest_sources.upload_to_s3_concurrently(source_db.engine, ['events', 'dims'], watermarks, 2, '2025-01-01_00-00-00')
+
+    assert len(read_csv(aws['s3'], 'test-raw', 'raw_data/events_2025-01-01_00-00-00.csv')) == 2
+    assert ingest_sources.get_watermarks(['events', 'dims'], aws['dynamodb'])['events']['processed_date'] == '2025-01-02 00:00:00'
+
+def test_parquet_writer_widens_columns_that_drift_between_chunks():
+    chunks = [
+        pd.DataFrame({'event_id': [1, 2], 'note': [None, None], 'price': [Decimal('1.5'), Decimal('2')], 'label': pd.Categorical(['a', 'b'])}),
+        pd.DataFrame({'event_id': [3, None], 'note': ['late', None], 'price': [Decimal('0.125'), None], 'label': pd.Categorical(['c', 'c'])}),
+    ]
+
+    file = io.BytesIO()
+    writer = ingest_sources.ParquetFrameWriter(file, 'snappy', {'event_id': 'Int32'})
+
+    for chunk in chunks:
+        writer.write(chunk)
+
+    writer.close()
+
+    table = pq.read_table(io.BytesIO(file.getvalue()))
+
+    assert [table.schema.field(name).type for name in table.column_names] == [pa.int32(), pa.string(), pa.decimal128(38, 18), pa.string()]
+    assert table.column('note').to_pylist() == [None, None, 'late', None]
+    assert table.column('price').to_pylist() == [Decimal('1.5'), Decimal('2'), Decimal('0.125'), None]
+
+def test_chunked_parquet_export_keeps_a_column_that_is_null_in_the_first_chunk(aws, source_db, monkeypatch):
+    monkeypatch.setenv('OUTPUT_FILE_FORMAT', 'parquet')
+
+    source_db.write('events', make_events(range(4)).assign(note=[None, None, 'late', None]))
+    query, params = ingest_sources.create_query('events', None)
+
+    with source_db.engine.connect() as conn:
+        assert ingest_sources.export_query(conn, 'events', query, 'events_1.parquet', aws['s3'], chunk_size=2, params=params)[:2] == (True, 4)
+
+    exported = pq.read_table(io.BytesIO(aws['s3'].get_object(Bucket='test-raw', Key='raw_data/events_1.parquet')['Body'].read()))
+
+    assert exported.column('note').to_pylist() == [None, None, 'late', None]
+    assert exported.schema.field('created_at').type == pa.timestamp('us')
+
+@pytest.mark.parametrize('compression, decompress', [
+    ('gzip', gzip.decompress),
+    ('zstd', lambda body: zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)).read()),
+])
+def test_multipart_upload_streams_compressed_chunks(aws, compression, decompress):
+    labels = np.random.default_rng(0).integers(0, 10**12, 3000).astype(str)
+    frames = [make_events(range(start, start + 1000)).assign(label=labels[start:start + 1000]) for start in range(0, 3000, 1000)]
+
+    writer = ingest_sources.S3MultipartWriter(aws['s3'], 'test-raw', 'raw_data/events.csv', part_size=4096, max_concurrency=2)
+    row_count, _ = ingest_sources.write_frames(iter(frames), ingest_sources.FileFrameSink(writer, 'csv', compression))
+    writer.close()
+
+    # Parts went out while the chunks were encoded, nothing was spooled to disk
+    assert writer.upload_id is not None
+    assert row_count == 3000
+
+    uploaded = pd.read_csv(io.BytesIO(decompress(aws['s3'].get_object(Bucket='test-raw', Key='raw_data/events.csv')['Body'].read())))
+
+    assert uploaded['event_id'].tolist() == list(range(3000))
+    assert uploaded['label'].astype(str).tolist() == labels.tolist()
+
+def test_backfill_extracts_each_created_at_range_into_its_own_part(aws, source_db, monkeypatch):
+    monkeypatch.setenv('BACKFILL_RANGES', '3')
+
+    created_at = pd.to_datetime(['2025-01-01', '2025-01-01', '2025-01-05', '2025-01-09', '2025-01-09', None])
+    source_db.write('events', make_events(range(1, 7)).assign(created_at=created_at))
+
+    valid, row_count, last_processed_date = ingest_sources.backfill_table('events', source_db.engine, aws['s3'], 'events_1', 'csv')
+
+    parts = [read_csv(aws['s3'], 'test-raw', key) for key in list_keys(aws['s3'], 'test-raw', 'raw_data/events_1_part-')]
+
+    # Rows without created_at ride along with the first range
+    assert (valid, row_count, last_processed_date) == (True, 6, pd.Timestamp('2025-01-09'))
+    assert [sorted(part['event_id'].tolist()) for part in parts] == [[1, 2, 6], [3], [4, 5]]
+
+def test_keyset_query_resumes_after_the_cursor_row(aws):
+    query, params = ingest_sources.create_keyset_query('events', ['event_id'], '2025-01-01 00:00:00', {'created_at': '2025-01-02 00:00:00', 'key': [7]}, 100)
+
+    assert 'created_at > CAST(:processed_date AS timestamp)' in query
+    assert '(created_at, event_id) > (:cursor_0, :cursor_1)' in query
+    assert query.endswith('ORDER BY created_at, event_id LIMIT :limit')
+    assert params == {'limit': 100, 'processed_date': '2025-01-01 00:00:00', 'cursor_0': '2025-01-02 00:00:00', 'cursor_1': 7}
+
+def test_checkpointed_export_resumes_from_the_saved_cursor(aws, source_db):
+    # Rows sharing a created_at straddle the chunk boundaries, only the key tells them apart
+    source_db.write('events', pd.concat([make_events([1, 2, 3], '2025-01-01'), make_events([4, 5], '2025-01-02')], ignore_index=True))
+
+    valid, row_count, last_processed_date = ingest_sources.export_with_checkpoints(source_db.engine, 'events', {'processed_date': None}, aws['s3'], aws['dynamodb'], 'events_1', 'csv', 2)
+
+    assert (valid, row_count) == (True, 5)
+    assert pd.Timestamp(last_processed_date) == pd.Timestamp('2025-01-02')
+    assert len(list_keys(aws['s3'], 'test-raw', 'raw_data/events_1_chunk-')) == 3
+
+    # A run that timed out after the first chunk picks up after its last row
+    watermark = ingest_sources.get_watermarks(['events'], aws['dynamodb'])['events']
+    watermark['checkpoint']['created_at'], watermark['checkpoint']['key'] = '2025-01-01 00:00:00', [2]
+
+    valid, row_count, _ = ingest_sources.export_with_checkpoints(source_db.engine, 'events', watermark, aws['s3'], aws['dynamodb'], 'events_2', 'csv', 2)
+
+    assert (valid, row_count) == (True, 3)
+    assert pd.concat(read_csv(aws['s3'], 'test-raw', key) for key in list_keys(aws['s3'], 'test-raw', 'raw_data/events_2_chunk-'))['event_id'].tolist() == [3, 4, 5]
+
+def test_dedup_index_drops_rows_seen_earlier_in_the_run(aws):
+    dedup_index = ingest_sources.DedupIndex(aws['s3'], 'events', ['event_id'])
+
+    assert dedup_index.filter(make_events([1, 2, 2]))['event_id'].tolist() == [1, 2]
+    assert dedup_index.filter(make_events([2, 3]))['event_id'].tolist() == [3]
+
+def test_dedup_index_persists_fingerprints_only_on_commit(aws, monkeypatch):
+    monkeypatch.setenv('DEDUP_INDEX_PREFIX', '_dedup')
+
+    dedup_index = ingest_sources.DedupIndex(aws['s3'], 'events', ['event_id'])
+    dedup_index.filter(make_events([1, 2]))
+
+    # Nothing landed yet, a retry must ship the same rows again
+    assert len(ingest_sources.DedupIndex(aws['s3'], 'events', ['event_id']).filter(make_events([1, 2]))) == 2
+
+    dedup_index.commit()
+
+    assert ingest_sources.DedupIndex(aws['s3'], 'events', ['event_id']).filter(make_events([1, 2, 3]))['event_id'].tolist() == [3]
+
+def test_backfill_commits_the_dedup_index_only_once_every_range_landed(aws, source_db, monkeypatch):
+    monkeypatch.setenv('DEDUP_INDEX_PREFIX', '_dedup')
+    monkeypatch.setenv('BACKFILL_RANGES', '2')
+    monkeypatch.setenv('BACKFILL_MAX_WORKERS', '1')
+
+    source_db.write('events', pd.concat([make_events([1, 2], '2025-01-01'), make_events([3, 4], '2025-01-04')], ignore_index=True))
+
+    export_range = ingest_sources.export_range
+
+    def fail_last_range(engine, table_name, query, params, file_name, *args, **kwargs):
+        result = export_range(engine, table_name, query, params, file_name, *args, **kwargs)
+
+        if file_name.endswith('part-0001.csv'):
+            raise RuntimeError('range failed')
+
+        return result
+
+    monkeypatch.setattr(ingest_sources, 'export_range', fail_last_range)
+
+    with pytest.raises(RuntimeError):
+        ingest_sources.backfill_table('events', source_db.engine, aws['s3'], 'events_1', 'csv', dedup_index=ingest_sources.get_dedup_index('events', aws['s3']))
+
+    assert aws['s3'].list_objects_v2(Bucket='test-raw', Prefix='_dedup/')['Contents'] == []
+
+    monkeypatch.setattr(ingest_sources, 'export_range', export_range)
+
+    _, _, last_processed_date = ingest_sources.backfill_table('events', source_db.engine, aws['s3'], 'events_2', 'csv', dedup_index=ingest_sources.get_dedup_index('events', aws['s3']))
+
+    assert last_processed_date == pd.Timestamp('2025-01-04')
+    assert sum(len(read_csv(aws['s3'], 'test-raw', key)) for key in list_keys(aws['s3'], 'test-raw', 'raw_data/events_2_part-')) == 4
+    assert ingest_sources.get_dedup_index('events', aws['s3']).filter(make_events([1, 2], '2025-01-01')).empty
+
+def test_backfill_of_an_invalid_table_is_skipped_without_a_watermark(aws, source_db, monkeypatch):
+    monkeypatch.setenv('DEDUP_INDEX_PREFIX', '_dedup')
+    monkeypatch.setenv('BACKFILL_RANGES', '2')
+
+    source_db.write('events', make_events([1, 2]).drop(columns='amount'))
+    watermark = {'processed_date': None}
+
+    # Like any invalid extract the table is logged and skipped, the other tables of the run go on
+    ingest_sources.ingest_table('events', source_db.engine, aws['s3'], aws['dynamodb'], watermark, '2025-01-01_00-00-00')
+
+    assert aws['s3'].list_objects_v2(Bucket='test-raw')['Contents'] == []
+    assert aws['s3'].list_objects_v2(Bucket='test-raw', Prefix='_dedup/')['Contents'] == []
+    assert ingest_sources.get_watermarks(['events'], aws['dynamodb']) == {'events': {'processed_date': None}}
+
+def test_invalid_columns_are_rejected_before_rows_are_fetched(aws, source_db):
+    source_db.write('events', make_events([1, 2]).drop(columns='amount'))
+    query, params = ingest_sources.create_query('events', None)
+
+    with source_db.engine.connect() as conn:
+        assert ingest_sources.export_query(conn, 'events', query, 'events_1.csv', aws['s3'], params=params) == (False, 0, None)
+
+    # Only the header of the rejected table reaches the error bucket
+    rejected = read_csv(aws['s3'], 'test-errors', 'events_1.csv_empty_or_invalid_stricture.csv')
+
+    assert rejected.empty
+    assert rejected.columns.tolist() == ['event_id', 'label', 'created_at']
+    assert aws['s3'].list_objects_v2(Bucket='test-raw')['Contents'] == []
+
+def test_declared_column_types_are_applied_to_each_frame():
+    df = pd.DataFrame({
+        'event_id': [1, None],
+        'amount': [Decimal('1.50'), Decimal('2')],
+        'label': ['a', 'a'],
+        'created_at': [pd.Timestamp('2025-01-01 10:00:00').to_pydatetime(), None],
+    }, dtype=object)
+
+    typed = ingest_sources.apply_column_types(df, {'event_id': 'Int32', 'amount': 'float32', 'label': 'category', 'created_at': 'datetime64[ns]', 'missing': 'int8'})
+
+    assert typed.dtypes.astype(str).to_dict() == {'event_id': 'Int32', 'amount': 'float32', 'label': 'category', 'created_at': 'datetime64[ns]'}
+
+    # Nulls stay typed instead of becoming placeholder values
+    assert typed['event_id'].isna().tolist() == [False, True]
+    assert typed['created_at'].isna().tolist() == [False, True]
+
+def test_pushdown_query_cleans_like_clean_data(aws, source_db, monkeypatch):
+    monkeypatch.setenv('INGEST_PUSHDOWN', 'true')
+
+    source_db.write('events', pd.DataFrame({'event_id': [1, 2, 3, 3], 'label': ['a\tb', '  ', 'c', 'c'], 'amount': 1.0, 'created_at': '2025-01-01 00:00:00'}))
+
+    assert ingest_sources.is_pushdown_enabled('events')
+
+    exported = {}
+
+    for pushdown in [False, True]:
+        query, params = ingest_sources.create_query('events', None, pushdown=pushdown)
+
+        with source_db.engine.connect() as conn:
+            ingest_sources.export_query(conn, 'events', query, f"events_{pushdown}.csv", aws['s3'], params=params, pushdown=pushdown)
+
+        exported[pushdown] = read_csv(aws['s3'], 'test-raw', f"raw_data/events_{pushdown}.csv").sort_values('event_id', ignore_index=True)
+
+    pd.testing.assert_frame_equal(exported[True], exported[False])
+    assert exported[True]['label'].tolist() == ['a b', '-1', 'c']
+
+class CopyCursor:
+    # The psycopg2 cursor calls export_copy makes, COPY writes the rows the server would send
+    def __init__(self, body, last_processed_date):
+        self.body = body
+        self.last_processed_date = last_processed_date
+        self.statements = []
+        self.rowcount = -1
+
+    def execute(self, query, params=None):
+        self.statements.append(query)
+
+    def fetchone(self):
+        return (self.last_processed_date,)
+
+    def mogrify(self, query, params):
+        return (query % {name: f"'{value}'" for name, value in params.items()}).encode('utf-8')
+
+    def copy_expert(self, query, file):
+        self.statements.append(query)
+        file.write(self.body)
+        self.rowcount = self.body.count(b'\n') - 1
+
+class CopyEngine:
+    def __init__(self, cursor):
+        self.copy_cursor = cursor
+        self.closed = False
+
+    def raw_connection(self):
+        return self
+
+    def cursor(self):
+        return self.copy_cursor
+
+    def close(self):
+        self.closed = True
+
+@pytest.mark.parametrize('compression, key, decompress', [
+    ('none', 'raw_data/events_1.csv', bytes),
+    ('gzip', 'raw_data/events_1.csv.gz', gzip.decompress),
+])
+def test_copy_engine_streams_the_server_csv_to_s3(aws, monkeypatch, compression, key, decompress):
+    monkeypatch.setenv('CSV_COMPRESSION', compression)
+
+    body = b'event_id,label,amount,created_at\n1,a,1.0,2025-01-02 00:00:00\n2,b,2.0,2025-01-02 00:00:00\n'
+    engine = CopyEngine(CopyCursor(body, pd.Timestamp('2025-01-02')))
+    file_name = key.split('/')[-1]
+
+    assert ingest_sources.export_copy(engine, 'events', '2025-01-01 00:00:00', file_name, aws['s3']) == (True, 2, pd.Timestamp('2025-01-02'))
+
+    # The watermark and the COPY read one snapshot with the projection and cleaning done by the server
+    isolation, watermark_query, copy_query = engine.copy_cursor.statements
+
+    assert isolation.startswith('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+    assert watermark_query == 'SELECT max(created_at) FROM events WHERE created_at > CAST(%(processed_date)s AS timestamp)'
+    assert copy_query.startswith('COPY (SELECT DISTINCT event_id, CASE WHEN btrim(')
+    assert copy_query.endswith("FROM events WHERE created_at > CAST('2025-01-01 00:00:00' AS timestamp)) TO STDOUT WITH (FORMAT csv, HEADER true)")
+    assert decompress(aws['s3'].get_object(Bucket='test-raw', Key=key)['Body'].read()) == body
+    assert engine.closed
+
+def test_diff_snapshot_chunk_marks_inserts_and_updates():
+    key_columns = ['dim_key']
+    _, previous = ingest_sources.diff_snapshot_chunk(pd.DataFrame({'dim_key': [1, 2, 3], 'label': ['a', 'b', 'c']}), key_columns, np.array([], dtype=np.uint64), np.array([], dtype=np.uint64))
+    previous = previous.sort_values('key_hash', ignore_index=True)
+
+    changes, current = ingest_sources.diff_snapshot_chunk(
+        pd.DataFrame({'dim_key': [1, 2, 4], 'label': ['a', 'B', 'd']}),
+        key_columns,
+        previous['key_hash'].to_numpy(dtype=np.uint64),
+        previous['row_hash'].to_numpy(dtype=np.uint64)
+    )
+
+    assert dict(zip(changes['dim_key'], changes['change_op'])) == {2: 'update', 4: 'insert'}
+    assert current['dim_key'].tolist() == [1, 2, 4]
+
+def test_clean_data_falls_back_in_process_when_the_pool_breaks(monkeypatch):
+    class BrokenPool:
+        shut_down = False
+
+        def map(self, *args):
+            raise BrokenProcessPool('worker died')
+
+        def shutdown(self, wait=True, cancel_futures=False):
+            self.shut_down = True
+
+    pool = BrokenPool()
+    monkeypatch.setitem(resource_cache.process_pools, 2, pool)
+    monkeypatch.setenv('CLEAN_DATA_WORKERS', '2')
+    monkeypatch.setenv('CLEAN_DATA_MIN_SHARD_ROWS', '2')
+
+    df = pd.DataFrame({'label': [' a ', 'b', None, 'b'], 'created_at': pd.Timestamp('2025-01-01')})
+
+    pd.testing.assert_frame_equal(ingest_sources.clean_data(df.copy()), ingest_sources.clean_data_vectorized(df.copy()))
+    assert pool.shut_down
+    assert 2 not in resource_cache.process_pools
+
+def test_snapshot_diff_keeps_quarantined_keys_out_of_the_deletes(aws, source_db):
+    created_at = '2025-01-01 00:00:00'
+    source_db.write('dims', pd.DataFrame({'dim_key': [1, 2, 3], 'label': ['a', 'b', 'c'], 'created_at': created_at}))
+
+    assert ingest_sources.export_snapshot_diff(source_db.engine, 'dims', 'dims_1.csv', aws['s3']) == (True, 3)
+
+    # Key 2 fails its row rule and key 3 is gone from the source
+    source_db.write('dims', pd.DataFrame({'dim_key': [1, 2], 'label': ['a', None], 'created_at': created_at}))
+
+    assert ingest_sources.export_snapshot_diff(source_db.engine, 'dims', 'dims_2.csv', aws['s3']) == (True, 1)
+
+    changes = read_csv(aws['s3'], 'test-raw', 'raw_data/dims_2.csv')
+    quarantined = read_csv(aws['s3'], 'test-errors', 'dims_2.csv_quarantined.csv')
+
+    assert changes.columns.tolist() == ['dim_key', 'label', 'created_at', 'change_op']
+    assert changes[['dim_key', 'change_op']].values.tolist() == [[3, 'delete']]
+    assert quarantined['dim_key'].tolist() == [2]
+
+    # Once the row is fixed it is an update of the version emitted before, not a new insert
+    source_db.write('dims', pd.DataFrame({'dim_key': [1, 2], 'label': ['a', 'B'], 'created_at': created_at}))
+
+    assert ingest_sources.export_snapshot_diff(source_db.engine, 'dims', 'dims_3.csv', aws['s3']) == (True, 1)
+    assert read_csv(aws['s3'], 'test-raw', 'raw_data/dims_3.csv')[['dim_key', 'change_op']].values.tolist() == [[2, 'update']]
+
+def test_row_quarantine_holds_failing_rows_until_commit(aws):
+    rules = [{'column': 'amount', 'check': 'numeric', 'min': 0}, {'column': 'created_at', 'check': 'timestamp', 'required': True}]
+    quarantine = ingest_sources.RowQuarantine(aws['s3'], 'events', rules, 'events_1.csv')
+    df = pd.DataFrame({'event_id': [1, 2, 3, 4], 'amount': [5, -1, 'x', 2], 'created_at': ['2025-01-01', '2025-01-01', None, 'never']}, dtype=object)
+
+    kept = quarantine.filter(df)
+
+    # The remaining rows get the dtypes they would have had without the failing ones
+    assert kept['event_id'].tolist() == [1]
+    assert kept['amount'].dtype == np.int64
+    assert aws['s3'].list_objects_v2(Bucket='test-errors')['Contents'] == []
+
+    assert quarantine.commit() == 3
+
+    quarantined = read_csv(aws['s3'], 'test-errors', 'events_1.csv_quarantined.csv')
+
+    assert dict(zip(quarantined['event_id'], quarantined['quarantine_reason'])) == {
+        2: 'amount: not numeric or below 0',
+        3: 'amount: not numeric or below 0; created_at: not a timestamp or null',
+        4: 'created_at: not a timestamp or null',
+    }
+
+def test_row_quarantine_commits_nothing_without_failures(aws):
+    quarantine = ingest_sources.RowQuarantine(aws['s3'], 'events', [{'column': 'label', 'check': 'in', 'values': ['a']}], 'events_1.csv')
+
+    assert len(quarantine.filter(make_events([1, 2]).astype(object))) == 2
+    assert quarantine.commit() == 0
+    assert aws['s3'].list_objects_v2(Bucket='test-errors')['Contents'] == []
@@ -0,0 +1,12 @@
+import os
+import subprocess
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+def test_handlers_import_without_their_heavy_dependencies():
+    # A fresh interpreter, the other tests already loaded pandas into this one
+    code = "import sys, ingest_sources, load_raw; print(' '.join(sorted({'boto3', 'numpy', 'pandas', 'pyarrow', 'sqlalchemy'} & set(sys.modules))))"
+    result = subprocess.run([sys.executable, '-c', code], cwd=SRC_DIR, capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == ''
@@ -0,0 +1,120 @@
+import json
+
+import pytest
+
+import load_raw
+
+def make_sqs_event(keys):
+    return {
+        'Records': [
+            {
+                'eventSource': 'aws:sqs',
+                'messageId': f"message-{index}",
+                'body': json.dumps({'Records': [{'s3': {'bucket': {'name': 'test-raw'}, 'object': {'key': key, 'size': 1}}}]}),
+            }
+            for index, key in enumerate(keys)
+        ]
+    }
+
+def test_errors_outside_a_copy_fail_the_whole_sqs_batch(aws, monkeypatch):
+    aws['s3'].put_object(Bucket='test-raw', Key='raw_data/events_2025-01-01_00-00-00.csv', Body=b'event_id,label\n1,a\n')
+
+    def fail(**kwargs):
+        raise RuntimeError('throttled')
+
+    monkeypatch.setattr(aws['redshift-data'], 'execute_statement', fail)
+
+    # The messages go back to the queue instead of being deleted as if they had loaded
+    with pytest.raises(RuntimeError, match='throttled'):
+        load_raw.lambda_handler(make_sqs_event(['raw_data/events_2025-01-01_00-00-00.csv']), None)
+
+def test_a_failed_copy_fails_an_s3_invocation(aws):
+    event = {'Records': [{'eventSource': 'aws:s3', 's3': {'bucket': {'name': 'test-raw'}, 'object': {'key': 'raw_data/events_2025-01-01_00-00-00.csv', 'size': 1}}}]}
+
+    with pytest.raises(Exception, match='1 COPY statements failed'):
+        load_raw.lambda_handler(event, None)
+
+class BusyRedshiftData:
+    # Every slot of the workgroup is taken by statements of other invocations
+    def __init__(self):
+        self.list_calls = []
+
+    def list_statements(self, **kwargs):
+        self.list_calls.append(kwargs)
+
+        return {'Statements': [{'Id': f"other-{kwargs['Status']}"}]}
+
+def test_files_of_one_table_load_through_one_manifest_copy(aws):
+    keys = ['raw_data/events_2025-01-01_00-00-00.csv', 'raw_data/events_2025-01-02_00-00-00.csv', 'raw_data/order_item_options_2025-01-01_00-00-00.csv']
+
+    for key in keys:
+        aws['s3'].put_object(Bucket='test-raw', Key=key, Body=b'header\n1\n2\n')
+
+    assert load_raw.lambda_handler(make_sqs_event(keys), None) == {'batchItemFailures': []}
+
+    # Both tables go in one batch statement, the two events files in one COPY
+    (statement,) = aws['redshift-data'].statements.values()
+    events_copy, options_copy = [sub_statement['QueryString'] for sub_statement in statement['SubStatements']]
+    manifest_key = aws['s3'].list_objects_v2(Bucket='test-raw', Prefix='manifests/')['Contents'][0]['Key']
+    manifest = json.loads(aws['s3'].get_object(Bucket='test-raw', Key=manifest_key)['Body'].read())
+
+    assert statement['ResultRows'] == 6
+    assert events_copy.startswith(f"copy events_raw from 's3://test-raw/{manifest_key}'") and events_copy.endswith(' manifest;')
+    assert options_copy.startswith("copy order_item_options_raw from 's3://test-raw/raw_data/order_item_options_2025-01-01_00-00-00.csv'")
+    assert [entry['url'] for entry in manifest['entries']] == [f"s3://test-raw/{key}" for key in keys[:2]]
+
+def test_failed_batch_is_retried_one_table_at_a_time(aws):
+    aws['s3'].put_object(Bucket='test-raw', Key='raw_data/events_2025-01-01_00-00-00.csv', Body=b'event_id,label\n1,a\n')
+    aws['s3'].put_object(Bucket='test-raw', Key='raw_data/order_item_options_2025-01-01_00-00-00.csv', Body=b'order_id,lineitem_id\n1,a\n2,b\n')
+
+    # The third COPY reads an object that is not there, in one batch it would roll back the other two
+    event = make_sqs_event(['raw_data/events_2025-01-01_00-00-00.csv', 'raw_data/order_item_options_2025-01-01_00-00-00.csv', 'raw_data/order_items_2025-01-01_00-00-00.csv'])
+
+    assert load_raw.lambda_handler(event, None) == {'batchItemFailures': [{'itemIdentifier': 'message-2'}]}
+
+    statements = list(aws['redshift-data'].statements.values())
+    loaded = {load_raw.get_target_table(statement['QueryString']): statement['ResultRows'] for statement in statements if 'QueryString' in statement and statement['Status'] == 'FINISHED'}
+
+    assert [statement['Status'] for statement in statements] == ['FAILED', 'FINISHED', 'FINISHED', 'FAILED']
+    assert loaded == {'events_raw': 1, 'order_item_options_raw': 2}
+
+def test_slot_count_is_scoped_to_the_workgroup(aws):
+    redshift_client = BusyRedshiftData()
+    tracker = load_raw.StatementTracker(redshift_client, max_in_flight=4)
+
+    assert tracker.count_workgroup_in_flight() == len(load_raw.IN_FLIGHT_STATUSES)
+    assert {call['WorkgroupName'] for call in redshift_client.list_calls} == {'test-workgroup'}
+
+def test_waiting_for_a_slot_gives_up_at_the_timeout(aws):
+    tracker = load_raw.StatementTracker(BusyRedshiftData(), max_in_flight=1, timeout=0)
+
+    with pytest.raises(Exception, match='free Redshift statement slot'):
+        tracker.wait_for_slot()
+
+def test_snapshot_change_files_are_merged_by_primary_key_in_run_order(aws):
+    keys = ['raw_data/dims_2025-01-02_00-00-00.csv', 'raw_data/events_2025-01-01_00-00-00.csv', 'raw_data/dims_2025-01-01_00-00-00.csv']
+
+    for key in keys:
+        aws['s3'].put_object(Bucket='test-raw', Key=key, Body=b'header\n1\n')
+
+    assert load_raw.lambda_handler(make_sqs_event(keys), None) == {'batchItemFailures': []}
+
+    # The merge is a batch of its own, the events COPY goes separately
+    events_statement, merge_statement = aws['redshift-data'].statements.values()
+    queries = [sub_statement['QueryString'] for sub_statement in merge_statement['SubStatements']]
+    apply_changes = [
+        "delete from dims_raw using dims_raw_changes where dims_raw.dim_key = dims_raw_changes.dim_key;",
+        "insert into dims_raw (dim_key, label, created_at) select dim_key, label, created_at from dims_raw_changes where change_op <> 'delete';",
+        "delete from dims_raw_changes;",
+    ]
+
+    assert events_statement['QueryString'].startswith('copy events_raw from ')
+    assert queries == [
+        "create temp table dims_raw_changes as select dim_key, label, created_at, cast(null as varchar(6)) as change_op from dims_raw limit 0;",
+        load_raw.render_copy_query(load_raw.get_copy_template(keys[2]).replace('dims_raw', 'dims_raw_changes', 1), f"s3://test-raw/{keys[2]}"),
+        *apply_changes,
+        load_raw.render_copy_query(load_raw.get_copy_template(keys[0]).replace('dims_raw', 'dims_raw_changes', 1), f"s3://test-raw/{keys[0]}"),
+        *apply_changes,
+        "drop table dims_raw_changes;",
+    ]
+    assert merge_statement['ResultRows'] == 2
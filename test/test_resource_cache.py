@@ -0,0 +1,46 @@
+import json
+
+import resource_cache
+
+class Engine:
+    def __init__(self, secret):
+        self.secret = secret
+        self.disposed = False
+
+    def dispose(self):
+        self.disposed = True
+
+def test_clients_are_reused_until_the_credentials_change(monkeypatch):
+    created = []
+
+    monkeypatch.setattr(resource_cache, 'clients', {})
+    monkeypatch.setattr(resource_cache, 'create_client', lambda service_name: created.append(service_name) or object())
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'old')
+
+    client = resource_cache.get_client('s3')
+
+    assert resource_cache.get_client('s3') is client
+
+    # Every ingestion worker slot keeps a client of its own
+    assert resource_cache.get_client('s3', 'ingest-worker-0') is not client
+
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'new')
+
+    assert resource_cache.get_client('s3') is not client
+    assert created == ['s3', 's3', 's3']
+
+def test_engines_are_rebuilt_when_the_secret_rotates(monkeypatch):
+    secrets = {'source': json.dumps({'password': 'old'})}
+
+    monkeypatch.setattr(resource_cache, 'engines', {})
+    monkeypatch.setattr(resource_cache, 'get_secret', lambda secret_name, refresh=False: secrets[secret_name])
+
+    engine = resource_cache.get_engine('source', Engine)
+
+    assert resource_cache.get_engine('source', Engine) is engine
+
+    secrets['source'] = json.dumps({'password': 'new'})
+    rotated = resource_cache.get_engine('source', Engine)
+
+    assert rotated is not engine and engine.disposed
+    assert rotated.secret == {'password': 'new'}
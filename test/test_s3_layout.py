@@ -0,0 +1,37 @@
+import datetime
+
+import s3_layout
+
+def test_run_manifest_writes_a_part_per_export(aws):
+    s3_client = aws['s3']
+    manifest = s3_layout.RunManifest('2025-01-01_00-00-00_abcdef12', s3_client, 'test-raw')
+
+    manifest.add('events', [('raw_data/table=events/ingest_date=2025-01-01/restaurant_id=7/part-1.csv', 2)])
+
+    # An export that landed nothing writes no part
+    assert manifest.add('dims', []) is None
+
+    manifest.add('dims', [('raw_data/dims_2025-01-01_00-00-00.csv', 3)])
+
+    # Parts land as each export finishes, a run that times out later keeps what it listed
+    keys = s3_layout.list_run_manifests(s3_client, 'test-raw')
+    entries = [entry for key in keys for entry in s3_layout.read_run_manifest(s3_client, 'test-raw', key)['entries']]
+
+    assert keys == ['_manifests/2025-01-01_00-00-00_abcdef12_00000.json', '_manifests/2025-01-01_00-00-00_abcdef12_00001.json']
+    assert [(entry['table'], entry['rows'], entry['partition']) for entry in entries] == [
+        ('events', 2, {'table': 'events', 'ingest_date': '2025-01-01', 'restaurant_id': '7'}),
+        ('dims', 3, {}),
+    ]
+    assert s3_layout.list_run_manifests(s3_client, 'test-raw', keys[0]) == keys[1:]
+
+def test_settled_keys_move_the_watermark_and_recent_ones_stay_listed(monkeypatch):
+    monkeypatch.setenv('S3_SETTLE_MINUTES', '30')
+    recent = 'raw_data/events_' + (datetime.datetime.now() - datetime.timedelta(minutes=5)).strftime('%Y-%m-%d_%H-%M-%S')
+    settled = ['raw_data/events_2025-01-01_00-00-00.csv', 'raw_data/events_2025-01-02_00-00-00.csv']
+
+    start_after, processed = s3_layout.settle_keys('raw_data/events_', '', {*settled, recent})
+
+    assert (start_after, processed) == (settled[1], [recent])
+
+    # Nothing new has settled, the watermark stays
+    assert s3_layout.settle_keys('raw_data/events_', start_after, {recent}) == (start_after, [recent])
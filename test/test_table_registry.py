@@ -0,0 +1,31 @@
+import json
+
+import pytest
+
+import table_registry
+
+def test_registry_is_compiled_again_only_when_the_variable_changes(monkeypatch):
+    monkeypatch.setenv('FILE_STRUCTURES', json.dumps({'orders': {'required_columns': ['order_id'], 'primary_key': ['order_id']}}))
+
+    tables = table_registry.get_tables()
+
+    assert table_registry.get_tables() is tables
+    assert table_registry.get_table('orders').dedup_key == ['order_id']
+
+    monkeypatch.setenv('FILE_STRUCTURES', json.dumps({'orders': {'required_columns': ['order_id', 'created_at']}}))
+
+    assert table_registry.get_table('orders').get_missing_columns(['order_id']) == ['created_at']
+
+def test_files_match_the_longest_table_name(monkeypatch):
+    monkeypatch.setenv('FILE_STRUCTURES', json.dumps({'orders': {}, 'orders_archive': {}}))
+
+    assert table_registry.match_file('orders_archive_2025-01-01_00-00-00.csv').name == 'orders_archive'
+    assert table_registry.match_file('orders_2025-01-01_00-00-00.csv').name == 'orders'
+    assert table_registry.match_file('customers_2025-01-01_00-00-00.csv') is None
+
+    # Hive keys name their table in the path
+    assert table_registry.match_key('raw_data/table=orders/ingest_date=2025-01-01/part-2025-01-01_00-00-00.csv').name == 'orders'
+
+def test_snapshot_tables_need_the_columns_their_change_files_are_merged_on():
+    with pytest.raises(ValueError, match='Snapshot mode needs a primary_key and required_columns for dims'):
+        table_registry.compile_structures(json.dumps({'dims': {'extract_mode': 'snapshot', 'primary_key': ['dim_key']}}))
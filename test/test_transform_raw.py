@@ -0,0 +1,117 @@
+import datetime
+import io
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+import transform_raw
+
+LINE_ITEM_COLUMNS = ['app_name', 'restaurant_id', 'creation_time_utc', 'order_id', 'user_id', 'is_loyalty', 'currency', 'lineitem_id', 'item_category', 'item_name', 'item_price', 'item_quantity', 'created_at']
+OPTION_COLUMNS = ['order_id', 'lineitem_id', 'option_group_name', 'option_name', 'option_price', 'option_quantity', 'created_at']
+
+def make_line_item(order_id, created_at):
+    return ['web', 1, created_at, order_id, 7, False, 'USD', 1, 'Burgers', 'Classic', 10.0, 1, created_at]
+
+def make_option(order_id, created_at, price):
+    return [order_id, 1, 'Size', 'Large', price, 1, created_at]
+
+def put_raw(s3_client, table_name, day, rows, columns):
+    # The raw tables are named the other way round, order_items holds the options
+    key = f"raw_data/{table_name}_2025-01-{day:02d}_00-00-00.csv"
+    s3_client.put_object(Bucket='test-raw', Key=key, Body=pd.DataFrame(rows, columns=columns).to_csv(index=False).encode('utf-8'))
+
+def put_recent_raw(s3_client, table_name, minutes_ago, rows, columns):
+    # Keys named inside the settle window, their run may still be landing files
+    name = (datetime.datetime.now() - datetime.timedelta(minutes=minutes_ago)).strftime('%Y-%m-%d_%H-%M-%S')
+    s3_client.put_object(Bucket='test-raw', Key=f"raw_data/{table_name}_{name}.csv", Body=pd.DataFrame(rows, columns=columns).to_csv(index=False).encode('utf-8'))
+
+def read_order_lines(s3_client):
+    keys = [s3_object['Key'] for s3_object in s3_client.list_objects_v2(Bucket='test-raw', Prefix='transformed/order_lines/')['Contents']]
+    tables = [pq.read_table(io.BytesIO(s3_client.get_object(Bucket='test-raw', Key=key)['Body'].read())) for key in keys]
+
+    if not tables:
+        return pd.DataFrame(columns=['order_id', 'option_count', 'option_revenue'])
+
+    return pd.concat([table.to_pandas() for table in tables], ignore_index=True).sort_values('order_id', ignore_index=True)
+
+def test_line_items_wait_for_options_that_arrive_in_a_later_run(aws):
+    s3_client, dynamo_db_client = aws['s3'], aws['dynamodb']
+
+    # Order 2's line item is newer than every option read so far, its option lands with the next run
+    put_raw(s3_client, 'order_items', 1, [make_option('1', '2025-01-01 10:00:00', 1.0)], OPTION_COLUMNS)
+    put_raw(s3_client, 'order_item_options', 1, [make_line_item('1', '2025-01-01 10:00:00'), make_line_item('2', '2025-01-01 10:05:00')], LINE_ITEM_COLUMNS)
+
+    transform_raw.transform_raw(s3_client, dynamo_db_client)
+
+    assert read_order_lines(s3_client)['order_id'].tolist() == ['1']
+
+    put_raw(s3_client, 'order_items', 2, [make_option('2', '2025-01-01 10:05:00', 2.5)], OPTION_COLUMNS)
+
+    transform_raw.transform_raw(s3_client, dynamo_db_client)
+
+    order_lines = read_order_lines(s3_client)
+
+    assert order_lines[['order_id', 'option_count', 'option_revenue']].values.tolist() == [['1', 1, 1.0], ['2', 1, 2.5]]
+
+def test_a_run_that_dies_after_its_manifest_is_not_transformed_again(aws, monkeypatch):
+    s3_client, dynamo_db_client = aws['s3'], aws['dynamodb']
+
+    put_raw(s3_client, 'order_items', 1, [make_option('1', '2025-01-01 10:00:00', 1.0)], OPTION_COLUMNS)
+    put_raw(s3_client, 'order_item_options', 1, [make_line_item('1', '2025-01-01 10:00:00')], LINE_ITEM_COLUMNS)
+
+    def fail(*args):
+        raise RuntimeError('watermark write failed')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(transform_raw, 'mark_last_processed_key', fail)
+
+        with pytest.raises(RuntimeError):
+            transform_raw.transform_raw(s3_client, dynamo_db_client)
+
+    # The retry starts from the committed manifest instead of the raw watermarks that never moved
+    transform_raw.transform_raw(s3_client, dynamo_db_client)
+
+    assert read_order_lines(s3_client)['order_id'].tolist() == ['1']
+    assert len(s3_client.list_objects_v2(Bucket='test-raw', Prefix='transformed/_runs/')['Contents']) == 1
+
+def test_a_raw_file_landing_after_a_later_named_one_is_still_read(aws):
+    s3_client, dynamo_db_client = aws['s3'], aws['dynamodb']
+
+    put_recent_raw(s3_client, 'order_items', 1, [make_option('1', '2025-01-01 10:00:00', 1.0)], OPTION_COLUMNS)
+    put_recent_raw(s3_client, 'order_item_options', 1, [make_line_item('1', '2025-01-01 10:00:00'), make_line_item('2', '2025-01-01 10:05:00')], LINE_ITEM_COLUMNS)
+
+    transform_raw.transform_raw(s3_client, dynamo_db_client)
+
+    # A longer run that started earlier lands its file after the first transform read past its name
+    put_recent_raw(s3_client, 'order_items', 5, [make_option('2', '2025-01-01 10:05:00', 2.5)], OPTION_COLUMNS)
+
+    transform_raw.transform_raw(s3_client, dynamo_db_client)
+    transform_raw.transform_raw(s3_client, dynamo_db_client)
+
+    order_lines = read_order_lines(s3_client)
+
+    assert order_lines[['order_id', 'option_count', 'option_revenue']].values.tolist() == [['1', 1, 1.0], ['2', 1, 2.5]]
+
+def test_parquet_raw_files_are_read_a_row_group_at_a_time(aws, monkeypatch):
+    s3_client, dynamo_db_client = aws['s3'], aws['dynamodb']
+    monkeypatch.setenv('TRANSFORM_CHUNK_SIZE', '1')
+
+    options = pd.DataFrame([make_option('1', '2025-01-01 10:00:00', 1.0), make_option('2', '2025-01-01 10:00:00', 2.5)], columns=OPTION_COLUMNS)
+    buffer = io.BytesIO()
+    options.to_parquet(buffer, index=False, row_group_size=1)
+    s3_client.put_object(Bucket='test-raw', Key='raw_data/order_items_2025-01-01_00-00-00.parquet', Body=buffer.getvalue())
+    put_raw(s3_client, 'order_item_options', 1, [make_line_item('1', '2025-01-01 10:00:00'), make_line_item('2', '2025-01-01 10:00:00')], LINE_ITEM_COLUMNS)
+
+    transform_raw.transform_raw(s3_client, dynamo_db_client)
+
+    assert read_order_lines(s3_client)[['order_id', 'option_revenue']].values.tolist() == [['1', 1.0], ['2', 2.5]]
+
+def test_pending_option_totals_keep_the_newest_under_the_cap(aws, monkeypatch):
+    monkeypatch.setenv('TRANSFORM_PENDING_OPTION_ROWS', '2')
+    options = pd.DataFrame([make_option(str(order_id), f"2025-01-01 10:0{order_id}:00", 1.0) for order_id in [3, 1, 2]], columns=OPTION_COLUMNS)
+
+    key = transform_raw.save_pending_options(aws['s3'], 'run', transform_raw.aggregate_options(options))
+    option_totals, _ = transform_raw.load_pending_options(aws['s3'], key)
+
+    assert sorted(option_totals.index.get_level_values('order_id')) == ['2', '3']